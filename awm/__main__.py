@@ -14,8 +14,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from awm.routers import deployments, allocations, tools, service
+from awm.oidc.client import AsyncOpenIDClient
+from awm.authorization import OIDC_ALLOWED_ISSUERS
+from awm.utils.db import DataBase
+from awm.utils.migrations import migrate_url
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    migrate_url(deployments.DB_SHARD_URLS or deployments.DB_URL)
+    await AsyncOpenIDClient.prewarm(OIDC_ALLOWED_ISSUERS)
+    yield
+    await AsyncOpenIDClient.close()
+    DataBase.close_all()
 
 
 def create_app():
@@ -24,6 +38,7 @@ def create_app():
         description="EOSC Application Workflow Management API",
         version="0.1.46",
         docs_url="/",
+        lifespan=lifespan,
     )
 
     app.include_router(
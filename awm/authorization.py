@@ -13,10 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import time
 import logging
 from fastapi import HTTPException, Security
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from awm.oidc.client import OpenIDClient
+from awm.oidc.client import OpenIDClient, AsyncOpenIDClient
+from awm.oidc.jwt import JWT, TokenClaims
+from awm.utils.cache import TTLCache
+from awm.utils import metrics
 
 # Middleware de seguridad HTTP para Bearer Token
 security = HTTPBearer(
@@ -26,30 +31,109 @@ security = HTTPBearer(
 )
 logger = logging.getLogger(__name__)
 
+# How tokens are validated: "userinfo" (calling the issuer userinfo endpoint),
+# "jwt" (verifying the token signature locally with the issuer JWKS)
+# or "introspection" (calling the issuer introspection endpoint)
+OIDC_AUTH_MODE = os.getenv("OIDC_AUTH_MODE", "userinfo")
+if OIDC_AUTH_MODE not in ["userinfo", "jwt", "introspection"]:
+    raise Exception(f"OIDC auth mode '{OIDC_AUTH_MODE}' is not supported")
+# Client credentials used in the introspection requests
+OIDC_CLIENT_ID = os.getenv("OIDC_CLIENT_ID")
+OIDC_CLIENT_SECRET = os.getenv("OIDC_CLIENT_SECRET")
+if OIDC_AUTH_MODE == "introspection" and not (OIDC_CLIENT_ID and OIDC_CLIENT_SECRET):
+    raise Exception("OIDC_CLIENT_ID and OIDC_CLIENT_SECRET must be set to use introspection")
+# Comma separated list of the OIDC issuers accepted (if empty any issuer is accepted)
+OIDC_ALLOWED_ISSUERS = [iss.strip() for iss in os.getenv("OIDC_ALLOWED_ISSUERS", "").split(",") if iss.strip()]
+# Audience that the tokens must have (verified in jwt mode)
+OIDC_AUDIENCE = os.getenv("OIDC_AUDIENCE", OIDC_CLIENT_ID)
+# the signing keys or the introspection endpoint (that gets the client credentials)
+# are got from the token issuer, so it must be a trusted one
+if OIDC_AUTH_MODE in ["jwt", "introspection"] and not OIDC_ALLOWED_ISSUERS:
+    raise Exception(f"OIDC_ALLOWED_ISSUERS must be set to use {OIDC_AUTH_MODE} mode")
+if OIDC_AUTH_MODE == "jwt":
+    if not OIDC_AUDIENCE:
+        raise Exception("OIDC_AUDIENCE (or OIDC_CLIENT_ID) must be set to use jwt mode")
+# Time (in secs) to remember tokens rejected before contacting the issuer
+OIDC_REJECTED_CACHE_TTL = int(os.getenv("OIDC_REJECTED_CACHE_TTL", "60"))
+# Allowed clock skew (in secs) checking the nbf claim (the same used verifying JWTs)
+OIDC_CLOCK_SKEW = OpenIDClient.CLOCK_SKEW
+OIDC_CACHE_SIZE = int(os.getenv("OIDC_CACHE_SIZE", "1000"))
+OIDC_CACHE_TTL = int(os.getenv("OIDC_CACHE_TTL", "300"))
+# Cache of validated user info, indexed by the hash of the token
+user_info_cache = TTLCache(OIDC_CACHE_SIZE, OIDC_CACHE_TTL)
+metrics.register("oidc_user_info_cache", user_info_cache.stats)
+# Cache of the rejection reasons of invalid tokens, indexed by the hash of the token
+rejected_cache = TTLCache(OIDC_CACHE_SIZE, OIDC_REJECTED_CACHE_TTL)
+metrics.register("oidc_rejected_cache", rejected_cache.stats)
 
-def authenticate(
+
+async def authenticate(
     credentials: HTTPAuthorizationCredentials = Security(security)
 ):
     token = credentials.credentials
-    user_info = check_OIDC(token)
+    user_info = await async_check_OIDC(token)
     if user_info is None:
         raise HTTPException(status_code=401, detail="Authorization required")
     return user_info
 
 
-def check_OIDC(token):
+def _get_rejection_reason(claims: TokenClaims) -> str:
+    if not claims.iss or claims.exp is None:
+        return "Invalid token"
+    if OIDC_ALLOWED_ISSUERS and claims.iss.rstrip("/") not in [iss.rstrip("/") for iss in OIDC_ALLOWED_ISSUERS]:
+        return "Untrusted token issuer"
+    now = time.time()
+    if int(claims.exp) < now:
+        return "Token expired"
+    if int(claims.claims.get("nbf", 0)) > now + OIDC_CLOCK_SKEW:
+        return "Token not yet valid"
+    return None
+
+
+def _pre_check(token: str, cache_key: str) -> TokenClaims:
+    """Reject malformed, expired or untrusted tokens without any network request"""
+    reason = rejected_cache.get(cache_key)
+    if reason is None:
+        try:
+            claims = JWT.parse(token)
+            reason = _get_rejection_reason(claims)
+        except Exception:
+            reason = "Invalid token"
+        if reason is None:
+            return claims
+        rejected_cache.set(cache_key, reason)
+    raise HTTPException(status_code=401, detail=reason)
+
+
+def _cache_user_info(cache_key: str, claims: TokenClaims, user_info: dict):
+    # Do not cache the token itself, only the user info
+    user_info_cache.set(cache_key, dict(user_info), int(claims.exp))
+    user_info["token"] = claims.token
+    return user_info
+
+
+async def async_check_OIDC(token):
+    cache_key = TTLCache.hash_key(token)
+    user_info = user_info_cache.get(cache_key)
+    if user_info is not None:
+        return dict(user_info, token=token)
+
     try:
-        expired, _ = OpenIDClient.is_access_token_expired(token)
-        if expired:
-            raise HTTPException(status_code=401, detail="Token expired")
-        success, user_info = OpenIDClient.get_user_info_request(token)
+        claims = _pre_check(token, cache_key)
+        if OIDC_AUTH_MODE == "jwt":
+            success, user_info = await AsyncOpenIDClient.get_user_info_jwt(token, claims=claims,
+                                                                           allowed_issuers=OIDC_ALLOWED_ISSUERS,
+                                                                           audience=OIDC_AUDIENCE)
+        elif OIDC_AUTH_MODE == "introspection":
+            success, user_info = await AsyncOpenIDClient.get_user_info_introspection(
+                token, OIDC_CLIENT_ID, OIDC_CLIENT_SECRET, claims=claims, allowed_issuers=OIDC_ALLOWED_ISSUERS)
+        else:
+            success, user_info = await AsyncOpenIDClient.get_user_info_request(token, claims=claims)
         if not success:
             return None
+        return _cache_user_info(cache_key, claims, user_info)
     except HTTPException:
         raise
     except Exception:
         logger.exception("Error checking OIDC token")
         return None
-
-    user_info["token"] = token
-    return user_info
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 from typing import List, Union
+from urllib.parse import urlencode
 from pydantic import BaseModel, Field, HttpUrl
 from awm.models.allocation import AllocationInfo
 from awm.models.tool import ToolInfo
@@ -25,22 +26,33 @@ class Page(BaseModel):
     """Page Base class for pagination"""
     from_: int = Field(..., alias="from", description="Index of the first element to return")
     limit: int = Field(..., description="Maximum number of elements to return")
-    count: int = Field(..., description="Total number of elements")
+    count: int | None = Field(None, description="Total number of elements (if requested)")
     self_: HttpUrl | None = Field(None, alias="self", description="Endpoint that returned this page")
     prevPage: HttpUrl | None = Field(None, description="Endpoint that returns the previous page")
     nextPage: HttpUrl | None = Field(None, description="Endpoint that returns the next page")
 
     model_config = {"populate_by_name": True}
 
-    def set_next_and_prev_pages(self, request: Request, all_nodes: bool):
+    def set_next_and_prev_pages(self, request: Request, all_nodes: bool, keyset: bool = False,
+                                next_cursor: str = None):
+        """Set the links to the next and previous pages.
+        With keyset pagination the next page is got with next_cursor (None if there are no more elements)."""
         base_url = request.url.scheme + "://" + request.url.hostname + request.url.path
         if all_nodes:
             base_url += "?allNodes=true&"
         else:
             base_url += "?"
-        if self.from_ + self.limit < self.count:
+        # Keep the other parameters of the request (e.g. filters)
+        params = [(k, v) for k, v in request.query_params.multi_items()
+                  if k not in ["from", "limit", "cursor", "allNodes"]]
+        if params:
+            base_url += urlencode(params) + "&"
+        if keyset:
+            if next_cursor:
+                self.nextPage = HttpUrl(f"{base_url}cursor={next_cursor}&limit={self.limit}")
+        elif self.count is not None and self.from_ + self.limit < self.count:
             self.nextPage = HttpUrl(f"{base_url}from={self.from_ + self.limit}&limit={self.limit}")
-        if self.from_ > 0 and self.count > 0:
+        if self.from_ > 0 and self.count != 0:
             self.prevPage = HttpUrl(f"{base_url}from={max(0, self.from_ - self.limit)}&limit={self.limit}")
 
 
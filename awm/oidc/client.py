@@ -13,42 +13,166 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import json
-import requests
+import httpx
+import asyncio
+import logging
 import time
 from awm.oidc.jwt import JWT
+from awm.oidc.discovery import DiscoveryCache
+from awm.utils.cache import TTLCache
+from awm.utils import metrics
+
+
+logger = logging.getLogger(__name__)
 
 
 class OpenIDClient(object):
+    """Caches and transport independent logic of the OIDC clients (see AsyncOpenIDClient)"""
 
-    ISSUER_CONFIG_CACHE = {}
+    ISSUER_CONFIG_CACHE = DiscoveryCache(ttl=int(os.getenv("OIDC_DISCOVERY_TTL", "3600")),
+                                         refresh_ahead=int(os.getenv("OIDC_DISCOVERY_REFRESH", "300")))
+    JWKS_CACHE = {}
+    # Minimum time (in secs) between JWKS downloads of the same issuer
+    JWKS_MIN_REFRESH = 60
+    INTROSPECTION_CACHE = TTLCache(int(os.getenv("OIDC_CACHE_SIZE", "1000")),
+                                   int(os.getenv("OIDC_INTROSPECTION_TTL", "3600")))
+    # Time (in secs) to cache inactive tokens
+    INTROSPECTION_NEGATIVE_TTL = int(os.getenv("OIDC_INTROSPECTION_NEGATIVE_TTL", "30"))
+    # Allowed clock skew (in secs) checking the nbf claim
+    CLOCK_SKEW = 60
 
     @staticmethod
-    def get_openid_configuration(iss, verify_ssl=False):
-        try:
-            if iss in OpenIDClient.ISSUER_CONFIG_CACHE:
-                return OpenIDClient.ISSUER_CONFIG_CACHE[iss]
+    def _parse_openid_configuration(resp):
+        if resp.status_code != 200:
+            raise Exception("Code: %d. Message: %s." % (resp.status_code, resp.text))
+        conf = resp.json()
+        # Only store currently needed data
+        return {"userinfo_endpoint": conf["userinfo_endpoint"],
+                "introspection_endpoint": conf.get("introspection_endpoint"),
+                "jwks_uri": conf.get("jwks_uri")}
+
+    @staticmethod
+    def _jwks_cached(iss, refresh=False):
+        cached = OpenIDClient.JWKS_CACHE.get(iss)
+        if cached and (not refresh or time.time() - cached["updated"] < OpenIDClient.JWKS_MIN_REFRESH):
+            return cached["keys"]
+        return None
+
+    @staticmethod
+    def _store_jwks(iss, jwks):
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            if jwk.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[jwk.get("kid")] = JWT.load_jwk(jwk)
+            except Exception:
+                # Ignore unsupported keys
+                continue
+        OpenIDClient.JWKS_CACHE[iss] = {"keys": keys, "updated": time.time()}
+        return keys
+
+    @staticmethod
+    def check_issuer(iss, allowed_issuers):
+        """Check that an issuer is in the list of allowed ones (if set), before sending any request to it"""
+        if allowed_issuers is not None and (iss or "").rstrip("/") not in [i.rstrip("/") for i in allowed_issuers]:
+            raise Exception("Untrusted token issuer: %s." % iss)
+
+    @staticmethod
+    def _verify_claims(claims, keys, audience=None):
+        if claims.kid is None and len(keys) == 1:
+            key = list(keys.values())[0]
+        elif claims.kid in keys:
+            key = keys[claims.kid]
+        else:
+            return False, "Unknown signing key: %s." % claims.kid
+        user_info = JWT.verify(claims, key)
+        if int(user_info.get("nbf", 0)) > time.time() + OpenIDClient.CLOCK_SKEW:
+            return False, "Token not yet valid."
+        if audience:
+            aud = user_info.get("aud")
+            if audience not in (aud if isinstance(aud, list) else [aud]):
+                return False, "Invalid token audience."
+        return True, user_info
+
+    @staticmethod
+    def _cache_introspection(cache_key, introspection):
+        if introspection.get("active"):
+            res = True, introspection
+            expires = int(introspection["exp"]) if introspection.get("exp") else None
+        else:
+            res = False, "Token is not active."
+            expires = time.time() + OpenIDClient.INTROSPECTION_NEGATIVE_TTL
+        OpenIDClient.INTROSPECTION_CACHE.set(cache_key, res, expires)
+        return res
+
+
+class AsyncOpenIDClient(object):
+    """OIDC client using the caches of OpenIDClient and a pool of HTTP connections"""
+
+    POOL_SIZE = int(os.getenv("OIDC_POOL_SIZE", "20"))
+    TIMEOUT = int(os.getenv("OIDC_TIMEOUT", "30"))
+    HTTP_CLIENTS = {}
+
+    @staticmethod
+    def get_http_client(verify_ssl=False):
+        """
+        Get the shared HTTP client (one per verify_ssl value)
+        """
+        if verify_ssl not in AsyncOpenIDClient.HTTP_CLIENTS:
+            limits = httpx.Limits(max_connections=AsyncOpenIDClient.POOL_SIZE,
+                                  max_keepalive_connections=AsyncOpenIDClient.POOL_SIZE)
+            AsyncOpenIDClient.HTTP_CLIENTS[verify_ssl] = httpx.AsyncClient(verify=verify_ssl, limits=limits,
+                                                                           timeout=AsyncOpenIDClient.TIMEOUT)
+        return AsyncOpenIDClient.HTTP_CLIENTS[verify_ssl]
+
+    @staticmethod
+    async def close():
+        """
+        Close the shared HTTP clients
+        """
+        clients = list(AsyncOpenIDClient.HTTP_CLIENTS.values())
+        AsyncOpenIDClient.HTTP_CLIENTS.clear()
+        for client in clients:
+            await client.aclose()
+
+    @staticmethod
+    async def get_openid_configuration(iss, verify_ssl=False):
+        async def fetch(iss):
             url = "%s/.well-known/openid-configuration" % iss
-            resp = requests.request("GET", url, verify=verify_ssl)
-            if resp.status_code != 200:
-                return {"error": "Code: %d. Message: %s." % (resp.status_code, resp.text)}
-            # Only store currently needed data
-            OpenIDClient.ISSUER_CONFIG_CACHE[iss] = {"userinfo_endpoint": resp.json()["userinfo_endpoint"],
-                                                     "introspection_endpoint": resp.json()["introspection_endpoint"]}
-            return resp.json()
+            resp = await AsyncOpenIDClient.get_http_client(verify_ssl).get(url)
+            return OpenIDClient._parse_openid_configuration(resp)
+
+        try:
+            return await OpenIDClient.ISSUER_CONFIG_CACHE.get(iss, fetch)
         except Exception as ex:
             return {"error": str(ex)}
 
     @staticmethod
-    def get_user_info_request(token, verify_ssl=False):
+    async def prewarm(issuers, verify_ssl=False):
+        """
+        Load the configuration of a list of issuers
+        """
+        confs = await asyncio.gather(*[AsyncOpenIDClient.get_openid_configuration(iss, verify_ssl)
+                                       for iss in issuers])
+        for iss, conf in zip(issuers, confs):
+            if "error" in conf:
+                logger.warning("Error getting OIDC configuration of issuer %s: %s", iss, conf["error"])
+
+    @staticmethod
+    async def get_user_info_request(token, verify_ssl=False, claims=None):
         """
         Get a the user info from a token
         """
         try:
-            decoded_token = JWT().get_info(token)
+            if claims is None:
+                claims = JWT.parse(token)
             headers = {'Authorization': 'Bearer %s' % token}
-            conf = OpenIDClient.get_openid_configuration(decoded_token['iss'], verify_ssl=False)
-            resp = requests.request("GET", conf["userinfo_endpoint"], verify=verify_ssl, headers=headers)
+            conf = await AsyncOpenIDClient.get_openid_configuration(claims.iss)
+            resp = await AsyncOpenIDClient.get_http_client(verify_ssl).get(conf["userinfo_endpoint"],
+                                                                           headers=headers)
             if resp.status_code != 200:
                 return False, "Code: %d. Message: %s." % (resp.status_code, resp.text)
             return True, json.loads(resp.text)
@@ -56,16 +180,55 @@ class OpenIDClient(object):
             return False, str(ex)
 
     @staticmethod
-    def get_token_introspection(token, client_id, client_secret, verify_ssl=False):
+    async def get_jwks(iss, verify_ssl=False, refresh=False):
+        """
+        Get the public keys of an issuer indexed by kid
+        """
+        keys = OpenIDClient._jwks_cached(iss, refresh)
+        if keys is not None:
+            return keys
+        conf = await AsyncOpenIDClient.get_openid_configuration(iss)
+        if not conf.get("jwks_uri"):
+            raise Exception("Error getting jwks_uri of issuer %s: %s" % (iss, conf.get("error")))
+        resp = await AsyncOpenIDClient.get_http_client(verify_ssl).get(conf["jwks_uri"])
+        if resp.status_code != 200:
+            raise Exception("Code: %d. Message: %s." % (resp.status_code, resp.text))
+        return OpenIDClient._store_jwks(iss, resp.json())
+
+    @staticmethod
+    async def get_user_info_jwt(token, verify_ssl=False, claims=None, allowed_issuers=None, audience=None):
+        """
+        Get a the user info from the claims of a token, verifying its signature locally
+        with the keys of its issuer (that must be in allowed_issuers, if set) and its audience (if set)
+        """
+        try:
+            if claims is None:
+                claims = JWT.parse(token)
+            OpenIDClient.check_issuer(claims.iss, allowed_issuers)
+            keys = await AsyncOpenIDClient.get_jwks(claims.iss, verify_ssl)
+            if claims.kid not in keys:
+                # The issuer may have rotated its keys
+                keys = await AsyncOpenIDClient.get_jwks(claims.iss, verify_ssl, refresh=True)
+            return OpenIDClient._verify_claims(claims, keys, audience)
+        except Exception as ex:
+            return False, str(ex)
+
+    @staticmethod
+    async def get_token_introspection(token, client_id, client_secret, verify_ssl=False, claims=None,
+                                      allowed_issuers=None):
         """
-        Get token introspection
+        Get token introspection from its issuer, that must be in allowed_issuers (if set)
+        as the client credentials are sent to it
         """
         try:
-            decoded_token = JWT().get_info(token)
-            conf = OpenIDClient.get_openid_configuration(decoded_token['iss'], verify_ssl=False)
-            url = "%s?token=%s&token_type_hint=access_token" % (conf["introspection_endpoint"], token)
-            resp = requests.request("GET", url, verify=verify_ssl,
-                                    auth=requests.auth.HTTPBasicAuth(client_id, client_secret))
+            if claims is None:
+                claims = JWT.parse(token)
+            OpenIDClient.check_issuer(claims.iss, allowed_issuers)
+            conf = await AsyncOpenIDClient.get_openid_configuration(claims.iss)
+            data = {"token": token, "token_type_hint": "access_token"}
+            resp = await AsyncOpenIDClient.get_http_client(verify_ssl).post(conf["introspection_endpoint"],
+                                                                            data=data,
+                                                                            auth=(client_id, client_secret))
             if resp.status_code != 200:
                 return False, "Code: %d. Message: %s." % (resp.status_code, resp.text)
             return True, json.loads(resp.text)
@@ -73,21 +236,22 @@ class OpenIDClient(object):
             return False, str(ex)
 
     @staticmethod
-    def is_access_token_expired(token):
+    async def get_user_info_introspection(token, client_id, client_secret, verify_ssl=False, claims=None,
+                                          allowed_issuers=None):
         """
-        Check if the current access token is expired
+        Get a the user info from the introspection of a token.
+        Active tokens are cached until they expire and inactive ones for a short time.
         """
-        if token:
-            try:
-                decoded_token = JWT().get_info(token)
-                now = int(time.time())
-                expires = int(decoded_token['exp'])
-                validity = expires - now
-                if validity < 0:
-                    return True, "Token expired"
-                else:
-                    return False, "Valid Token for %d seconds" % validity
-            except Exception:
-                return True, "Error getting token info"
-        else:
-            return True, "No token specified"
+        cache_key = TTLCache.hash_key(token)
+        res = OpenIDClient.INTROSPECTION_CACHE.get(cache_key)
+        if res is None:
+            success, introspection = await AsyncOpenIDClient.get_token_introspection(token, client_id,
+                                                                                     client_secret, verify_ssl,
+                                                                                     claims, allowed_issuers)
+            if not success:
+                return False, introspection
+            res = OpenIDClient._cache_introspection(cache_key, introspection)
+        return res
+
+
+metrics.register("oidc_introspection_cache", OpenIDClient.INTROSPECTION_CACHE.stats)
@@ -0,0 +1,124 @@
+#
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class DiscoveryCache():
+    """
+    Cache of OIDC discovery documents indexed by issuer.
+
+    Entries expire after `ttl` seconds and are refreshed in background when
+    they are requested during the last `refresh_ahead` seconds of their life.
+    Concurrent misses of the same issuer wait (up to `wait_timeout` seconds)
+    for a single fetch.
+    The fetch coroutines must return the document to store or raise an Exception.
+    """
+
+    def __init__(self, ttl: float = 3600, refresh_ahead: float = 300, wait_timeout: float = 60):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.wait_timeout = wait_timeout
+        self._entries = {}
+        self._inflight = {}
+        self._refreshing = set()
+        self._tasks = set()
+
+    def _get_entry(self, iss: str, now: float):
+        entry = self._entries.get(iss)
+        if entry and entry[1] > now:
+            return entry
+        return None
+
+    def _store(self, iss: str, conf: dict):
+        self._entries[iss] = (conf, time.time() + self.ttl)
+
+    def _needs_refresh(self, iss: str, entry: tuple, now: float) -> bool:
+        """Check if the entry must be refreshed ahead, marking it as refreshing"""
+        if entry[1] - now < self.refresh_ahead and iss not in self._refreshing:
+            self._refreshing.add(iss)
+            return True
+        return False
+
+    async def _refresh(self, iss: str, fetch):
+        try:
+            self._store(iss, await fetch(iss))
+        except Exception:
+            logger.exception("Error refreshing OIDC configuration of issuer %s", iss)
+        finally:
+            self._refreshing.discard(iss)
+
+    async def _wait(self, iss: str, future: asyncio.Future) -> dict:
+        """Wait for the fetch of other request without cancelling it on timeout"""
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.wait_timeout)
+        except asyncio.TimeoutError:
+            raise Exception("Timeout waiting for the OIDC configuration of issuer %s" % iss)
+
+    async def get(self, iss: str, fetch) -> dict:
+        """Get the configuration of an issuer, awaiting fetch(iss) if needed"""
+        now = time.time()
+        entry = self._get_entry(iss, now)
+        if entry:
+            if self._needs_refresh(iss, entry, now):
+                task = asyncio.create_task(self._refresh(iss, fetch))
+                # keep a reference to the task until it finishes
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            return entry[0]
+
+        loop = asyncio.get_running_loop()
+        future = self._inflight.get(iss)
+        if future is not None and future.get_loop() is loop:
+            return await self._wait(iss, future)
+
+        future = loop.create_future()
+        self._inflight[iss] = future
+        try:
+            conf = await fetch(iss)
+            self._store(iss, conf)
+            future.set_result(conf)
+            return conf
+        except BaseException as ex:
+            # also resolve the future if the fetch is cancelled so that waiters do not hang
+            if not isinstance(ex, Exception):
+                ex = Exception("Request of the OIDC configuration of issuer %s cancelled" % iss)
+            future.set_exception(ex)
+            # avoid "exception was never retrieved" warnings if nobody waits
+            future.exception()
+            raise
+        finally:
+            if self._inflight.get(iss) is future:
+                del self._inflight[iss]
+
+    def __contains__(self, iss: str) -> bool:
+        return self._get_entry(iss, time.time()) is not None
+
+    def __getitem__(self, iss: str) -> dict:
+        entry = self._get_entry(iss, time.time())
+        if entry is None:
+            raise KeyError(iss)
+        return entry[0]
+
+    def pop(self, iss: str, default=None):
+        entry = self._entries.pop(iss, None)
+        return entry[0] if entry else default
+
+    def clear(self):
+        self._entries.clear()
@@ -16,10 +16,43 @@
 import json
 import base64
 import re
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+
+
+# Python's base64 functions ignore invalid characters, so we need to
+# check for them explicitly.
+B64_RE = re.compile(b"^[A-Za-z0-9_-]*$")
+
+
+class TokenClaims(NamedTuple):
+    """Immutable result of parsing a JWT once: the raw token, its header and its claims"""
+    token: str
+    header: Mapping
+    claims: Mapping
+
+    @property
+    def iss(self):
+        return self.claims.get("iss")
+
+    @property
+    def exp(self):
+        return self.claims.get("exp")
+
+    @property
+    def kid(self):
+        return self.header.get("kid")
 
 
 class JWT(object):
 
+    HASHES = {"256": hashes.SHA256, "384": hashes.SHA384, "512": hashes.SHA512}
+    CURVES = {"P-256": ec.SECP256R1, "P-384": ec.SECP384R1, "P-521": ec.SECP521R1}
+
     @staticmethod
     def b64d(b):
         """Decode some base64-encoded bytes.
@@ -31,10 +64,7 @@ class JWT(object):
 
         cb = b.rstrip(b"=")  # shouldn't but there you are
 
-        # Python's base64 functions ignore invalid characters, so we need to
-        # check for them explicitly.
-        b64_re = re.compile(b"^[A-Za-z0-9_-]*$")
-        if not b64_re.match(cb):
+        if not B64_RE.match(cb):
             raise Exception(cb, "base64-encoded data contains illegal characters")
 
         if cb == b:
@@ -56,15 +86,103 @@ class JWT(object):
             b += b"="
         return b
 
+    @staticmethod
+    def parse(token):
+        """
+        Unpacks a JWT into its parts, returning a TokenClaims object with
+        the header and the token info json decoded.
+        The signature is not verified.
+
+        :param token: The JWT token
+        """
+        part = token.encode("utf-8").split(b".")
+        if len(part) != 3:
+            raise Exception("Invalid JWT format")
+        if not B64_RE.match(part[2].rstrip(b"=")):
+            raise Exception(part[2], "base64-encoded data contains illegal characters")
+        header = json.loads(JWT.b64d(part[0]).decode("utf-8"))
+        claims = json.loads(JWT.b64d(part[1]).decode("utf-8"))
+        if not isinstance(header, dict) or not isinstance(claims, dict):
+            raise Exception("Invalid JWT format")
+        return TokenClaims(token, MappingProxyType(header), MappingProxyType(claims))
+
     @staticmethod
     def get_info(token):
         """
-        Unpacks a JWT into its parts and base64 decodes the parts
-        individually, returning the part 1 json decoded, where the
-        token info is stored.
+        Unpacks a JWT into its parts returning the token info json decoded.
+
+        :param token: The JWT token
+        """
+        return dict(JWT.parse(token).claims)
+
+    @staticmethod
+    def get_header(token):
+        """
+        Returns the JOSE header of a JWT json decoded.
 
         :param token: The JWT token
         """
-        part = tuple(token.encode("utf-8").split(b"."))
-        part = [JWT.b64d(p) for p in part]
-        return json.loads(part[1].decode("utf-8"))
+        return dict(JWT.parse(token).header)
+
+    @staticmethod
+    def _b64_to_int(value):
+        return int.from_bytes(JWT.b64d(value.encode("utf-8")), "big")
+
+    @staticmethod
+    def load_jwk(jwk):
+        """
+        Returns the public key represented by a JWK (RSA or EC keys).
+
+        :param jwk: The JWK as a dict
+        """
+        if jwk.get("kty") == "RSA":
+            return rsa.RSAPublicNumbers(JWT._b64_to_int(jwk["e"]), JWT._b64_to_int(jwk["n"])).public_key()
+        elif jwk.get("kty") == "EC":
+            if jwk.get("crv") not in JWT.CURVES:
+                raise Exception("Unsupported EC curve: %s" % jwk.get("crv"))
+            curve = JWT.CURVES[jwk["crv"]]()
+            return ec.EllipticCurvePublicNumbers(JWT._b64_to_int(jwk["x"]),
+                                                 JWT._b64_to_int(jwk["y"]),
+                                                 curve).public_key()
+        raise Exception("Unsupported key type: %s" % jwk.get("kty"))
+
+    @staticmethod
+    def verify(token, key):
+        """
+        Verifies the signature of a JWT with the public key provided,
+        returning the token info json decoded.
+        Raises Exception if the signature is not valid.
+        Only asymmetric algorithms (RS*, PS* and ES*) are supported.
+
+        :param token: The JWT token (or the TokenClaims returned by parse)
+        :param key: The public key (as returned by load_jwk)
+        """
+        if not isinstance(token, TokenClaims):
+            token = JWT.parse(token)
+        alg = token.header.get("alg", "")
+        if alg[:2] not in ["RS", "PS", "ES"] or alg[2:] not in JWT.HASHES:
+            raise Exception("Unsupported JWT algorithm: %s" % alg)
+        hash_alg = JWT.HASHES[alg[2:]]()
+        signing_input, signature = token.token.encode("utf-8").rsplit(b".", 1)
+        signature = JWT.b64d(signature)
+
+        try:
+            if alg.startswith("ES"):
+                if not isinstance(key, ec.EllipticCurvePublicKey):
+                    raise Exception("Invalid key type for algorithm %s" % alg)
+                num_len = len(signature) // 2
+                signature = encode_dss_signature(int.from_bytes(signature[:num_len], "big"),
+                                                 int.from_bytes(signature[num_len:], "big"))
+                key.verify(signature, signing_input, ec.ECDSA(hash_alg))
+            else:
+                if not isinstance(key, rsa.RSAPublicKey):
+                    raise Exception("Invalid key type for algorithm %s" % alg)
+                if alg.startswith("PS"):
+                    pad = padding.PSS(mgf=padding.MGF1(hash_alg), salt_length=hash_alg.digest_size)
+                else:
+                    pad = padding.PKCS1v15()
+                key.verify(signature, signing_input, pad, hash_alg)
+        except InvalidSignature:
+            raise Exception("Invalid JWT signature")
+
+        return dict(token.claims)
@@ -15,7 +15,6 @@
 
 import os
 import awm
-import json
 from fastapi import APIRouter, Query, Depends, Request, Response
 from awm.authorization import authenticate
 from awm.models.allocation import AllocationInfo, Allocation, AllocationId
@@ -31,15 +30,27 @@ ALLOCATION_STORE = os.getenv("ALLOCATION_STORE", "vault")
 
 if ALLOCATION_STORE == "db":
     from awm.utils.allocation_store_db import AllocationStoreDB
+    from awm.utils.db import DataBase
     DB_URL = os.getenv("DB_URL", AllocationStoreDB.DEFAULT_URL)
-    allocation_store = AllocationStoreDB(DB_URL)
+    DB_SHARD_URLS = DataBase.split_urls(os.getenv("DB_SHARD_URLS"))
+    DB_READ_URLS = DataBase.split_urls(os.getenv("DB_READ_URLS"))
+    allocation_store = AllocationStoreDB(DB_SHARD_URLS or DB_URL, DB_READ_URLS)
 elif ALLOCATION_STORE == "vault":
     from awm.utils.allocation_store_vault import AllocationStoreVault
     VAULT_URL = os.getenv("VAULT_URL", AllocationStoreVault.DEFAULT_URL)
     ENCRYPT_KEY = os.getenv("ENCRYPT_KEY", AllocationStoreVault.DEFAULT_KEY)
-    allocation_store = AllocationStoreVault(VAULT_URL, key=ENCRYPT_KEY)
+    VAULT_LAYOUT = os.getenv("VAULT_LAYOUT", AllocationStoreVault.LAYOUT_SINGLE)
+    allocation_store = AllocationStoreVault(VAULT_URL, key=ENCRYPT_KEY, layout=VAULT_LAYOUT)
 else:
     raise Exception(f"Allocation store '{ALLOCATION_STORE}' is not supported")
+# Cache of the allocations of each user (0 to disable it)
+ALLOCATION_CACHE_SIZE = int(os.getenv("ALLOCATION_CACHE_SIZE", "0"))
+if ALLOCATION_CACHE_SIZE > 0:
+    from awm.utils.allocation_store_cache import CachingAllocationStore
+    ALLOCATION_CACHE_TTL = int(os.getenv("ALLOCATION_CACHE_TTL", "60"))
+    ALLOCATION_CACHE_BYTES = int(os.getenv("ALLOCATION_CACHE_BYTES", "67108864"))
+    allocation_store = CachingAllocationStore(allocation_store, ALLOCATION_CACHE_SIZE, ALLOCATION_CACHE_TTL,
+                                              ALLOCATION_CACHE_BYTES)
 
 
 # GET /allocations
@@ -64,10 +75,21 @@ def list_allocations(
     limit: int = Query(100, alias="limit", ge=1,
                        description="Maximum number of elements to return"),
     all_nodes: bool = Query(False, alias="allNodes"),
+    cursor: str = Query(None, description="Opaque cursor, returned in nextPage, to get the next elements"),
+    with_count: bool = Query(True, alias="withCount",
+                             description="Return the total number of elements (set to false to skip counting them)"),
     user_info=Depends(authenticate)
 ):
+    if cursor and all_nodes:
+        return return_error("cursor is not supported with allNodes", 400)
+    if cursor:
+        from_ = 0
     try:
-        count, allocations = allocation_store.list_allocations(user_info, from_, limit)
+        # The local count is needed to paginate the remote nodes
+        count, allocations, next_cursor = allocation_store.list_allocations(user_info, from_, limit, cursor,
+                                                                            with_count or all_nodes)
+    except ValueError as ex:
+        return return_error(str(ex), 400)
     except Exception as ex:
         return return_error(str(ex), 503)
 
@@ -88,8 +110,10 @@ def list_allocations(
         res.extend(remote_tools)
         count += remote_count
 
-    page = PageOfAllocations(from_=from_, limit=limit, elements=res, count=count)
-    page.set_next_and_prev_pages(request, all_nodes)
+    page = PageOfAllocations(from_=from_, limit=limit, elements=res)
+    if count is not None:
+        page.count = count
+    page.set_next_and_prev_pages(request, all_nodes, keyset=not all_nodes, next_cursor=next_cursor)
     return Response(content=page.model_dump_json(exclude_unset=True, by_alias=True),
                     status_code=200, media_type="application/json")
 
@@ -143,13 +167,13 @@ def get_allocation(request: Request,
 
 def _check_allocation_in_use(allocation_id: str, user_info: dict, request: Request) -> Response:
     # check if this allocation is used in any deployment
-    response = awm.routers.deployments._list_deployments(user_info=user_info, request=request)
-    if response.status_code != 200:
-        return response
+    try:
+        in_use = awm.routers.deployments._is_allocation_in_use(allocation_id, user_info)
+    except Exception as ex:
+        return return_error(str(ex), 503)
 
-    for dep_info in json.loads(response.body).get("elements"):
-        if dep_info.get('deployment', {}).get('allocation', {}).get('id') == allocation_id:
-            return return_error("Allocation in use", 409)
+    if in_use:
+        return return_error("Allocation in use", 409)
 
     return None
 
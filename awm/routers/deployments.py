@@ -25,8 +25,11 @@ from awm.models.error import Error
 from awm.models.success import Success
 from awm.models.allocation import AllocationUnion
 from awm.utils.node_registry import EOSCNodeRegistry
-from typing import Tuple, Union
+from typing import Literal, Tuple, Union
 from awm.utils.db import DataBase
+from awm.utils.migrations import migrate
+from awm.utils.pagination import (CREATED, cursor_created, encode_cursor, decode_cursor, mongo_seek_filter,
+                                  mongo_sort, sql_list_query, sql_list_total)
 
 from . import return_error
 
@@ -34,23 +37,10 @@ from . import return_error
 router = APIRouter()
 IM_URL = os.getenv("IM_URL", "http://localhost:8800")
 DB_URL = os.getenv("DB_URL", "file:///tmp/awm.db")
-
-
-def _init_table(db: DataBase) -> bool:
-    """Creates de database."""
-    if not db.table_exists("deployments"):
-        awm.logger.info("Creating deployments table")
-        if db.db_type == DataBase.MYSQL:
-            db.execute("CREATE TABLE deployments (id VARCHAR(255) PRIMARY KEY, data TEXT"
-                       ", owner VARCHAR(255), created TIMESTAMP)")
-        elif db.db_type == DataBase.SQLITE:
-            db.execute("CREATE TABLE deployments (id TEXT PRIMARY KEY, data TEXT"
-                       ", owner VARCHAR(255), created TIMESTAMP)")
-        elif db.db_type == DataBase.MONGO:
-            db.connection.create_collection("deployments")
-            db.connection["deployments"].create_index([("id", 1), ("owner", 1)], unique=True)
-        return True
-    return False
+# Whitespace separated lists of the URLs of the DB shards (used instead of DB_URL if set)
+# and of the DB read replicas
+DB_SHARD_URLS = DataBase.split_urls(os.getenv("DB_SHARD_URLS"))
+DB_READ_URLS = DataBase.split_urls(os.getenv("DB_READ_URLS"))
 
 
 def _get_im_auth_header(token: str, allocation: AllocationUnion = None) -> dict:
@@ -82,19 +72,53 @@ def _get_im_auth_header(token: str, allocation: AllocationUnion = None) -> dict:
     return auth_data
 
 
+def _update_deployment_status(dep_info: DeploymentInfo, owner: str):
+    """Store the last status got from the IM, to filter the deployments by status"""
+    # Without the read replicas, so that the owner is not marked as a recent writer:
+    # it only refreshes the stored status, which may be stale in any case
+    db = DataBase(DB_SHARD_URLS or DB_URL, owner=owner)
+    if db.connect():
+        with db:
+            data = dep_info.model_dump_json(exclude_unset=True)
+            if db.db_type == DataBase.MONGO:
+                db.update("deployments", {"id": dep_info.id}, {"$set": {"data": data, "status": dep_info.status}},
+                          upsert=False)
+            else:
+                db.execute("UPDATE deployments SET data = %s, status = %s WHERE id = %s",
+                           (data, dep_info.status, dep_info.id))
+    else:
+        awm.logger.error("Failed to store the status of deployment %s", dep_info.id)
+
+
+def _is_allocation_in_use(allocation_id: str, user_info: dict) -> bool:
+    """Check if any deployment of the user uses an allocation (using the allocation_id index)"""
+    db = DataBase(DB_SHARD_URLS or DB_URL, DB_READ_URLS, owner=user_info['sub'])
+    if db.connect():
+        with db:
+            migrate(db)
+            if db.db_type == DataBase.MONGO:
+                res = db.find("deployments", {"owner": user_info['sub'], "allocation_id": allocation_id},
+                              {"id": True}, limit=1)
+            else:
+                res = db.select("SELECT id FROM deployments WHERE owner = %s and allocation_id = %s LIMIT 1",
+                                (user_info['sub'], allocation_id))
+        return bool(res)
+    raise Exception("Database connection failed")
+
+
 def _get_deployment(deployment_id: str, user_info: dict, request: Request,
                     get_state: bool = True) -> Tuple[Union[Error, Deployment], int]:
     dep_info = None
     user_token = user_info['token']
     user_id = user_info['sub']
-    db = DataBase(DB_URL)
+    db = DataBase(DB_SHARD_URLS or DB_URL, DB_READ_URLS, owner=user_id)
     if db.connect():
-        _init_table(db)
-        if db.db_type == DataBase.MONGO:
-            res = db.find("deployments", {"id": deployment_id, "owner": user_id}, {"data": True})
-        else:
-            res = db.select("SELECT data FROM deployments WHERE id = %s and owner = %s", (deployment_id, user_id))
-        db.close()
+        with db:
+            migrate(db)
+            if db.db_type == DataBase.MONGO:
+                res = db.find("deployments", {"id": deployment_id, "owner": user_id}, {"data": True})
+            else:
+                res = db.select("SELECT data FROM deployments WHERE id = %s and owner = %s", (deployment_id, user_id))
         if res:
             if db.db_type == DataBase.MONGO:
                 deployment_data = res[0]["data"]
@@ -125,7 +149,9 @@ def _get_deployment(deployment_id: str, user_info: dict, request: Request,
                         if not success:
                             msg = Error(description=state_info)
                             return msg, 400
-                        dep_info.status = state_info['state']
+                        if dep_info.status != state_info['state']:
+                            dep_info.status = state_info['state']
+                            _update_deployment_status(dep_info, user_id)
             except Exception as ex:
                 msg = Error(id="400", description=str(ex))
                 return msg, 400
@@ -140,41 +166,80 @@ def _get_deployment(deployment_id: str, user_info: dict, request: Request,
 
 def _list_deployments(from_: int = 0, limit: int = 100,
                       all_nodes: bool = False,
-                      user_info: dict = None, request: Request = None) -> Response:
+                      user_info: dict = None, request: Request = None,
+                      cursor: str = None, with_count: bool = True,
+                      filters: dict = None, sort: str = None) -> Response:
+    """List the deployments of the user.
+    filters is a dict of the values that the deployments must have in the
+    status, tool_id or allocation_id columns, and sort is "created" or "-created".
+    The status is the last one got from the IM when getting the deployment,
+    so the status filter may return deployments whose status has changed."""
+    filters = {column: value for column, value in (filters or {}).items() if value is not None}
+    if all_nodes and (filters or sort):
+        return return_error("Filters and sort are not supported with allNodes", 400)
+    # The local count is needed to paginate the remote nodes
+    with_count = with_count or all_nodes
+    if cursor:
+        if all_nodes:
+            return return_error("cursor is not supported with allNodes", 400)
+        try:
+            # created and id of the last element and the sort used
+            last = decode_cursor(cursor, CREATED, str, str)
+        except ValueError as ex:
+            return return_error(str(ex), 400)
+        from_ = 0
+    else:
+        last = None
+
     deployments = []
-    db = DataBase(DB_URL)
+    next_cursor = None
+    db = DataBase(DB_SHARD_URLS or DB_URL, DB_READ_URLS, owner=user_info['sub'])
     if db.connect():
-        _init_table(db)
-        if db.db_type == DataBase.MONGO:
-            res = db.find("deployments", filt={"owner": user_info['sub']},
-                          projection={"data": True}, sort=[('created', -1)])
-            for count, elem in enumerate(res):
-                if from_ > count:
-                    continue
-                deployment_data = elem['data']
-                try:
-                    deployment_info = DeploymentInfo.model_validate(deployment_data)
-                except Exception as ex:
-                    awm.logger.error("Failed to parse deployment info from database: %s", str(ex))
-                    continue
-                deployments.append(deployment_info)
-                if len(deployments) >= limit:
-                    break
-            count = len(res)
-        else:
-            sql = "SELECT data FROM deployments WHERE owner = %s order by created LIMIT %s OFFSET %s"
-            res = db.select(sql, (user_info['sub'], limit, from_))
-            for elem in res:
-                deployment_data = elem[0]
-                try:
-                    deployment_info = DeploymentInfo.model_validate_json(deployment_data)
-                except Exception as ex:
-                    awm.logger.error("Failed to parse deployment info from database: %s", str(ex))
-                    continue
-                deployments.append(deployment_info)
-            res = db.select("SELECT count(id) from deployments WHERE owner = %s", (user_info['sub'],))
-            count = res[0][0] if res else 0
-        db.close()
+        with db:
+            migrate(db)
+            if db.db_type == DataBase.MONGO:
+                descending = sort != "created"
+            else:
+                descending = sort == "-created"
+            order = "-created" if descending else "created"
+            if last and last[2] != order:
+                return return_error("Invalid cursor: it was got with a different sort", 400)
+            if db.db_type == DataBase.MONGO:
+                # Get one more element to know if there is a next page
+                res, count = db.find_page("deployments", dict(filters, owner=user_info['sub']),
+                                          projection={"data": True, "id": True, "created": True},
+                                          sort=mongo_sort(descending), skip=from_, limit=limit + 1,
+                                          seek=mongo_seek_filter(*last[:2], descending) if last else None,
+                                          with_total=with_count)
+                if len(res) > limit:
+                    next_cursor = encode_cursor(cursor_created(res[limit - 1].get('created')),
+                                                res[limit - 1].get('id'), order)
+                for elem in res[:limit]:
+                    deployment_data = elem['data']
+                    try:
+                        deployment_info = DeploymentInfo.model_validate(deployment_data)
+                    except Exception as ex:
+                        awm.logger.error("Failed to parse deployment info from database: %s", str(ex))
+                        continue
+                    deployments.append(deployment_info)
+            else:
+                sql, values = sql_list_query("deployments", "data, created, id", user_info['sub'], from_, limit,
+                                             last[:2] if last else None, with_count, filters, descending,
+                                             db.db_type)
+                res = db.select(sql, values)
+                if len(res) > limit:
+                    next_cursor = encode_cursor(cursor_created(res[limit - 1][1]), res[limit - 1][2], order)
+                for elem in res[:limit]:
+                    deployment_data = elem[0]
+                    try:
+                        deployment_info = DeploymentInfo.model_validate_json(deployment_data)
+                    except Exception as ex:
+                        awm.logger.error("Failed to parse deployment info from database: %s", str(ex))
+                        continue
+                    deployments.append(deployment_info)
+                count = None
+                if with_count:
+                    count = sql_list_total(db, "deployments", user_info['sub'], res, bool(from_ or last), filters)
     else:
         return return_error("Database connection failed", 503)
 
@@ -183,8 +248,10 @@ def _list_deployments(from_: int = 0, limit: int = 100,
         deployments.extend(remote_tools)
         count += remote_count
 
-    page = PageOfDeployments(from_=from_, limit=limit, elements=deployments, count=count, self_=str(request.url))
-    page.set_next_and_prev_pages(request, all_nodes)
+    page = PageOfDeployments(from_=from_, limit=limit, elements=deployments, self_=str(request.url))
+    if count is not None:
+        page.count = count
+    page.set_next_and_prev_pages(request, all_nodes, keyset=not all_nodes, next_cursor=next_cursor)
     return Response(content=page.model_dump_json(exclude_unset=True, by_alias=True),
                     status_code=200, media_type="application/json")
 
@@ -211,9 +278,19 @@ def list_deployments(
     limit: int = Query(100, alias="limit", ge=1,
                        description="Maximum number of elements to return"),
     all_nodes: bool = Query(False, alias="allNodes"),
+    cursor: str = Query(None, description="Opaque cursor, returned in nextPage, to get the next elements"),
+    with_count: bool = Query(True, alias="withCount",
+                             description="Return the total number of elements (set to false to skip counting them)"),
+    status: str = Query(None, description="Only return the deployments with this status (the last one "
+                                          "got when getting the deployment, it may be outdated)"),
+    tool: str = Query(None, description="Only return the deployments of this tool ID"),
+    allocation: str = Query(None, description="Only return the deployments in this allocation ID"),
+    sort: Literal["created", "-created"] = Query(None, description="Sort by creation time, ascending or "
+                                                                   "descending (with a leading '-')"),
     user_info=Depends(authenticate)
 ):
-    return _list_deployments(from_, limit, all_nodes, user_info, request)
+    filters = {"status": status, "tool_id": tool, "allocation_id": allocation}
+    return _list_deployments(from_, limit, all_nodes, user_info, request, cursor, with_count, filters, sort)
 
 
 # GET /deployment/{deployment_id}
@@ -289,14 +366,14 @@ def delete_deployment(deployment_id,
         if not success:
             return return_error(msg, 400)
 
-    db = DataBase(DB_URL)
+    db = DataBase(DB_SHARD_URLS or DB_URL, DB_READ_URLS, owner=user_info['sub'])
     if db.connect():
-        _init_table(db)
-        if db.db_type == DataBase.MONGO:
-            db.delete("deployments", {"id": deployment_id})
-        else:
-            db.execute("DELETE FROM deployments WHERE id = %s", (deployment_id,))
-        db.close()
+        with db:
+            migrate(db)
+            if db.db_type == DataBase.MONGO:
+                db.delete("deployments", {"id": deployment_id})
+            else:
+                db.execute("DELETE FROM deployments WHERE id = %s", (deployment_id,))
     else:
         return return_error("Database connection failed", 503)
 
@@ -351,22 +428,27 @@ def deploy_workload(deployment: Deployment,
         if not success:
             return_error(deployment_id, 400)
 
-    db = DataBase(DB_URL)
+    db = DataBase(DB_SHARD_URLS or DB_URL, DB_READ_URLS, owner=user_info['sub'])
     if db.connect():
-        _init_table(db)
-        deployment_info = DeploymentInfo(id=deployment_id,
-                                         deployment=deployment,
-                                         status="pending",
-                                         self_=str(request.url_for("get_deployment", deployment_id=deployment_id)))
-        data = deployment_info.model_dump_json(exclude_unset=True)
-        if db.db_type == DataBase.MONGO:
-            res = db.replace("deployments", {"id": deployment_id}, {"id": deployment_id, "data": data,
-                                                                    "owner": user_info['sub'],
-                                                                    "created": time.time()})
-        else:
-            res = db.execute("replace into deployments (id, data, created, owner) values (%s, %s, %s, %s)",
-                             (deployment_id, data, time.time(), user_info['sub']))
-        db.close()
+        with db:
+            migrate(db)
+            deployment_info = DeploymentInfo(id=deployment_id,
+                                             deployment=deployment,
+                                             status="pending",
+                                             self_=str(request.url_for("get_deployment", deployment_id=deployment_id)))
+            data = deployment_info.model_dump_json(exclude_unset=True)
+            if db.db_type == DataBase.MONGO:
+                res = db.replace("deployments", {"id": deployment_id}, {"id": deployment_id, "data": data,
+                                                                        "owner": user_info['sub'],
+                                                                        "created": time.time(),
+                                                                        "status": deployment_info.status,
+                                                                        "tool_id": deployment.tool.id,
+                                                                        "allocation_id": deployment.allocation.id})
+            else:
+                res = db.execute("replace into deployments (id, data, created, owner, status, tool_id, allocation_id) "
+                                 "values (%s, %s, %s, %s, %s, %s, %s)",
+                                 (deployment_id, data, time.time(), user_info['sub'], deployment_info.status,
+                                  deployment.tool.id, deployment.allocation.id))
         if not res:
             return return_error("Failed to store deployment information in the database", 503)
     else:
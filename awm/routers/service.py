@@ -13,12 +13,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from fastapi import APIRouter, Response
+import os
+import secrets
+from fastapi import APIRouter, Response, Security
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from awm.models.success import Success
+from awm.utils import metrics
 from awm import __version__
+from . import return_error
 
 
 router = APIRouter()
+# Token required to get the metrics (they are not served if it is not set)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 
 
 # GET /version
@@ -29,3 +36,15 @@ router = APIRouter()
 def version():
     return Response(content=Success(message=__version__).model_dump_json(),
                     media_type="application/json")
+
+
+# GET /metrics
+@router.get("/metrics",
+            summary="Return internal metrics of the service",
+            include_in_schema=False)
+def get_metrics(credentials: HTTPAuthorizationCredentials = Security(HTTPBearer(auto_error=False))):
+    if not METRICS_TOKEN:
+        return return_error("Metrics not enabled", 404)
+    if credentials is None or not secrets.compare_digest(credentials.credentials.encode(), METRICS_TOKEN.encode()):
+        return return_error("Invalid metrics token", 401)
+    return metrics.collect()
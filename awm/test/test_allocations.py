@@ -14,8 +14,10 @@
 # limitations under the License.
 
 import pytest
+import hvac
 import json
 import uuid
+import datetime
 from pydantic import HttpUrl
 from cryptography.fernet import Fernet
 from fastapi.testclient import TestClient
@@ -25,6 +27,7 @@ from awm.utils.node_registry import EOSCNode
 from awm.utils.db import DataBase
 from awm.utils.allocation_store_vault import AllocationStoreVault
 from awm.utils.allocation_store_db import AllocationStoreDB
+from awm.utils.allocation_store_cache import CachingAllocationStore
 import awm
 
 
@@ -41,7 +44,7 @@ def headers():
 
 @pytest.fixture
 def check_oidc_mock():
-    with patch('awm.authorization.check_OIDC') as mock_func:
+    with patch('awm.authorization.async_check_OIDC') as mock_func:
         mock_func.return_value = {
             "sub": "user123",
             "name": "User DN",
@@ -57,6 +60,7 @@ def db_mock(mocker):
     instance = MagicMock()
     instance.connect.return_value = True
     instance.db_type = DataBase.SQLITE
+    mocker.patch("awm.utils.allocation_store_db.migrate")
     db = mocker.patch("awm.utils.allocation_store_db.DataBase", return_value=instance)
     db.MONGO = DataBase.MONGO
     db.SQLITE = DataBase.SQLITE
@@ -90,11 +94,8 @@ def requests_post_mock(mocker):
 
 
 @pytest.fixture
-def list_deployments_mock(mocker):
-    list_dep_mock = mocker.patch("awm.routers.deployments._list_deployments")
-    list_dep_mock.return_value.status_code = 200
-    list_dep_mock.return_value.body = b'{"from": 0, "limit": 100, "count": 0, "self": "", "elements": []}'
-    return list_dep_mock
+def allocation_in_use_mock(mocker):
+    return mocker.patch("awm.routers.deployments._is_allocation_in_use", return_value=False)
 
 
 @pytest.fixture
@@ -156,17 +157,23 @@ def seed_allocations(backend_type, db_mock, vault_mock):
             if backend_type == "mongo":
                 db_mock.db_type = DataBase.MONGO
             selects = []
+            pages = []
             for allocations_elem in allocations_list:
                 allocations, total = allocations_elem
                 if backend_type == "mongo":
                     rows = allocations
+                    pages.append((rows, total))
                 else:
-                    rows = [[a["id"], json.dumps(a["data"])] for a in allocations]
+                    rows = [[a["id"], json.dumps(a["data"]), a.get("created", 1)] for a in allocations]
+                    if total is not None:
+                        # the total is returned as the last column of the list query
+                        rows = [row + [total] for row in rows]
                 selects.append(rows)
-                if total is not None:
+                if total is not None and not rows:
                     selects.append([[total]])
             if backend_type == "mongo":
                 db_mock.find.side_effect = selects
+                db_mock.find_page.side_effect = pages
             else:
                 db_mock.select.side_effect = selects
         elif backend_type in ["vault", "enc_vault"]:
@@ -188,7 +195,8 @@ def seed_allocations(backend_type, db_mock, vault_mock):
                 if total and len(elems) < total:
                     elems[str(uuid.uuid4())] = allocations[0]["data"]
                 res.append({"data": elems})
-            vault_mock.secrets.kv.v1.read_secret.side_effect = res
+            # Vault returns a 404 if the user has no allocations
+            vault_mock.secrets.kv.v1.read_secret.side_effect = res or hvac.exceptions.InvalidPath()
 
     return _seed
 
@@ -213,19 +221,45 @@ def test_list_allocations(
                                'limit': 100}
 
 
+@pytest.mark.parametrize("backend_type", ["vault"], indirect=True)
+def test_list_allocations_cursor(check_oidc_mock, requests_post_mock, client, headers, seed_allocations):
+    alloc = ALLOC_1[0][0]
+    seed_allocations([([alloc, dict(alloc, id="id2"), dict(alloc, id="id3")], 3)] * 2)
+
+    response = client.get("/allocations?limit=2", headers=headers)
+    assert response.status_code == 200
+    assert [elem["id"] for elem in response.json()["elements"]] == ["id1", "id2"]
+    next_page = response.json()["nextPage"]
+    assert "cursor=" in next_page
+
+    response = client.get(next_page, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["count"] == 3
+    assert [elem["id"] for elem in response.json()["elements"]] == ["id3"]
+    assert "nextPage" not in response.json()
+
+    response = client.get("/allocations?cursor=invalid", headers=headers)
+    assert response.status_code == 400
+
+
 @pytest.mark.parametrize("backend_type", ["db"], indirect=True)
 def test_list_allocations_sql(check_oidc_mock, client, db_mock, headers, seed_allocations):
     seed_allocations([ALLOC_1])
     client.get('/allocations/', headers=headers)
 
-    db_mock.select.assert_any_call(
-        "SELECT id, data FROM allocations WHERE owner = %s order by created LIMIT %s OFFSET %s",
-        ("user123", 100, 0)
+    db_mock.select.assert_called_once_with(
+        "SELECT id, data, created, (SELECT count(id) FROM allocations WHERE owner = %s) FROM allocations "
+        "WHERE owner = %s order by created, id LIMIT %s OFFSET %s",
+        ("user123", "user123", 101, 0)
     )
 
-    db_mock.select.assert_any_call(
-        "SELECT count(id) from allocations WHERE owner = %s",
-        ("user123",)
+    seed_allocations([ALLOC_1])
+    response = client.get('/allocations/?withCount=false', headers=headers)
+    assert response.status_code == 200
+    assert "count" not in response.json()
+    db_mock.select.assert_called_with(
+        "SELECT id, data, created FROM allocations WHERE owner = %s order by created, id LIMIT %s OFFSET %s",
+        ("user123", 101, 0)
     )
 
 
@@ -234,14 +268,34 @@ def test_list_allocations_mongo(check_oidc_mock, client, db_mock, headers, seed_
     seed_allocations([ALLOC_1])
     client.get('/allocations/', headers=headers)
 
-    db_mock.find.assert_called_with(
+    db_mock.find_page.assert_called_with(
         "allocations",
-        filt={"owner": "user123"},
-        projection={"data": True, "id": True},
-        sort=[("created", -1)]
+        {"owner": "user123"},
+        projection={"data": True, "id": True, "created": True},
+        sort=[("created", -1), ("id", -1)],
+        skip=0,
+        limit=101,
+        seek=None,
+        with_total=True
     )
 
 
+@pytest.mark.parametrize("backend_type", ["mongo"], indirect=True)
+def test_list_allocations_mongo_cursor(check_oidc_mock, client, db_mock, headers, seed_allocations):
+    # Allocations stored without created by previous versions
+    alloc = ALLOC_3[0][0]
+    seed_allocations([([dict(alloc, id="id2"), alloc], 2), ([alloc], 2)])
+
+    response = client.get('/allocations?limit=1', headers=headers)
+    assert response.status_code == 200
+    next_page = response.json()["nextPage"]
+
+    response = client.get(next_page, headers=headers)
+    assert response.status_code == 200
+    assert db_mock.find_page.call_args[1]["seek"] == {"$or": [{"created": {"$lt": 0.0}},
+                                                              {"created": {"$in": [0.0, None]}, "id": {"$lt": "id2"}}]}
+
+
 @pytest.mark.parametrize("backend_type", ["db"], indirect=True)
 def test_list_allocations_remote(
     client, check_oidc_mock, db_mock, list_nodes_mock, requests_get_mock, seed_allocations
@@ -316,7 +370,7 @@ def test_get_allocation(check_oidc_mock, db_mock, client, headers, requests_post
 
 
 @pytest.mark.parametrize("backend_type", ["db", "mongo", "vault"], indirect=True)
-def test_delete_allocation(check_oidc_mock, list_deployments_mock, client, headers,
+def test_delete_allocation(check_oidc_mock, allocation_in_use_mock, client, headers,
                            requests_post_mock, seed_allocations):
     seed_allocations([ALLOC_1, ALLOC_1])
 
@@ -324,34 +378,17 @@ def test_delete_allocation(check_oidc_mock, list_deployments_mock, client, heade
     assert response.status_code == 200
     assert response.json() == {"message": "Deleted"}
 
-    list_deployments_mock.return_value.status_code = 200
-    list_deployments_mock.return_value.body = json.dumps({
-        "from": 0, "limit": 100, "count": 0, "self": "",
-        "elements": [{
-            "deployment": {
-                "allocation": {
-                    "kind": "AllocationId",
-                    "id": "id1",
-                    "infoLink": "http://some.url/"
-                },
-                "tool": {
-                    "kind": "ToolId",
-                    "id": "toolid",
-                    "version": "latest",
-                    "infoLink": "http://some.url/"
-                },
-            },
-            "id": "dep_id",
-            "status": "pending",
-        }
-        ]}).encode()
+    # seed it again, as the store remembers the deletion
+    seed_allocations([ALLOC_1])
+    allocation_in_use_mock.return_value = True
     response = client.delete('/allocation/id1', headers=headers)
     assert response.status_code == 409
     assert response.json() == {'description': 'Allocation in use', 'id': '409'}
+    assert allocation_in_use_mock.call_args[0][0] == "id1"
 
 
 @pytest.mark.parametrize("backend_type", ["db"], indirect=True)
-def test_delete_allocation_sql(check_oidc_mock, list_deployments_mock, client, headers, db_mock, seed_allocations):
+def test_delete_allocation_sql(check_oidc_mock, allocation_in_use_mock, client, headers, db_mock, seed_allocations):
     seed_allocations([ALLOC_1, ALLOC_1])
 
     client.delete('/allocation/id1', headers=headers)
@@ -413,7 +450,7 @@ def test_create_allocation_enc_vault(check_oidc_mock, time_mock, uuid_mock, vaul
 
 
 @pytest.mark.parametrize("backend_type", ["db", "mongo", "vault"], indirect=True)
-def test_update_allocation(check_oidc_mock, list_deployments_mock, db_mock, client, headers,
+def test_update_allocation(check_oidc_mock, allocation_in_use_mock, db_mock, client, headers,
                            requests_post_mock, seed_allocations, allocation_payload):
     seed_allocations([ALLOC_3, ALLOC_3, ALLOC_3])
 
@@ -423,7 +460,7 @@ def test_update_allocation(check_oidc_mock, list_deployments_mock, db_mock, clie
 
 
 @pytest.mark.parametrize("backend_type", ["db"], indirect=True)
-def test_update_allocation_sql(check_oidc_mock, list_deployments_mock, db_mock, client, headers,
+def test_update_allocation_sql(check_oidc_mock, allocation_in_use_mock, db_mock, client, headers,
                                seed_allocations, allocation_payload):
     seed_allocations([ALLOC_3, ALLOC_3])
 
@@ -433,3 +470,259 @@ def test_update_allocation_sql(check_oidc_mock, list_deployments_mock, db_mock,
         "update allocations set data = %s where id = %s",
         ('{"kind": "KubernetesEnvironment", "host": "http://k8s.io/"}', 'id1')
     )
+
+
+@pytest.mark.parametrize("backend_type", ["mongo"], indirect=True)
+def test_update_allocation_mongo(check_oidc_mock, allocation_in_use_mock, db_mock, client, headers,
+                                 seed_allocations, allocation_payload):
+    seed_allocations([ALLOC_3, ALLOC_3])
+
+    client.put('/allocation/id1', headers=headers, json=allocation_payload)
+
+    # The created time of the allocation is kept
+    db_mock.update.assert_called_with(
+        "allocations", {"id": "id1"},
+        {"$set": {"data": {"kind": "KubernetesEnvironment", "host": "http://k8s.io/"}, "owner": "user123"}},
+        upsert=False
+    )
+
+
+def test_vault_token_cache(mocker, vault_mock, requests_post_mock):
+    now = mocker.patch("time.time", return_value=1000)
+    requests_post_mock.return_value.json.return_value = {"auth": {"client_token": "ctoken", "entity_id": "eid",
+                                                                  "lease_duration": 600}}
+    vault_mock.secrets.kv.v1.read_secret.return_value = {"data": {"id1": json.dumps({"kind": "EGI"})}}
+    store = AllocationStoreVault(AllocationStoreVault.DEFAULT_URL)
+    user_info = {"sub": "user123", "token": "token"}
+
+    store.get_allocation("id1", user_info)
+    store.list_allocations(user_info, 0, 10)
+    store.delete_allocation("id2", user_info)
+    assert requests_post_mock.call_count == 1
+    assert vault_mock.is_authenticated.call_count == 1
+
+    # A new OIDC token requires a new login
+    store.get_allocation("id1", {"sub": "user123", "token": "token2"})
+    assert requests_post_mock.call_count == 2
+
+    # Login again before the lease expires
+    now.return_value = 1000 + 600 - AllocationStoreVault.TOKEN_REFRESH
+    store.get_allocation("id1", user_info)
+    assert requests_post_mock.call_count == 3
+
+
+def test_vault_token_rejected(vault_mock, requests_post_mock):
+    requests_post_mock.return_value.json.return_value = {"auth": {"client_token": "ctoken", "entity_id": "eid",
+                                                                  "lease_duration": 600}}
+    kv = vault_mock.secrets.kv.v1
+    kv.read_secret.return_value = {"data": {"id1": json.dumps({"kind": "EGI"})}}
+    store = AllocationStoreVault(AllocationStoreVault.DEFAULT_URL)
+    user_info = {"sub": "user123", "token": "token"}
+    assert store.get_allocation("id1", user_info) == {"kind": "EGI"}
+
+    # The token is revoked: the cached client is dropped (closing its session) and it logs in again once
+    store._allocations.clear()
+    kv.read_secret.side_effect = [hvac.exceptions.Forbidden(), kv.read_secret.return_value]
+    assert store.get_allocation("id1", user_info) == {"kind": "EGI"}
+    assert requests_post_mock.call_count == 2
+    kv._adapter.close.assert_called_once()
+
+    kv.read_secret.side_effect = hvac.exceptions.Forbidden()
+    store._allocations.clear()
+    with pytest.raises(hvac.exceptions.Forbidden):
+        store.get_allocation("id1", user_info)
+    assert requests_post_mock.call_count == 3
+
+
+def test_vault_allocations_cache(mocker, vault_mock, requests_post_mock):
+    user_info = {"sub": "user123", "token": "token"}
+    kv = vault_mock.secrets.kv.v2
+    secret = {"data": {"id1": json.dumps({"kind": "EGI"})}, "metadata": {"version": 1}}
+    kv.read_secret_version.return_value = {"data": secret}
+    kv.read_secret_metadata.return_value = {"data": {"current_version": 1}}
+    kv.create_or_update_secret.return_value = {"data": {"version": 2}}
+    store = AllocationStoreVault("https://vault.com", path="users/{sub}", kv_ver=2)
+
+    assert store.get_allocation("id1", user_info) == {"kind": "EGI"}
+    # Not modified: only the metadata is read
+    assert store.get_allocation("id1", user_info) == {"kind": "EGI"}
+    assert kv.read_secret_version.call_count == 1
+    assert kv.read_secret_metadata.call_count == 1
+
+    # Our own writes update the cache
+    store.replace_allocation({"kind": "K8s"}, user_info, "id2")
+    kv.read_secret_metadata.return_value = {"data": {"current_version": 2}}
+    assert store.list_allocations(user_info, 0, 10)[1] == [{"id": "id1", "data": {"kind": "EGI"}},
+                                                           {"id": "id2", "data": {"kind": "K8s"}}]
+    assert kv.read_secret_version.call_count == 1
+
+    # Modified by another process
+    kv.read_secret_metadata.return_value = {"data": {"current_version": 3}}
+    assert store.get_allocation("id2", user_info) is None
+    assert kv.read_secret_version.call_count == 2
+
+
+def test_vault_check_and_set(mocker, vault_mock, requests_post_mock):
+    sleep = mocker.patch("time.sleep")
+    user_info = {"sub": "user123", "token": "token"}
+    kv = vault_mock.secrets.kv.v2
+    # another process adds id2 between our read and write
+    kv.read_secret_version.side_effect = [
+        {"data": {"data": {"id1": "{}"}, "metadata": {"version": 1}}},
+        {"data": {"data": {"id1": "{}", "id2": "{}"}, "metadata": {"version": 2}}},
+    ]
+    conflict = hvac.exceptions.InvalidRequest("check-and-set parameter did not match the current version")
+    kv.create_or_update_secret.side_effect = [conflict, {"data": {"version": 3}}]
+    store = AllocationStoreVault("https://vault.com", path="users/{sub}", kv_ver=2)
+
+    store.delete_allocation("id1", user_info)
+    assert sleep.call_count == 1
+    assert kv.create_or_update_secret.call_args_list[0][1]["cas"] == 1
+    assert kv.create_or_update_secret.call_args_list[1][0][1] == {"id2": "{}"}
+    assert kv.create_or_update_secret.call_args_list[1][1]["cas"] == 2
+
+    # bounded retries
+    kv.read_secret_version.side_effect = None
+    kv.read_secret_version.return_value = {"data": {"data": {"id2": "{}"}, "metadata": {"version": 3}}}
+    kv.create_or_update_secret.side_effect = conflict
+    with pytest.raises(hvac.exceptions.InvalidRequest):
+        store.replace_allocation({"kind": "EGI"}, user_info, "id3")
+    assert kv.create_or_update_secret.call_count == 2 + AllocationStoreVault.CAS_RETRIES + 1
+
+
+class FakeKV():
+    """KV v1 secrets engine storing the secrets in a dict"""
+
+    def __init__(self):
+        self.secrets = {}
+
+    def read_secret(self, path, mount_point):
+        if path not in self.secrets:
+            raise hvac.exceptions.InvalidPath()
+        return {"data": dict(self.secrets[path])}
+
+    def create_or_update_secret(self, path, secret, mount_point):
+        self.secrets[path] = dict(secret)
+        return MagicMock()
+
+    def delete_secret(self, path, mount_point):
+        del self.secrets[path]
+        return MagicMock()
+
+    def list_secrets(self, path, mount_point):
+        prefix = path.rstrip("/") + "/" if path else ""
+        keys = {p[len(prefix):].split("/")[0] + ("/" if "/" in p[len(prefix):] else "")
+                for p in self.secrets if p.startswith(prefix)}
+        if not keys:
+            raise hvac.exceptions.InvalidPath()
+        return {"data": {"keys": sorted(keys)}}
+
+
+def test_vault_update_stale_cache(vault_mock, requests_post_mock):
+    kv = FakeKV()
+    vault_mock.secrets.kv.v1 = kv
+    user_info = {"sub": "user123", "token": "token"}
+    store = AllocationStoreVault("https://vault.com", path="users/{sub}")
+    other = AllocationStoreVault("https://vault.com", path="users/{sub}")
+
+    store.replace_allocation({"kind": "K1"}, user_info, "id1")
+    assert store.get_allocation("id1", user_info) == {"kind": "K1"}
+    # another process adds an allocation while ours is cached
+    other.replace_allocation({"kind": "K2"}, user_info, "id2")
+    store.replace_allocation({"kind": "K3"}, user_info, "id3")
+    assert sorted(kv.secrets["users/user123"]) == ["id1", "id2", "id3"]
+
+
+def test_vault_per_allocation_layout(vault_mock, requests_post_mock):
+    kv = FakeKV()
+    vault_mock.secrets.kv.v1 = kv
+    user_info = {"sub": "user123", "token": "token"}
+    store = AllocationStoreVault("https://vault.com", path="users/{sub}", key=AllocationStoreVault.DEFAULT_KEY,
+                                 layout=AllocationStoreVault.LAYOUT_PER_ALLOCATION)
+
+    for i in range(3):
+        store.replace_allocation({"kind": f"K{i}"}, user_info, f"id{i}")
+    assert sorted(kv.secrets) == ["users/user123/id0", "users/user123/id1", "users/user123/id2"]
+    store.replace_allocation({"host": "h"}, user_info, "id1")
+    assert store.get_allocation("id1", user_info) == {"kind": "K1", "host": "h"}
+
+    count, data, cursor = store.list_allocations(user_info, 0, 2)
+    assert count == 3
+    assert [elem["id"] for elem in data] == ["id0", "id1"]
+    assert store.list_allocations(user_info, 0, 2, cursor)[1] == [{"id": "id2", "data": {"kind": "K2"}}]
+
+    store.delete_allocation("id0", user_info)
+    assert "users/user123/id0" not in kv.secrets
+    assert store.get_allocation("id0", user_info) is None
+    assert store.list_allocations(user_info, 0, 10)[0] == 2
+
+
+def test_vault_migrate_layout(mocker, vault_mock):
+    kv = FakeKV()
+    vault_mock.secrets.kv.v1 = kv
+    single = AllocationStoreVault("https://vault.com", path="users/{sub}/allocations",
+                                  key=AllocationStoreVault.DEFAULT_KEY)
+    kv.secrets["users/user1/allocations"] = {"id1": single._encrypt('{"kind": "K1"}'),
+                                             "id2": single._encrypt('{"kind": "K2"}')}
+    kv.secrets["users/user2/allocations"] = {"id3": single._encrypt('{"kind": "K3"}')}
+
+    assert awm.utils.allocation_store_vault.main(["--url", "https://vault.com", "--token", "admin",
+                                                  "--path", "users/{sub}/allocations"]) == 0
+    assert sorted(kv.secrets) == ["users/user1/allocations/id1", "users/user1/allocations/id2",
+                                  "users/user2/allocations/id3"]
+    # It can be repeated
+    assert awm.utils.allocation_store_vault.main(["--url", "https://vault.com", "--token", "admin",
+                                                  "--path", "users/{sub}/allocations"]) == 0
+
+    store = AllocationStoreVault("https://vault.com", path="users/{sub}/allocations",
+                                 key=AllocationStoreVault.DEFAULT_KEY,
+                                 layout=AllocationStoreVault.LAYOUT_PER_ALLOCATION)
+    mocker.patch.object(store, "_login", return_value=(kv, "users/user1/allocations"))
+    assert store.list_allocations({"sub": "user1"}, 0, 10)[1] == [{"id": "id1", "data": {"kind": "K1"}},
+                                                                  {"id": "id2", "data": {"kind": "K2"}}]
+
+
+def test_caching_allocation_store():
+    backend = MagicMock()
+    backend.get_allocation.return_value = {"kind": "EGI"}
+    backend.list_allocations.return_value = (1, [{"id": "id1", "data": {"kind": "EGI"}}], None)
+    store = CachingAllocationStore(backend, maxsize=10, ttl=60, maxbytes=1000)
+    user_info = {"sub": "user123", "token": "token"}
+
+    assert store.get_allocation("id1", user_info) == {"kind": "EGI"}
+    res = store.get_allocation("id1", user_info)
+    assert res == {"kind": "EGI"}
+    # cached values are not modified by the callers
+    res["kind"] = "other"
+    assert store.get_allocation("id1", user_info) == {"kind": "EGI"}
+    assert store.list_allocations(user_info, 0, 10) == store.list_allocations(user_info, 0, 10)
+    assert backend.get_allocation.call_count == 1
+    assert backend.list_allocations.call_count == 1
+    # other users are not affected
+    store.get_allocation("id1", {"sub": "user456"})
+    assert backend.get_allocation.call_count == 2
+
+    # writes invalidate the user results
+    store.replace_allocation({"kind": "EGI"}, user_info, "id1")
+    store.get_allocation("id1", user_info)
+    assert backend.get_allocation.call_count == 3
+    store.delete_allocation("id1", user_info)
+    store.list_allocations(user_info, 0, 10)
+    assert backend.list_allocations.call_count == 2
+
+    stats = store.stats()
+    assert stats["get"] == {"hits": 2, "misses": 3, "hit_ratio": 0.4}
+    assert stats["list"]["hits"] == 1
+    assert 0 < stats["bytes"] <= 1000
+
+    # results bigger than the size bound are not cached
+    backend.get_allocation.return_value = {"kind": "x" * 1000}
+    store.get_allocation("id2", user_info)
+    store.get_allocation("id2", user_info)
+    assert backend.get_allocation.call_count == 5
+
+    # values that are not JSON serializable can be cached too
+    backend.list_allocations.return_value = (1, [{"id": "id1", "created": datetime.datetime(2024, 1, 1)}], None)
+    store.list_allocations(user_info, 0, 20)
+    assert store.list_allocations(user_info, 0, 20)[1][0]["created"] == datetime.datetime(2024, 1, 1)
+    assert backend.list_allocations.call_count == 3
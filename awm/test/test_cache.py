@@ -0,0 +1,86 @@
+#
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from awm.utils.cache import TTLCache
+
+
+@pytest.fixture
+def time_mock(mocker):
+    return mocker.patch("awm.utils.cache.time.time", return_value=1000)
+
+
+def test_ttl_cache_expiration(time_mock):
+    cache = TTLCache(maxsize=10, ttl=100)
+    cache.set("key1", "value1", 1050)
+    cache.set("key2", "value2", 5000)
+    assert cache.get("key1") == "value1"
+    assert cache.get("key2") == "value2"
+
+    time_mock.return_value = 1060
+    assert cache.get("key1") is None
+    assert cache.get("key2") == "value2"
+
+    # TTL limits the expiration time
+    time_mock.return_value = 1100
+    assert cache.get("key2") is None
+
+    # Already expired values are not stored
+    assert not cache.set("key3", "value3", 1000)
+    assert cache.stats() == {"size": 0, "maxsize": 10, "hits": 3, "misses": 2, "evictions": 0}
+
+
+def test_ttl_cache_lru(time_mock):
+    cache = TTLCache(maxsize=2, ttl=100)
+    cache.set("key1", "value1")
+    cache.set("key2", "value2")
+    assert cache.get("key1") == "value1"
+    cache.set("key3", "value3")
+    assert cache.get("key2") is None
+    assert cache.get("key1") == "value1"
+    assert cache.get("key3") == "value3"
+    assert cache.stats()["evictions"] == 1
+    assert cache.delete("key1")
+    assert len(cache) == 1
+
+
+def test_ttl_cache_maxbytes(time_mock):
+    cache = TTLCache(maxsize=10, ttl=100, maxbytes=100)
+    cache.set("key1", "value1", size=40)
+    cache.set("key2", "value2", size=40)
+    cache.set("key1", "value1", size=50)
+    assert cache.stats()["bytes"] == 90
+    cache.set("key3", "value3", size=30)
+    # the least recently used is evicted
+    assert cache.get("key2") is None
+    assert cache.stats()["bytes"] == 80
+    # values bigger than the limit are not stored
+    assert not cache.set("key1", "value1", size=101)
+    assert cache.get("key1") is None
+    assert cache.stats()["bytes"] == 30
+
+
+def test_ttl_cache_on_remove(time_mock):
+    removed = []
+    cache = TTLCache(maxsize=2, ttl=100, on_remove=removed.append)
+    cache.set("key1", "value1", 1050)
+    cache.set("key2", "value2")
+    cache.set("key2", "value2b")
+    cache.set("key3", "value3")
+    assert removed == ["value2", "value1"]
+    time_mock.return_value = 1200
+    assert cache.get("key3") is None
+    cache.delete("key2")
+    assert removed == ["value2", "value1", "value3", "value2b"]
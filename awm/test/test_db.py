@@ -0,0 +1,457 @@
+#
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pytest
+import sqlite3
+import time
+import timeit
+from unittest.mock import MagicMock
+from awm.utils.db import DataBase, ConnectionPool, sql_fingerprint, mongo_fingerprint
+from awm.utils import migrations, sharding
+from awm.utils.pagination import sql_list_query
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    yield f"file://{tmp_path}/awm.db"
+    DataBase.close_all()
+
+
+def test_db_pool_reuse(db_url):
+    db = DataBase(db_url)
+    assert db.connect()
+    db.execute("CREATE TABLE test (id TEXT PRIMARY KEY, data TEXT)")
+    db.execute("INSERT INTO test (id, data) VALUES (%s, %s)", ("id1", "data1"))
+    conn = db.connection
+    db.close()
+    assert db.connection is None
+
+    db2 = DataBase(db_url)
+    assert db2.connect()
+    assert db2.connection is conn
+    assert db2.select("SELECT data FROM test WHERE id = %s", ("id1",)) == [("data1",)]
+    # A concurrent user gets other connection
+    db3 = DataBase(db_url)
+    assert db3.connect()
+    assert db3.connection is not conn
+    db3.close()
+    db2.close()
+
+
+def test_db_pool_release_on_error(db_url, mocker):
+    mocker.patch.object(DataBase, "POOL_MAX_SIZE", 2)
+    mocker.patch.object(DataBase, "POOL_WAIT_TIMEOUT", 0.1)
+    for _ in range(3):
+        db = DataBase(db_url)
+        assert db.connect()
+        with pytest.raises(sqlite3.OperationalError):
+            with db:
+                db.select("SELECT data FROM missing_table")
+        assert db.connection is None
+    # the failed operations do not reduce the pool capacity
+    dbs = [DataBase(db_url) for _ in range(2)]
+    assert all(db.connect() for db in dbs)
+    for db in dbs:
+        db.close()
+
+
+def test_connection_pool():
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    check = MagicMock()
+    pool = ConnectionPool(connect, check, min_size=1, max_size=2, idle_timeout=0, check_interval=0,
+                          wait_timeout=0.1)
+    assert connect.call_count == 1
+
+    conn1 = pool.acquire()
+    conn2 = pool.acquire()
+    assert connect.call_count == 2
+    with pytest.raises(Exception, match="Timeout waiting for a free DB connection"):
+        pool.acquire()
+
+    pool.release(conn1)
+    pool.release(conn2)
+    # Idle connections over min_size are closed
+    assert pool.acquire() is conn2
+    conn1.close.assert_called_once()
+
+    # Broken connections are discarded
+    pool.release(conn2)
+    check.side_effect = Exception("broken")
+    conn3 = pool.acquire()
+    assert conn3 is not conn2
+    conn2.close.assert_called_once()
+
+
+def test_migrations(db_url, mocker):
+    # Simulate a DB created before the migrations registry
+    db = DataBase(db_url)
+    assert db.connect()
+    db.execute("CREATE TABLE deployments (id TEXT PRIMARY KEY, data TEXT, owner VARCHAR(255), created TIMESTAMP)")
+    data = ('{"id": "id1", "status": "running", "deployment": {"tool": {"kind": "ToolId", "id": "tool1"}, '
+            '"allocation": {"kind": "AllocationId", "id": "alloc1"}}}')
+    db.execute("INSERT INTO deployments (id, data, owner, created) VALUES ('id1', %s, 'user', 1)", (data,))
+
+    assert migrations.migrate(db)
+    assert db.table_exists("allocations")
+    version = db.select("SELECT max(version) FROM schema_version")[0][0]
+    assert version == migrations.MIGRATIONS[-1][0]
+    assert db.select("SELECT count(id) FROM deployments") == [(1,)]
+    # The deployment columns are filled from the data
+    assert db.select("SELECT status, tool_id, allocation_id FROM deployments") == [("running", "tool1", "alloc1")]
+
+    # Migrations are only checked once per process
+    select = mocker.spy(db, "select")
+    assert migrations.migrate(db)
+    select.assert_not_called()
+
+    # The migration 4 can be applied again (e.g. by other process) filling only the missing columns
+    db.execute("INSERT INTO deployments (id, data, owner, created) VALUES ('id2', %s, 'user', 2)",
+               (data.replace("id1", "id2"),))
+    db.execute("DELETE FROM schema_version WHERE version = 4")
+    migrations._applied.discard(db.db_url)
+    assert migrations.migrate(db)
+    assert db.select("SELECT status, tool_id FROM deployments WHERE id = 'id2'") == [("running", "tool1")]
+    db.close()
+
+
+def test_sqlite_profile(db_url):
+    db = DataBase(db_url)
+    assert db.connect()
+    assert db.select("PRAGMA journal_mode") == [("wal",)]
+    assert db.select("PRAGMA synchronous") == [(1,)]
+    assert db.select("PRAGMA busy_timeout") == [(5000,)]
+    db.close()
+
+
+def test_db_lock_retry(db_url, mocker):
+    sleep = mocker.patch("awm.utils.db.time.sleep")
+    db = DataBase(db_url)
+    assert db.connect()
+    db.execute("CREATE TABLE test (id TEXT PRIMARY KEY, data TEXT)")
+    conn = db.connection
+    db.connection = MagicMock(wraps=conn)
+    cursor = MagicMock()
+    cursor.execute.side_effect = [sqlite3.OperationalError("database is locked")] * 2 + [None]
+    cursor.fetchall.return_value = [("data1",)]
+    db.connection.cursor.return_value = cursor
+    stats = DataBase.stats()
+
+    assert db.select("SELECT data FROM test") == [("data1",)]
+    assert sleep.call_count == 2
+    # Exponential backoff with jitter
+    assert sleep.call_args_list[0][0][0] <= DataBase.RETRY_SLEEP
+    assert sleep.call_args_list[1][0][0] <= DataBase.RETRY_SLEEP * 2
+    assert DataBase.stats()["lock_retries"] == stats["lock_retries"] + 2
+    # The connection is kept
+    assert db.connection.rollback.call_count == 2
+
+    # The retries are bounded and the error is raised
+    cursor.execute.side_effect = sqlite3.OperationalError("database is locked")
+    sleep.reset_mock()
+    with pytest.raises(sqlite3.OperationalError, match="database is locked"):
+        db.select("SELECT data FROM test")
+    assert sleep.call_count == DataBase.MAX_RETRIES
+    # and the total time waiting for the lock
+    mocker.patch.object(DataBase, "RETRY_TIMEOUT", 0)
+    sleep.reset_mock()
+    with pytest.raises(sqlite3.OperationalError, match="database is locked"):
+        db.select("SELECT data FROM test")
+    sleep.assert_not_called()
+    db.connection = conn
+    db.close()
+
+
+def test_query_fingerprints():
+    assert sql_fingerprint("SELECT id FROM t WHERE owner = %s and  id in (%s, %s, %s)\n LIMIT 10") == \
+        "SELECT id FROM t WHERE owner = ? and id in (...) LIMIT ?"
+    assert sql_fingerprint("SELECT id FROM t WHERE owner = 'user''s'") == "SELECT id FROM t WHERE owner = ?"
+    assert mongo_fingerprint("find", "t", {"owner": "user", "id": {"$in": ["a", "b"]}}) == \
+        'find t {"id": {"$in": "?"}, "owner": "?"}'
+    assert mongo_fingerprint("find", "t", {"$or": [{"id": "a"}, {"id": "b"}]}) == \
+        'find t {"$or": [{"id": "?"}, {"id": "?"}]}'
+
+
+def test_query_stats(db_url, mocker, caplog):
+    mocker.patch.object(DataBase, "SLOW_QUERY_TIME", 0)
+    db = DataBase(db_url)
+    assert db.connect()
+    db.execute("CREATE TABLE test_stats (id TEXT PRIMARY KEY, data TEXT)")
+    db.execute_many("insert into test_stats (id, data) values (%s, %s)", [("1", "a"), ("2", "b")])
+    db.select("SELECT data FROM test_stats WHERE id = %s", ("1",))
+    db.select("SELECT data FROM test_stats WHERE id = %s", ("2",))
+    with pytest.raises(Exception):
+        db.select("SELECT data FROM unknown_table")
+
+    stats = DataBase.query_stats()[DataBase.SQLITE]
+    select = stats["SELECT data FROM test_stats WHERE id = ?"]
+    assert select["calls"] == 2
+    assert select["rows"] == 2
+    assert select["errors"] == 0
+    assert select["latency"]["count"] == 2
+    assert select["latency"]["buckets"]["+Inf"] == 2
+    assert stats["insert into test_stats (id, data) values (...)"]["rows"] == 2
+    assert stats["SELECT data FROM unknown_table"]["errors"] == 1
+
+    # Slow operations are logged
+    mocker.patch.object(DataBase, "SLOW_QUERY_TIME", 0.000001)
+    db.select("SELECT data FROM test_stats")
+    assert "Slow SQLite operation" in caplog.text
+    assert "SELECT data FROM test_stats" in caplog.text
+    assert DataBase.query_stats()[DataBase.SQLITE]["SELECT data FROM test_stats"]["slow"] == 1
+    db.close()
+
+
+def test_read_replica(tmp_path, mocker):
+    primary_url = f"file://{tmp_path}/primary.db"
+    replica_url = f"file://{tmp_path}/replica.db"
+    for url in [primary_url, replica_url]:
+        db = DataBase(url)
+        assert db.connect()
+        db.execute("CREATE TABLE test (id TEXT PRIMARY KEY, data TEXT)")
+        db.execute("INSERT INTO test (id, data) VALUES ('id1', %s)", (url,))
+        db.close()
+
+    now = time.time()
+    mocker.patch("awm.utils.cache.time.time", return_value=now)
+    DataBase._recent_writes.clear()
+    try:
+        # Reads go to the replica
+        db = DataBase(primary_url, replica_url, owner="user1")
+        assert db.connect()
+        assert db.select("SELECT data FROM test") == [(replica_url,)]
+        # After a write, the owner reads from the primary
+        db.execute("UPDATE test SET data = 'new'")
+        assert db.select("SELECT data FROM test") == [("new",)]
+        db.close()
+        db = DataBase(primary_url, [replica_url], owner="user1")
+        assert db.connect()
+        assert db.select("SELECT data FROM test") == [("new",)]
+        db.close()
+        # but other owners still use the replica
+        db = DataBase(primary_url, replica_url, owner="user2")
+        assert db.connect()
+        assert db.select("SELECT data FROM test") == [(replica_url,)]
+        db.close()
+        # until the read your writes window finishes
+        mocker.patch("awm.utils.cache.time.time", return_value=now + DataBase.READ_YOUR_WRITES + 1)
+        db = DataBase(primary_url, replica_url, owner="user1")
+        assert db.connect()
+        assert db.select("SELECT data FROM test") == [(replica_url,)]
+        db.close()
+        # If the replica is not available, the primary is used
+        db = DataBase(primary_url, "unknown://replica", owner="user1")
+        assert db.connect()
+        assert db.select("SELECT data FROM test") == [("new",)]
+        db.close()
+    finally:
+        DataBase._recent_writes.clear()
+
+
+def test_split_urls():
+    mongo_url = "mongodb://u:p@h1:27017,h2:27017/awm?replicaSet=rs0"
+    assert DataBase.split_urls(mongo_url) == [mongo_url]
+    assert DataBase.split_urls(f" {mongo_url}\n  mysql://u:p@h3/awm ") == [mongo_url, "mysql://u:p@h3/awm"]
+    assert DataBase.split_urls(None) == []
+    # a single URL is not split
+    db = DataBase(mongo_url, mongo_url)
+    assert db.db_url == mongo_url
+    assert db.read_urls == [mongo_url]
+
+
+def test_sharding(tmp_path, capsys):
+    urls = [f"file://{tmp_path}/shard{i}.db" for i in range(3)]
+    assert migrations.migrate_url(urls[:2])
+
+    with pytest.raises(Exception, match="owner is required"):
+        DataBase(urls[:2])
+    owners = [f"user{i}" for i in range(20)]
+    for owner in owners:
+        db = DataBase(urls[:2], urls[2], owner=owner)
+        # the read replicas are not used with shards
+        assert db.read_urls == []
+        assert db.db_url == DataBase.get_shard(urls[:2], owner)
+        assert db.connect()
+        db.execute("replace into deployments (id, data, created, owner, status) values (%s, %s, %s, %s, %s)",
+                   (f"dep-{owner}", "{}", time.time(), owner, "running"))
+        db.execute("replace into allocations (id, data, created, owner) values (%s, %s, %s, %s)",
+                   (f"alloc-{owner}", "{}", time.time(), owner))
+        db.close()
+    # both shards are used
+    assert len({DataBase.get_shard(urls[:2], owner) for owner in owners}) == 2
+
+    # adding a shard only moves owners to the new one
+    moves = sharding.plan(urls[:2], urls)
+    assert moves
+    assert all(target == urls[2] for _, _, target in moves)
+    assert sharding.main(["plan", "--source", *urls[:2], "--target", *urls]) == 0
+    assert capsys.readouterr().out.count(f" -> {urls[2]}") == len(moves)
+
+    assert sharding.move(urls[:2], urls) == moves
+    assert sharding.plan(urls, urls) == []
+    for owner in owners:
+        db = DataBase(urls, owner=owner)
+        assert db.connect()
+        assert db.select("SELECT id, status FROM deployments WHERE owner = %s", (owner,)) == [(f"dep-{owner}",
+                                                                                               "running")]
+        assert db.select("SELECT id FROM allocations WHERE owner = %s", (owner,)) == [(f"alloc-{owner}",)]
+        db.close()
+    for url in urls:
+        db = DataBase(url)
+        assert db.connect()
+        assert db.select("SELECT count(id) FROM deployments")[0][0] == len(sharding.get_owners(db))
+        db.close()
+    DataBase.close_all()
+
+
+def test_bulk_operations(db_url):
+    db = DataBase(db_url)
+    assert db.connect()
+    db.execute("CREATE TABLE test (id TEXT PRIMARY KEY, data TEXT)")
+
+    assert db.execute_many("INSERT INTO test (id, data) VALUES (%s, %s)", [(f"id{i}", "old") for i in range(3)]) == 3
+    assert db.execute_many("INSERT INTO test (id, data) VALUES (%s, %s)", []) == 0
+    assert db.bulk_replace("test", [{"id": "id2", "data": "new"}, {"id": "id3", "data": "new"}]) == 2
+    assert db.select("SELECT id, data FROM test ORDER BY id") == [("id0", "old"), ("id1", "old"),
+                                                                  ("id2", "new"), ("id3", "new")]
+    assert db.bulk_delete("test", ["id0", "id3", "id4"]) == 2
+    assert db.select("SELECT id FROM test ORDER BY id") == [("id1",), ("id2",)]
+
+    # A failed batch is rolled back completely
+    with pytest.raises(Exception):
+        db.execute_many("INSERT INTO test (id, data) VALUES (%s, %s)", [("id5", "new"), ("id1", "dup")])
+    assert db.select("SELECT count(id) FROM test") == [(2,)]
+    db.close()
+
+
+def test_mongo_bulk_operations(mocker):
+    replace_one = mocker.patch("awm.utils.db.ReplaceOne", create=True)
+    db = DataBase("mongodb://localhost/awm")
+    db.db_type = DataBase.MONGO
+    db.connection = MagicMock()
+    collection = db.connection.__getitem__.return_value
+    # an existing element not modified is also counted
+    collection.bulk_write.return_value.matched_count = 1
+    collection.bulk_write.return_value.modified_count = 0
+    collection.bulk_write.return_value.upserted_count = 1
+    collection.delete_many.return_value.deleted_count = 2
+
+    assert db.bulk_replace("test", [{"id": "id1", "data": "d1"}, {"id": "id2", "data": "d2"}]) == 2
+    replace_one.assert_any_call({"id": "id2"}, {"id": "id2", "data": "d2"}, upsert=True)
+    collection.bulk_write.assert_called_once_with([replace_one.return_value] * 2, ordered=False)
+    assert db.bulk_delete("test", ["id1", "id2"]) == 2
+    collection.delete_many.assert_called_once_with({"id": {"$in": ["id1", "id2"]}})
+
+
+def test_mongo_find_page():
+    db = DataBase("mongodb://localhost/awm")
+    db.db_type = DataBase.MONGO
+    db.connection = MagicMock()
+    collection = db.connection.__getitem__.return_value
+    collection.find.return_value = [{"id": "id3"}]
+    collection.count_documents.return_value = 3
+
+    res = db.find_page("deployments", {"owner": "user1"}, projection={"id": True},
+                       sort=[("created", -1), ("id", -1)], skip=2, limit=1, seek={"id": {"$lt": "id4"}})
+    assert res == ([{"id": "id3"}], 3)
+    # The page is filtered and limited in the server, the total only with the main filter
+    collection.find.assert_called_once_with({"$and": [{"owner": "user1"}, {"id": {"$lt": "id4"}}]},
+                                            {"id": True, "_id": False}, sort=[("created", -1), ("id", -1)],
+                                            skip=2, limit=1)
+    collection.count_documents.assert_called_once_with({"owner": "user1"})
+
+    collection.find.return_value = []
+    collection.count_documents.return_value = 0
+    assert db.find_page("deployments", {"owner": "user2"}) == ([], 0)
+    # The total is not counted if it is not needed
+    assert db.find_page("deployments", {"owner": "user2"}, with_total=False) == ([], None)
+    assert collection.count_documents.call_count == 2
+
+
+def _list_plan(db, table, seek=False, filters=None, descending=False):
+    sql, values = sql_list_query(table, "data", "user1", 0, 100, [1, "id1"] if seek else None,
+                                 filters=filters, descending=descending)
+    res = db.select("EXPLAIN QUERY PLAN " + sql, values)
+    return " ".join(row[-1] for row in res)
+
+
+def test_list_indexes(db_url):
+    db = DataBase(db_url)
+    assert db.connect()
+    migrations.migrate(db)
+    for table in ["deployments", "allocations"]:
+        for seek in [False, True]:
+            plan = _list_plan(db, table, seek)
+            # The count subquery also uses an index
+            assert f"USING COVERING INDEX {table}_owner_" in plan
+            assert f"USING INDEX {table}_owner_created_id" in plan
+            # The index is also used to sort the results
+            assert "TEMP B-TREE" not in plan
+    for column in ["status", "tool_id", "allocation_id"]:
+        for descending in [False, True]:
+            plan = _list_plan(db, "deployments", True, {column: "value"}, descending)
+            assert f"USING INDEX deployments_owner_{column}_created_id" in plan
+            assert "TEMP B-TREE" not in plan
+    # Allocation in use check
+    res = db.select("EXPLAIN QUERY PLAN SELECT id FROM deployments WHERE owner = %s and allocation_id = %s LIMIT 1",
+                    ("user1", "alloc1"))
+    assert "USING COVERING INDEX deployments_owner_allocation_id_created_id" in res[0][-1]
+    db.close()
+
+
+def _fill_deployments(db, start, end, owners):
+    db.connection.executemany("INSERT INTO deployments (id, data, owner, created) VALUES (?, '{}', ?, ?)",
+                              ((f"id{i}", f"user{i % owners}", i) for i in range(start, end)))
+    db.connection.commit()
+
+
+def _time_list(db):
+    sql, values = sql_list_query("deployments", "data", "user1", 0, 100)
+    return min(timeit.repeat(lambda: db.select(sql, values), number=20, repeat=5))
+
+
+def test_list_plan_with_data(db_url):
+    """The list query must use the index also when the planner has statistics of a big table"""
+    db = DataBase(db_url)
+    assert db.connect()
+    migrations.migrate(db)
+    _fill_deployments(db, 0, 5000, 50)
+    db.execute("ANALYZE")
+    sql, values = sql_list_query("deployments", "data", "user1", 0, 100)
+    plan = " ".join(row[-1] for row in db.select("EXPLAIN QUERY PLAN " + sql, values))
+    assert "USING INDEX deployments_owner_created_id" in plan
+    assert "TEMP B-TREE" not in plan
+    assert len(db.select(sql, values)) == 100
+    db.close()
+
+
+@pytest.mark.skipif(not os.getenv("AWM_BENCH_ROWS"), reason="set AWM_BENCH_ROWS to run the benchmark")
+def test_list_benchmark(db_url):
+    """Listing cost must not grow with the size of the table (e.g. AWM_BENCH_ROWS=2000000)"""
+    rows = int(os.getenv("AWM_BENCH_ROWS"))
+    owners = max(1, rows // 200)
+    db = DataBase(db_url)
+    assert db.connect()
+    migrations.migrate(db)
+
+    # Same number of deployments per owner, 10 times more rows in the table
+    _fill_deployments(db, 0, rows // 10, max(1, owners // 10))
+    small = _time_list(db)
+    db.execute("DELETE FROM deployments")
+    _fill_deployments(db, 0, rows, owners)
+    big = _time_list(db)
+    print(f"\nList deployments: {rows // 10} rows {small / 20 * 1e6:.1f} us, {rows} rows {big / 20 * 1e6:.1f} us")
+    assert big < small * 3
+    db.close()
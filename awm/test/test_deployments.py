@@ -14,12 +14,16 @@
 # limitations under the License.
 
 import json
+import datetime
+import awm.routers.deployments
 import pytest
 from pydantic import HttpUrl
 from unittest.mock import MagicMock
 from fastapi.testclient import TestClient
 from awm.__main__ import create_app
+from awm.routers.deployments import _is_allocation_in_use
 from awm.utils.db import DataBase
+from awm.utils.pagination import CREATED, encode_cursor, decode_cursor
 from awm.utils.node_registry import EOSCNode
 
 
@@ -34,6 +38,7 @@ def db_mock(mocker):
     instance = MagicMock()
     instance.connect.return_value = True
     instance.db_type = DataBase.SQLITE
+    mocker.patch("awm.routers.deployments.migrate")
     db = mocker.patch("awm.routers.deployments.DataBase", return_value=instance)
     db.MONGO = DataBase.MONGO
     db.SQLITE = DataBase.SQLITE
@@ -43,7 +48,7 @@ def db_mock(mocker):
 @pytest.fixture
 def check_oidc_mock(mocker):
     """Mock para check_OIDC."""
-    mocked = mocker.patch("awm.authorization.check_OIDC")
+    mocked = mocker.patch("awm.authorization.async_check_OIDC")
     mocked.return_value = {"sub": "test-user", "token": "astoken"}
     return mocked
 
@@ -101,8 +106,7 @@ def _get_deployment_info(dep_id="dep_id"):
 
 def test_list_deployments(client, db_mock, check_oidc_mock):
     selects = [
-        [[_get_deployment_info()]],
-        [[1]]
+        [[_get_deployment_info(), 1, "dep_id", 1]]
     ]
     db_mock.select.side_effect = selects
 
@@ -113,20 +117,146 @@ def test_list_deployments(client, db_mock, check_oidc_mock):
     assert response.json()["count"] == 1
     assert response.json()["elements"][0]["id"] == "dep_id"
 
-    db_mock.select.assert_any_call(
-        "SELECT data FROM deployments WHERE owner = %s order by created LIMIT %s OFFSET %s",
-        ("test-user", 100, 0)
+    # The page and the total are got in a single query
+    db_mock.select.assert_called_once_with(
+        "SELECT data, created, id, (SELECT count(id) FROM deployments WHERE owner = %s) FROM deployments "
+        "WHERE owner = %s order by created, id LIMIT %s OFFSET %s",
+        ("test-user", "test-user", 101, 0)
+    )
+
+
+def test_list_deployments_without_count(client, db_mock, check_oidc_mock):
+    db_mock.select.side_effect = [[[_get_deployment_info(), 1, "dep_id"]]]
+
+    response = client.get("/deployments?withCount=false", headers={"Authorization": "Bearer token"})
+
+    assert response.status_code == 200
+    assert "count" not in response.json()
+    assert response.json()["elements"][0]["id"] == "dep_id"
+    db_mock.select.assert_called_once_with(
+        "SELECT data, created, id FROM deployments WHERE owner = %s order by created, id LIMIT %s OFFSET %s",
+        ("test-user", 101, 0)
+    )
+
+
+def test_list_deployments_filters(client, db_mock, check_oidc_mock):
+    db_mock.select.side_effect = [[[_get_deployment_info("dep1"), 2, "dep1", 2],
+                                   [_get_deployment_info("dep2"), 1, "dep2", 2]]]
+
+    response = client.get("/deployments?status=pending&tool=toolid&allocation=aid&sort=-created&limit=1",
+                          headers={"Authorization": "Bearer token"})
+
+    assert response.status_code == 200
+    assert response.json()["count"] == 2
+    assert [dep["id"] for dep in response.json()["elements"]] == ["dep1"]
+    where = "WHERE owner = %s and status = %s and tool_id = %s and allocation_id = %s"
+    db_mock.select.assert_called_once_with(
+        f"SELECT data, created, id, (SELECT count(id) FROM deployments {where}) FROM deployments {where} "
+        "order by created desc, id desc LIMIT %s OFFSET %s",
+        ("test-user", "pending", "toolid", "aid") * 2 + (2, 0)
     )
+    # The filters are kept in the next page
+    next_page = response.json()["nextPage"]
+    assert next_page.startswith("http://testserver/deployments?status=pending&tool=toolid&allocation=aid"
+                                "&sort=-created&cursor=")
+
+    response = client.get("/deployments?sort=other", headers={"Authorization": "Bearer token"})
+    assert response.status_code == 422
+    response = client.get("/deployments?status=pending&allNodes=true", headers={"Authorization": "Bearer token"})
+    assert response.status_code == 400
+
 
+def test_list_deployments_db_error(client, db_mock, check_oidc_mock):
+    db_mock.select.side_effect = Exception("database is locked")
+
+    with pytest.raises(Exception, match="database is locked"):
+        client.get("/deployments", headers={"Authorization": "Bearer token"})
+    # The connection is returned to the pool
+    db_mock.__exit__.assert_called_once()
+
+
+def test_list_deployments_out_of_range(client, db_mock, check_oidc_mock):
+    db_mock.select.side_effect = [[], [[1]]]
+
+    response = client.get("/deployments?from=10", headers={"Authorization": "Bearer token"})
+
+    assert response.status_code == 200
+    assert response.json()["count"] == 1
+    assert response.json()["elements"] == []
+    db_mock.select.assert_called_with("SELECT count(id) from deployments WHERE owner = %s", ("test-user",))
+
+
+def test_list_deployments_cursor(client, db_mock, check_oidc_mock):
+    db_mock.select.side_effect = [
+        [[_get_deployment_info("dep1"), 1, "dep1", 3], [_get_deployment_info("dep2"), 2, "dep2", 3]],
+        [[_get_deployment_info("dep3"), 3, "dep3", 3]]
+    ]
+
+    response = client.get("/deployments?limit=1", headers={"Authorization": "Bearer token"})
+    assert response.status_code == 200
+    assert [dep["id"] for dep in response.json()["elements"]] == ["dep1"]
+    next_page = response.json()["nextPage"]
+    cursor = next_page.split("cursor=")[1].split("&")[0]
+    assert next_page == f"http://testserver/deployments?cursor={cursor}&limit=1"
+
+    response = client.get(next_page, headers={"Authorization": "Bearer token"})
+    assert response.status_code == 200
+    assert response.json()["count"] == 3
+    assert [dep["id"] for dep in response.json()["elements"]] == ["dep3"]
+    assert "nextPage" not in response.json()
+    assert "prevPage" not in response.json()
     db_mock.select.assert_any_call(
-        "SELECT count(id) from deployments WHERE owner = %s",
-        ("test-user",)
+        "SELECT data, created, id, (SELECT count(id) FROM deployments WHERE owner = %s) FROM deployments "
+        "WHERE owner = %s and created >= %s and (created > %s or id > %s) order by created, id LIMIT %s OFFSET %s",
+        ("test-user", "test-user", 1, 1, "dep1", 2, 0)
     )
 
+    response = client.get("/deployments?cursor=invalid", headers={"Authorization": "Bearer token"})
+    assert response.status_code == 400
+    assert response.json() == {"id": "400", "description": "Invalid cursor"}
+    # The values must have the types of created and id
+    for values in [(1, "dep1"), ("dep1", 1, "created"), (1, 2, "created"), (True, "dep1", "created"),
+                   (None, "dep1", "created"), ({}, "dep1", "created")]:
+        response = client.get(f"/deployments?cursor={encode_cursor(*values)}",
+                              headers={"Authorization": "Bearer token"})
+        assert response.status_code == 400
+
+    response = client.get(f"/deployments?cursor={cursor}&allNodes=true", headers={"Authorization": "Bearer token"})
+    assert response.status_code == 400
+    # The cursor can only be used with the same sort
+    response = client.get(f"/deployments?cursor={cursor}&sort=-created", headers={"Authorization": "Bearer token"})
+    assert response.status_code == 400
+    assert response.json()["description"] == "Invalid cursor: it was got with a different sort"
+
+
+def test_list_deployments_cursor_datetime(client, db_mock, check_oidc_mock):
+    # MySQL returns the created values as datetimes
+    db_mock.db_type = DataBase.MYSQL
+    created = datetime.datetime(2024, 1, 2, 3, 4, 5)
+    db_mock.select.side_effect = [
+        [[_get_deployment_info("dep1"), created, "dep1", 3], ["invalid", created, "dep2", 3],
+         [_get_deployment_info("dep3"), created, "dep3", 3]],
+        [[_get_deployment_info("dep3"), created, "dep3", 3]]
+    ]
+
+    response = client.get("/deployments?limit=2", headers={"Authorization": "Bearer token"})
+    assert response.status_code == 200
+    # The next page starts after the last row got, even if it is not valid
+    assert [dep["id"] for dep in response.json()["elements"]] == ["dep1"]
+    next_page = response.json()["nextPage"]
+    cursor = next_page.split("cursor=")[1].split("&")[0]
+    assert decode_cursor(cursor, CREATED, str, str) == [created.timestamp(), "dep2", "created"]
+
+    response = client.get(next_page, headers={"Authorization": "Bearer token"})
+    assert response.status_code == 200
+    assert [dep["id"] for dep in response.json()["elements"]] == ["dep3"]
+    # The cursor is compared with the TIMESTAMP column as a datetime
+    assert db_mock.select.call_args[0][1] == ("test-user", "test-user", created, created, "dep2", 3, 0)
+
 
 def test_list_deployments_mongo(client, db_mock, check_oidc_mock):
     db_mock.db_type = DataBase.MONGO
-    db_mock.find.return_value = [{"data": json.loads(_get_deployment_info())}]
+    db_mock.find_page.return_value = ([{"data": json.loads(_get_deployment_info()), "id": "dep_id", "created": 1}], 1)
 
     response = client.get("/deployments",
                           headers={"Authorization": "Bearer token"})
@@ -135,18 +265,21 @@ def test_list_deployments_mongo(client, db_mock, check_oidc_mock):
     assert response.json()["count"] == 1
     assert response.json()["elements"][0]["id"] == "dep_id"
 
-    db_mock.find.assert_called_with(
+    db_mock.find_page.assert_called_with(
         "deployments",
-        filt={"owner": "test-user"},
-        projection={"data": True},
-        sort=[("created", -1)]
+        {"owner": "test-user"},
+        projection={"data": True, "id": True, "created": True},
+        sort=[("created", -1), ("id", -1)],
+        skip=0,
+        limit=101,
+        seek=None,
+        with_total=True
     )
 
 
 def test_list_deployments_remote(client, db_mock, check_oidc_mock, list_nodes_mock, requests_get_mock):
     selects = [
-        [[_get_deployment_info()]],
-        [[1]],
+        [[_get_deployment_info(), 1, "dep_id", 1]],
         [],
         [[1]],
         [],
@@ -217,6 +350,22 @@ def test_list_deployments_remote(client, db_mock, check_oidc_mock, list_nodes_mo
     assert str(response.json()["prevPage"]) == "http://testserver/deployments?allNodes=true&from=0&limit=2"
 
 
+def test_is_allocation_in_use(db_mock):
+    db_mock.select.return_value = [["dep_id"]]
+    assert _is_allocation_in_use("aid", {"sub": "test-user"})
+    db_mock.select.assert_called_once_with(
+        "SELECT id FROM deployments WHERE owner = %s and allocation_id = %s LIMIT 1", ("test-user", "aid"))
+
+    db_mock.select.return_value = []
+    assert not _is_allocation_in_use("aid", {"sub": "test-user"})
+
+    db_mock.db_type = DataBase.MONGO
+    db_mock.find.return_value = []
+    assert not _is_allocation_in_use("aid", {"sub": "test-user"})
+    db_mock.find.assert_called_once_with("deployments", {"owner": "test-user", "allocation_id": "aid"},
+                                         {"id": True}, limit=1)
+
+
 def test_get_deployment(client, db_mock, check_oidc_mock, im_mock, allocation_mock):
     db_mock.select.side_effect = [
         [[_get_deployment_info()]]
@@ -235,6 +384,12 @@ def test_get_deployment(client, db_mock, check_oidc_mock, im_mock, allocation_mo
         "SELECT data FROM deployments WHERE id = %s and owner = %s",
         ("dep_id", "test-user")
     )
+    # The new status is stored
+    assert db_mock.execute.call_args[0][0] == "UPDATE deployments SET data = %s, status = %s WHERE id = %s"
+    assert db_mock.execute.call_args[0][1][1:] == ("running", "dep_id")
+    # without the read replicas, not to send the next reads of the user to the primary DB
+    db_class = awm.routers.deployments.DataBase
+    assert db_class.call_args == ((awm.routers.deployments.DB_URL,), {"owner": "test-user"})
 
 
 def test_delete_deployment(client, db_mock, check_oidc_mock, im_mock, ost_allocation_mock):
@@ -278,3 +433,7 @@ def test_deploy_workload(
     assert response.status_code == 202
     assert response.json()["id"] == "new_dep_id"
     assert response.json()["infoLink"] == "http://testserver/deployment/new_dep_id"
+    # The indexed columns are stored with the data
+    sql, values = db_mock.execute.call_args[0]
+    assert sql.startswith("replace into deployments (id, data, created, owner, status, tool_id, allocation_id)")
+    assert values[4:] == ("pending", "toolid", "aid")
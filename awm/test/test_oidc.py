@@ -13,14 +13,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import sys
 import json
+import base64
+import subprocess
+import time
+import asyncio
 import pytest
-from awm.oidc.client import OpenIDClient
-from awm.authorization import check_OIDC
-from unittest.mock import MagicMock
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from awm.oidc.client import OpenIDClient, AsyncOpenIDClient
+from awm.oidc.discovery import DiscoveryCache
+from awm.oidc.jwt import JWT, TokenClaims
+from awm.authorization import async_check_OIDC, user_info_cache, rejected_cache
+from unittest.mock import MagicMock, AsyncMock
 from fastapi import HTTPException
 
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    user_info_cache.clear()
+    rejected_cache.clear()
+    OpenIDClient.ISSUER_CONFIG_CACHE.clear()
+    OpenIDClient.JWKS_CACHE.clear()
+    OpenIDClient.INTROSPECTION_CACHE.clear()
+
+
+def check_OIDC(token):
+    return asyncio.run(async_check_OIDC(token))
+
+
+def _response(data, status_code=200):
+    response = MagicMock()
+    response.status_code = status_code
+    response.json.return_value = data
+    response.text = json.dumps(data)
+    return response
+
+
 @pytest.fixture
 def token(mocker):
     return ("eyJraWQiOiJyc2ExIiwiYWxnIjoiUlMyNTYifQ.eyJzdWIiOiJkYzVkNWFiNy02ZGI5LTQwNzktOTg1Yy04MGFjMDUwMTcw"
@@ -32,14 +63,20 @@ def token(mocker):
 
 @pytest.fixture
 def jwt_mock(mocker):
-    """Mock para requests.request()"""
-    return mocker.patch("awm.oidc.client.JWT.get_info")
+    """Mock para JWT.parse(), configurable con el contenido del token"""
+    info = MagicMock()
+    mocker.patch("awm.oidc.client.JWT.parse", side_effect=lambda token: TokenClaims(token, {}, info.return_value))
+    return info
 
 
 @pytest.fixture
-def requests_mock(mocker):
-    """Mock para requests.request()"""
-    return mocker.patch("awm.oidc.client.requests.request")
+def http_mock(mocker):
+    """Mock of the shared HTTP client of AsyncOpenIDClient"""
+    client = MagicMock()
+    client.get = AsyncMock()
+    client.post = AsyncMock()
+    mocker.patch("awm.oidc.client.AsyncOpenIDClient.get_http_client", return_value=client)
+    return client
 
 
 @pytest.fixture
@@ -48,44 +85,30 @@ def time_mock(mocker):
     return mocker.patch("awm.oidc.client.time.time")
 
 
-def test_get_openid_configuration_success(requests_mock):
-    """Test obtener configuración OpenID exitosamente"""
-    iss = "https://issuer.example.com"
-    response_data = {
-        "userinfo_endpoint": "https://issuer.example.com/userinfo",
+CONF = {"userinfo_endpoint": "https://issuer.example.com/userinfo",
         "introspection_endpoint": "https://issuer.example.com/introspect",
-        "token_endpoint": "https://issuer.example.com/token"
-    }
+        "token_endpoint": "https://issuer.example.com/token"}
+
 
-    mock_response = MagicMock()
-    mock_response.status_code = 200
-    mock_response.json.return_value = response_data
-    requests_mock.return_value = mock_response
+def test_get_openid_configuration_success(http_mock):
+    """Test obtener configuración OpenID exitosamente"""
+    iss = "https://issuer.example.com"
+    http_mock.get.return_value = _response(CONF)
 
-    result = OpenIDClient.get_openid_configuration(iss)
+    result = asyncio.run(AsyncOpenIDClient.get_openid_configuration(iss))
 
     assert "userinfo_endpoint" in result
     assert result["userinfo_endpoint"] == "https://issuer.example.com/userinfo"
     assert result["introspection_endpoint"] == "https://issuer.example.com/introspect"
-    requests_mock.assert_called_once_with(
-        "GET",
-        "https://issuer.example.com/.well-known/openid-configuration",
-        verify=False
-    )
+    http_mock.get.assert_called_once_with("https://issuer.example.com/.well-known/openid-configuration")
 
 
-def test_get_user_info_request_success(requests_mock, token):
+def test_get_user_info_request_success(http_mock, token):
     """Test obtener user info exitosamente"""
-    mock_response = MagicMock()
-    mock_response.status_code = 200
-    mock_response.text = json.dumps({
-        "sub": "user123",
-        "name": "Test User",
-        "email": "user@example.com"
-    })
-    requests_mock.return_value = mock_response
+    http_mock.get.side_effect = [_response(CONF),
+                                 _response({"sub": "user123", "name": "Test User", "email": "user@example.com"})]
 
-    success, user_info = OpenIDClient.get_user_info_request(token)
+    success, user_info = asyncio.run(AsyncOpenIDClient.get_user_info_request(token))
 
     assert success is True
     assert user_info["sub"] == "user123"
@@ -93,80 +116,359 @@ def test_get_user_info_request_success(requests_mock, token):
     assert user_info["email"] == "user@example.com"
 
     # Verificar que se hizo la llamada con los headers correctos
-    requests_mock.assert_called()
-    call_args = requests_mock.call_args
-    assert call_args[1]["headers"]["Authorization"] == f"Bearer {token}"
+    assert http_mock.get.call_args[1]["headers"]["Authorization"] == f"Bearer {token}"
 
 
-def test_get_token_introspection_success(requests_mock, token):
+def test_get_token_introspection_success(http_mock, token):
     """Test obtener introspección de token exitosamente"""
     client_id = "client123"
     client_secret = "secret456"
 
-    jwt_mock.return_value = {"iss": "https://issuer.example.com"}
-
-    mock_response = MagicMock()
-    mock_response.status_code = 200
-    mock_response.text = json.dumps({
-        "active": True,
-        "exp": 9999999999,
-        "sub": "user123"
-    })
-    requests_mock.return_value = mock_response
+    http_mock.get.return_value = _response(CONF)
+    http_mock.post.return_value = _response({"active": True, "exp": 9999999999, "sub": "user123"})
 
-    success, introspection = OpenIDClient.get_token_introspection(token, client_id, client_secret)
+    success, introspection = asyncio.run(AsyncOpenIDClient.get_token_introspection(token, client_id,
+                                                                                   client_secret))
 
     assert success is True
     assert introspection["active"] is True
     assert introspection["sub"] == "user123"
 
 
-def test_token_not_expired(jwt_mock, time_mock, token):
-    """Test token válido (no expirado)"""
+def test_auth_check_oidc_expired(token):
+    with pytest.raises(HTTPException):
+        check_OIDC(token)
+
+
+def test_auth_check_oidc_invalid(http_mock):
+    with pytest.raises(HTTPException) as ex:
+        check_OIDC("invalid.token")
+    assert ex.value.detail == "Invalid token"
+    http_mock.get.assert_not_called()
+
+
+def test_auth_check_oidc_success(http_mock, jwt_mock, time_mock, token):
+    http_mock.get.side_effect = [_response(CONF),
+                                 _response({"sub": "user123", "name": "Test User", "email": "user@example.com"})]
+
     current_time = 1000
     expiration_time = 2000
 
-    jwt_mock.return_value = {"exp": expiration_time}
+    jwt_mock.return_value = {"exp": expiration_time, "iss": "https://issuer.example.com"}
     time_mock.return_value = current_time
 
-    is_expired, message = OpenIDClient.is_access_token_expired(token)
+    res = check_OIDC(token)
+
+    assert res["sub"] == "user123"
+    assert res["name"] == "Test User"
+    assert res["email"] == "user@example.com"
 
-    assert is_expired is False
-    assert "Valid Token" in message
-    assert "1000 seconds" in message
 
+def test_auth_check_oidc_cache(http_mock, jwt_mock, time_mock, token):
+    http_mock.get.side_effect = [_response(CONF), _response({"sub": "user123"})]
 
-def test_token_expired(token):
-    """Test token expirado"""
-    is_expired, message = OpenIDClient.is_access_token_expired(token)
+    jwt_mock.return_value = {"exp": 2000, "iss": "https://issuer.example.com"}
+    time_mock.return_value = 1000
 
-    assert is_expired is True
-    assert "Token expired" in message
+    res = check_OIDC(token)
+    assert res == {"sub": "user123", "token": token}
+    calls = http_mock.get.call_count
 
+    res = check_OIDC(token)
+    assert res == {"sub": "user123", "token": token}
+    assert http_mock.get.call_count == calls
+    assert user_info_cache.stats()["hits"] == 1
+    assert user_info_cache.stats()["misses"] == 1
 
-def test_auth_check_oidc_expired(token):
+    # The entry must expire with the token
+    time_mock.return_value = 2001
     with pytest.raises(HTTPException):
         check_OIDC(token)
 
 
-def test_auth_check_oidc_success(requests_mock, jwt_mock, time_mock, token):
-    mock_response = MagicMock()
-    mock_response.status_code = 200
-    mock_response.text = json.dumps({
-        "sub": "user123",
-        "name": "Test User",
-        "email": "user@example.com"
-    })
-    requests_mock.return_value = mock_response
+@pytest.fixture
+def rsa_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
 
-    current_time = 1000
-    expiration_time = 2000
 
-    jwt_mock.return_value = {"exp": expiration_time, "iss": "https://issuer.example.com"}
-    time_mock.return_value = current_time
+def _b64e(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
 
-    res = check_OIDC(token)
 
-    assert res["sub"] == "user123"
-    assert res["name"] == "Test User"
-    assert res["email"] == "user@example.com"
+def _int_b64e(value):
+    return _b64e(value.to_bytes((value.bit_length() + 7) // 8, "big"))
+
+
+def _sign_token(key, claims, kid="kid1"):
+    header = _b64e(json.dumps({"alg": "RS256", "kid": kid}).encode())
+    payload = _b64e(json.dumps(claims).encode())
+    signature = key.sign(f"{header}.{payload}".encode(), padding.PKCS1v15(), hashes.SHA256())
+    return f"{header}.{payload}.{_b64e(signature)}"
+
+
+def _jwks_responses(key, kid="kid1"):
+    conf_response = MagicMock()
+    conf_response.status_code = 200
+    conf_response.json.return_value = {"userinfo_endpoint": "https://jwt.example.com/userinfo",
+                                       "introspection_endpoint": "https://jwt.example.com/introspect",
+                                       "jwks_uri": "https://jwt.example.com/jwks"}
+    numbers = key.public_key().public_numbers()
+    jwks_response = MagicMock()
+    jwks_response.status_code = 200
+    jwks_response.json.return_value = {"keys": [{"kty": "RSA", "kid": kid, "use": "sig",
+                                                 "n": _int_b64e(numbers.n), "e": _int_b64e(numbers.e)}]}
+    return conf_response, jwks_response
+
+
+def _get_user_info_jwt(token):
+    return asyncio.run(AsyncOpenIDClient.get_user_info_jwt(token))
+
+
+def test_get_user_info_jwt(http_mock, rsa_key):
+    http_mock.get.side_effect = _jwks_responses(rsa_key)
+    token = _sign_token(rsa_key, {"sub": "user123", "iss": "https://jwt.example.com", "exp": 9999999999})
+
+    success, user_info = _get_user_info_jwt(token)
+    assert success is True
+    assert user_info["sub"] == "user123"
+    assert http_mock.get.call_count == 2
+
+    # The JWKS is cached
+    success, user_info = _get_user_info_jwt(token)
+    assert success is True
+    assert http_mock.get.call_count == 2
+
+    # Tampered tokens are rejected
+    other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    token = _sign_token(other_key, {"sub": "user123", "iss": "https://jwt.example.com", "exp": 9999999999})
+    success, msg = _get_user_info_jwt(token)
+    assert success is False
+    assert msg == "Invalid JWT signature"
+
+    # Unknown kids refresh the JWKS (at most once per JWKS_MIN_REFRESH)
+    token = _sign_token(rsa_key, {"sub": "user123", "iss": "https://jwt.example.com", "exp": 9999999999}, "kid2")
+    success, msg = _get_user_info_jwt(token)
+    assert success is False
+    assert msg == "Unknown signing key: kid2."
+    assert http_mock.get.call_count == 2
+
+    # nbf is checked with the same clock skew as in the pre-check
+    now = int(time.time())
+    token = _sign_token(rsa_key, {"sub": "user123", "iss": "https://jwt.example.com", "exp": 9999999999,
+                                  "nbf": now + OpenIDClient.CLOCK_SKEW // 2})
+    assert _get_user_info_jwt(token)[0] is True
+    token = _sign_token(rsa_key, {"sub": "user123", "iss": "https://jwt.example.com", "exp": 9999999999,
+                                  "nbf": now + OpenIDClient.CLOCK_SKEW * 2})
+    assert _get_user_info_jwt(token) == (False, "Token not yet valid.")
+
+
+def test_get_user_info_jwt_issuer_audience(http_mock, rsa_key):
+    http_mock.get.side_effect = _jwks_responses(rsa_key)
+    claims = {"sub": "user123", "iss": "https://jwt.example.com", "exp": 9999999999, "aud": ["awm", "other"]}
+
+    # Untrusted issuers are rejected before getting their keys
+    success, msg = asyncio.run(AsyncOpenIDClient.get_user_info_jwt(_sign_token(rsa_key, claims),
+                                                                   allowed_issuers=["https://issuer.example.com"]))
+    assert success is False
+    assert msg == "Untrusted token issuer: https://jwt.example.com."
+    http_mock.get.assert_not_called()
+
+    allowed = ["https://jwt.example.com/"]
+    success, _ = asyncio.run(AsyncOpenIDClient.get_user_info_jwt(_sign_token(rsa_key, claims),
+                                                                 allowed_issuers=allowed, audience="awm"))
+    assert success is True
+    claims["aud"] = "other"
+    success, msg = asyncio.run(AsyncOpenIDClient.get_user_info_jwt(_sign_token(rsa_key, claims),
+                                                                   allowed_issuers=allowed, audience="awm"))
+    assert success is False
+    assert msg == "Invalid token audience."
+
+
+@pytest.mark.parametrize("env,error", [
+    ({"OIDC_AUTH_MODE": "jwt", "OIDC_AUDIENCE": "awm"}, "OIDC_ALLOWED_ISSUERS must be set"),
+    ({"OIDC_AUTH_MODE": "jwt", "OIDC_ALLOWED_ISSUERS": "https://iss"}, "OIDC_AUDIENCE"),
+    ({"OIDC_AUTH_MODE": "jwt", "OIDC_ALLOWED_ISSUERS": "https://iss", "OIDC_CLIENT_ID": "awm"}, None),
+    ({"OIDC_AUTH_MODE": "introspection", "OIDC_CLIENT_ID": "awm", "OIDC_CLIENT_SECRET": "secret"},
+     "OIDC_ALLOWED_ISSUERS must be set"),
+    ({"OIDC_AUTH_MODE": "introspection", "OIDC_CLIENT_ID": "awm", "OIDC_CLIENT_SECRET": "secret",
+      "OIDC_ALLOWED_ISSUERS": "https://iss"}, None),
+])
+def test_auth_mode_config(env, error):
+    env = dict({k: v for k, v in os.environ.items() if not k.startswith("OIDC_")}, **env)
+    res = subprocess.run([sys.executable, "-c", "import awm.authorization"], env=env, capture_output=True, text=True)
+    if error:
+        assert res.returncode != 0
+        assert error in res.stderr
+    else:
+        assert res.returncode == 0, res.stderr
+
+
+def test_async_check_oidc(http_mock, jwt_mock, time_mock, token):
+    http_mock.get.side_effect = [_response({"userinfo_endpoint": "https://async.example.com/userinfo",
+                                            "introspection_endpoint": "https://async.example.com/introspect"}),
+                                 _response({"sub": "user123"})]
+
+    jwt_mock.return_value = {"exp": 2000, "iss": "https://async.example.com"}
+    time_mock.return_value = 1000
+
+    res = asyncio.run(async_check_OIDC(token))
+    assert res == {"sub": "user123", "token": token}
+    http_mock.get.assert_called_with("https://async.example.com/userinfo",
+                                     headers={"Authorization": f"Bearer {token}"})
+
+    # Second call is served from the cache
+    res = asyncio.run(async_check_OIDC(token))
+    assert res == {"sub": "user123", "token": token}
+    assert http_mock.get.call_count == 2
+
+
+def test_discovery_cache_single_flight():
+    cache = DiscoveryCache(ttl=100, refresh_ahead=10)
+    calls = []
+
+    async def fetch(iss):
+        calls.append(iss)
+        await asyncio.sleep(0.1)
+        return {"userinfo_endpoint": f"{iss}/userinfo"}
+
+    async def gets():
+        return await asyncio.gather(*[cache.get("https://iss", fetch) for _ in range(5)])
+
+    assert asyncio.run(gets()) == [{"userinfo_endpoint": "https://iss/userinfo"}] * 5
+    assert calls == ["https://iss"]
+
+    # Waiters give up after wait_timeout without cancelling the fetch
+    cache = DiscoveryCache(ttl=100, refresh_ahead=10, wait_timeout=0.05)
+
+    async def slow_gets():
+        return await asyncio.gather(*[cache.get("https://iss2", fetch) for _ in range(2)], return_exceptions=True)
+
+    res = asyncio.run(slow_gets())
+    assert res[0] == {"userinfo_endpoint": "https://iss2/userinfo"}
+    assert "Timeout waiting" in str(res[1])
+
+
+def test_discovery_cache_cancel():
+    cache = DiscoveryCache(ttl=100, refresh_ahead=10)
+
+    async def fetch(iss):
+        await asyncio.sleep(10)
+
+    async def cancel_leader():
+        leader = asyncio.create_task(cache.get("https://iss", fetch))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.get("https://iss", fetch))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        with pytest.raises(Exception, match="cancelled"):
+            await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(cancel_leader())
+    assert cache._inflight == {}
+
+
+def test_discovery_cache_refresh_ahead(mocker):
+    time_mock = mocker.patch("awm.oidc.discovery.time.time", return_value=1000)
+    cache = DiscoveryCache(ttl=100, refresh_ahead=10)
+    fetch = AsyncMock(return_value={"userinfo_endpoint": "https://iss/userinfo"})
+
+    async def get():
+        res = await cache.get("https://iss", fetch)
+        # let the background refresh run
+        await asyncio.sleep(0)
+        return res
+
+    asyncio.run(get())
+    time_mock.return_value = 1080
+    assert asyncio.run(get()) == {"userinfo_endpoint": "https://iss/userinfo"}
+    assert fetch.call_count == 1
+
+    # Near the expiration time the entry is refreshed in background (only once)
+    time_mock.return_value = 1095
+
+    async def gets():
+        res = await asyncio.gather(cache.get("https://iss", fetch), cache.get("https://iss", fetch))
+        await asyncio.sleep(0)
+        return res
+
+    assert asyncio.run(gets()) == [{"userinfo_endpoint": "https://iss/userinfo"}] * 2
+    assert fetch.call_count == 2
+
+    # Expired entries are fetched again
+    time_mock.return_value = 1200
+    asyncio.run(get())
+    assert fetch.call_count == 3
+
+
+def _get_user_info_introspection(token):
+    return asyncio.run(AsyncOpenIDClient.get_user_info_introspection(token, "client", "secret"))
+
+
+def test_get_user_info_introspection(http_mock, token):
+    http_mock.get.return_value = _response(CONF)
+    http_mock.post.return_value = _response({"active": True, "exp": 9999999999, "sub": "user123"})
+
+    success, user_info = _get_user_info_introspection(token)
+    assert success is True
+    assert user_info["sub"] == "user123"
+    calls = http_mock.post.call_count
+    success, user_info = _get_user_info_introspection(token)
+    assert success is True
+    assert http_mock.post.call_count == calls
+    assert http_mock.post.call_args[0][0] == "https://issuer.example.com/introspect"
+    assert http_mock.post.call_args[1]["data"] == {"token": token, "token_type_hint": "access_token"}
+
+    # Inactive tokens are also cached
+    OpenIDClient.INTROSPECTION_CACHE.clear()
+    http_mock.post.return_value = _response({"active": False})
+    success, msg = _get_user_info_introspection(token)
+    assert success is False
+    assert msg == "Token is not active."
+    calls = http_mock.post.call_count
+    success, msg = _get_user_info_introspection(token)
+    assert success is False
+    assert http_mock.post.call_count == calls
+
+    assert OpenIDClient.INTROSPECTION_CACHE.stats()["hits"] == 1
+
+    # The client credentials are not sent to untrusted issuers
+    OpenIDClient.INTROSPECTION_CACHE.clear()
+    success, msg = asyncio.run(AsyncOpenIDClient.get_user_info_introspection(
+        token, "client", "secret", allowed_issuers=["https://issuer.example.com"]))
+    assert success is False
+    assert msg.startswith("Untrusted token issuer")
+    assert http_mock.post.call_count == calls
+
+
+def test_parse_token_once(mocker, http_mock, time_mock, token):
+    http_mock.get.side_effect = [_response(CONF), _response({"sub": "user123"})]
+    time_mock.return_value = 1000
+    parse_spy = mocker.spy(JWT, "parse")
+
+    # The token is decoded only once per request
+    assert check_OIDC(token)["sub"] == "user123"
+    assert parse_spy.call_count == 1
+
+
+def test_auth_check_oidc_fast_reject(mocker, http_mock, jwt_mock, time_mock, token):
+    mocker.patch("awm.authorization.OIDC_ALLOWED_ISSUERS", ["https://issuer.example.com/"])
+    time_mock.return_value = 1000
+    jwt_mock.return_value = {"exp": 2000, "iss": "https://evil.example.com"}
+    with pytest.raises(HTTPException) as ex:
+        check_OIDC(token)
+    assert ex.value.detail == "Untrusted token issuer"
+
+    # Rejected tokens are remembered
+    with pytest.raises(HTTPException) as ex:
+        check_OIDC(token)
+    assert ex.value.detail == "Untrusted token issuer"
+    assert rejected_cache.stats()["hits"] == 1
+
+    rejected_cache.clear()
+    jwt_mock.return_value = {"exp": 2000, "nbf": 1500, "iss": "https://issuer.example.com"}
+    with pytest.raises(HTTPException) as ex:
+        check_OIDC(token)
+    assert ex.value.detail == "Token not yet valid"
+    http_mock.get.assert_not_called()
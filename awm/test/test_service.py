@@ -37,3 +37,17 @@ def test_version(client, headers):
     response = client.get('/version', headers=headers)
     assert response.status_code == 200
     assert response.json() == {'message': __version__}
+
+
+def test_metrics(client, headers, mocker):
+    # Not served if there is no token configured
+    assert client.get('/metrics').status_code == 404
+
+    mocker.patch("awm.routers.service.METRICS_TOKEN", "metrics-token")
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers=headers).status_code == 401
+    response = client.get('/metrics', headers={"Authorization": "Bearer metrics-token"})
+    assert response.status_code == 200
+    assert response.json()["oidc_user_info_cache"]["maxsize"] == 1000
+    assert "hits" in response.json()["oidc_introspection_cache"]
+    assert "db_queries" in response.json()
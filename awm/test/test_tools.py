@@ -35,7 +35,7 @@ def headers():
 
 @pytest.fixture
 def check_oidc_mock():
-    with patch('awm.authorization.check_OIDC') as mock_func:
+    with patch('awm.authorization.async_check_OIDC') as mock_func:
         mock_func.return_value = {
             "sub": "user123",
             "name": "User DN",
@@ -13,12 +13,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List
+from typing import List, Tuple
 
 
 class AllocationStore():
 
-    def list_allocations(self, user_info: dict, from_: int, limit: int) -> List[dict]:
+    def list_allocations(self, user_info: dict, from_: int, limit: int,
+                         cursor: str = None, with_count: bool = True) -> Tuple[int, List[dict], str]:
+        """Return the total number of allocations of the user, the requested ones
+        and the cursor to get the next ones (None if there are no more).
+        If cursor is set, from_ is ignored and the elements after the cursor are returned.
+        If with_count is not set, the total may be None to avoid counting them."""
         raise NotImplementedError()
 
     def get_allocation(self, allocation_id: str, user_info: dict) -> dict:
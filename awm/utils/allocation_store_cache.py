@@ -0,0 +1,117 @@
+#
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import json
+import time
+import threading
+from typing import List, Tuple
+from awm.utils.allocation_store import AllocationStore
+from awm.utils.cache import TTLCache
+from awm.utils import metrics
+
+
+class CachingAllocationStore(AllocationStore):
+    """
+    Cache of the allocations returned by another AllocationStore.
+
+    The results of each user are stored in an entry of a LRU cache bounded by
+    number of users and total bytes. They expire after `ttl` seconds and all the
+    ones of a user are removed when it replaces or deletes an allocation.
+    Changes made by other processes are only seen when the results expire.
+    """
+
+    def __init__(self, store: AllocationStore, maxsize: int = 1000, ttl: float = 60, maxbytes: int = 0):
+        self.store = store
+        self.ttl = ttl
+        self._cache = TTLCache(maxsize, ttl, maxbytes)
+        self._lock = threading.Lock()
+        # Number of invalidations, to avoid caching results read before one of them
+        self._invalidations = 0
+        self._counters = {"get": [0, 0], "list": [0, 0]}
+        metrics.register("allocation_cache", self.stats)
+
+    def _get(self, user_info: dict, operation: str, key: tuple):
+        """Return (True, value) if the result is cached or (False, None) otherwise"""
+        entries = self._cache.get(user_info['sub'])
+        entry = entries.get(key) if entries else None
+        found = entry is not None and entry[1] > time.time()
+        with self._lock:
+            self._counters[operation][0 if found else 1] += 1
+        if found:
+            # cached values must not be modified
+            return True, copy.deepcopy(entry[0])
+        return False, None
+
+    def _set(self, user_info: dict, key: tuple, value, invalidations: int):
+        # estimated size, values that are not JSON serializable (e.g. datetimes) are counted as strings
+        size = len(json.dumps(value, default=str))
+        now = time.time()
+        with self._lock:
+            if invalidations != self._invalidations:
+                return
+            entries = {k: v for k, v in (self._cache.get(user_info['sub']) or {}).items() if v[1] > now}
+            entries[key] = (copy.deepcopy(value), now + self.ttl, size)
+            self._cache.set(user_info['sub'], entries, size=sum(v[2] for v in entries.values()))
+
+    def _invalidate(self, user_info: dict = None):
+        with self._lock:
+            self._invalidations += 1
+            if user_info:
+                self._cache.delete(user_info['sub'])
+            else:
+                self._cache.clear()
+
+    def list_allocations(self, user_info: dict, from_: int, limit: int,
+                         cursor: str = None, with_count: bool = True) -> Tuple[int, List[dict], str]:
+        key = ("list", from_, limit, cursor, with_count)
+        found, res = self._get(user_info, "list", key)
+        if found:
+            return tuple(res)
+        invalidations = self._invalidations
+        res = self.store.list_allocations(user_info, from_, limit, cursor, with_count)
+        self._set(user_info, key, list(res), invalidations)
+        return res
+
+    def get_allocation(self, allocation_id: str, user_info: dict) -> dict:
+        key = ("get", allocation_id)
+        found, res = self._get(user_info, "get", key)
+        if found:
+            return res
+        invalidations = self._invalidations
+        res = self.store.get_allocation(allocation_id, user_info)
+        self._set(user_info, key, res, invalidations)
+        return res
+
+    def delete_allocation(self, allocation_id: str, user_info: dict = None):
+        try:
+            return self.store.delete_allocation(allocation_id, user_info)
+        finally:
+            self._invalidate(user_info)
+
+    def replace_allocation(self, data: dict, user_info: dict, allocation_id: str = None) -> str:
+        try:
+            return self.store.replace_allocation(data, user_info, allocation_id)
+        finally:
+            self._invalidate(user_info)
+
+    def stats(self) -> dict:
+        """Return the usage counters of the cache and the hit ratio of each operation"""
+        res = self._cache.stats()
+        with self._lock:
+            for operation, (hits, misses) in self._counters.items():
+                res[operation] = {"hits": hits, "misses": misses,
+                                  "hit_ratio": hits / (hits + misses) if hits + misses else 0.0}
+        return res
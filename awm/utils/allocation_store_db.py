@@ -16,8 +16,11 @@
 import json
 import time
 import uuid
-from typing import List
+from typing import List, Tuple
 from awm.utils.db import DataBase
+from awm.utils.pagination import (CREATED, cursor_created, encode_cursor, decode_cursor, mongo_seek_filter,
+                                  sql_list_query, sql_list_total)
+from awm.utils.migrations import migrate
 from awm.utils.allocation_store import AllocationStore
 
 
@@ -31,66 +34,66 @@ class AllocationStoreDB(AllocationStore):
 
     DEFAULT_URL = "file:///tmp/awm.db"
 
-    def __init__(self, db_url):
-        self.db = DataBase(db_url)
-        if self.db.connect():
-            self._init_table(self.db)
-            self.db.close()
-        else:
-            raise DBConnectionException()
+    def __init__(self, db_url, read_urls=None):
+        self.db_url = db_url
+        self.read_urls = read_urls
+        for url in db_url if isinstance(db_url, (list, tuple)) else [db_url]:
+            db = DataBase(url)
+            if db.connect():
+                with db:
+                    migrate(db)
+            else:
+                raise DBConnectionException()
 
-    @staticmethod
-    def _init_table(db: DataBase) -> bool:
-        """Creates de database."""
-        if not db.table_exists("allocations"):
-            if db.db_type == DataBase.MYSQL:
-                db.execute("CREATE TABLE allocations (id VARCHAR(255) PRIMARY KEY, data TEXT, "
-                           "owner VARCHAR(255), created TIMESTAMP)")
-            elif db.db_type == DataBase.SQLITE:
-                db.execute("CREATE TABLE allocations (id TEXT PRIMARY KEY, data TEXT, "
-                           "owner VARCHAR(255), created TIMESTAMP)")
-            elif db.db_type == DataBase.MONGO:
-                db.connection.create_collection("allocations")
-                db.connection["allocations"].create_index([("id", 1), ("owner", 1)], unique=True)
-            return True
-        return False
+    def _get_db(self, user_info: dict = None) -> DataBase:
+        # A DataBase object per operation, as the store is shared among threads
+        return DataBase(self.db_url, self.read_urls, owner=user_info['sub'] if user_info else None)
 
-    def list_allocations(self, user_info: dict, from_: int, limit: int) -> List[dict]:
-        if self.db.connect():
+    def list_allocations(self, user_info: dict, from_: int, limit: int,
+                         cursor: str = None, with_count: bool = True) -> Tuple[int, List[dict], str]:
+        last = decode_cursor(cursor, CREATED, str) if cursor else None
+        if last:
+            from_ = 0
+        db = self._get_db(user_info)
+        if db.connect():
             allocations = []
-            if self.db.db_type == DataBase.MONGO:
-                res = self.db.find("allocations", filt={"owner": user_info['sub']},
-                                   projection={"data": True, "id": True}, sort=[('created', -1)])
-                for count, elem in enumerate(res):
-                    if from_ > count:
-                        continue
-                    allocations.append(elem)
-                    if len(allocations) >= limit:
-                        break
-                count = len(res)
-            else:
-                sql = "SELECT id, data FROM allocations WHERE owner = %s order by created LIMIT %s OFFSET %s"
-                res = self.db.select(sql, (user_info['sub'], limit, from_))
-                for elem in res:
-                    allocations.append({"id": elem[0], "data": json.loads(elem[1])})
-                res = self.db.select("SELECT count(id) from allocations WHERE owner = %s", (user_info['sub'],))
-                count = res[0][0] if res else 0
-            self.db.close()
-            return count, allocations
+            with db:
+                if db.db_type == DataBase.MONGO:
+                    allocations, count = db.find_page("allocations", {"owner": user_info['sub']},
+                                                      projection={"data": True, "id": True, "created": True},
+                                                      sort=[('created', -1), ('id', -1)],
+                                                      skip=from_, limit=limit + 1,
+                                                      seek=mongo_seek_filter(*last) if last else None,
+                                                      with_total=with_count)
+                else:
+                    sql, values = sql_list_query("allocations", "id, data, created", user_info['sub'],
+                                                 from_, limit, last, with_count, db_type=db.db_type)
+                    res = db.select(sql, values)
+                    for elem in res:
+                        allocations.append({"id": elem[0], "data": json.loads(elem[1]), "created": elem[2]})
+                    count = None
+                    if with_count:
+                        count = sql_list_total(db, "allocations", user_info['sub'], res, bool(from_ or last))
+            next_cursor = None
+            if len(allocations) > limit:
+                allocations = allocations[:limit]
+                next_cursor = encode_cursor(cursor_created(allocations[-1].get("created")), allocations[-1]["id"])
+            return count, allocations, next_cursor
 
         raise DBConnectionException()
 
     def get_allocation(self, allocation_id: str, user_info: dict) -> dict:
-        if self.db.connect():
-            if self.db.db_type == DataBase.MONGO:
-                res = self.db.find("allocations", {"id": allocation_id, "owner": user_info['sub']},
-                                   {"id": True, "data": True})
-            else:
-                res = self.db.select("SELECT id, data FROM allocations WHERE id = %s and owner = %s",
-                                     (allocation_id, user_info['sub']))
-            self.db.close()
+        db = self._get_db(user_info)
+        if db.connect():
+            with db:
+                if db.db_type == DataBase.MONGO:
+                    res = db.find("allocations", {"id": allocation_id, "owner": user_info['sub']},
+                                  {"id": True, "data": True})
+                else:
+                    res = db.select("SELECT id, data FROM allocations WHERE id = %s and owner = %s",
+                                    (allocation_id, user_info['sub']))
             if res:
-                if self.db.db_type == DataBase.MONGO:
+                if db.db_type == DataBase.MONGO:
                     return res[0]["data"]
                 else:
                     return json.loads(res[0][1])
@@ -98,37 +101,39 @@ class AllocationStoreDB(AllocationStore):
         raise DBConnectionException()
 
     def delete_allocation(self, allocation_id: str, user_info: dict = None):
-        if self.db.connect():
-            if self.db.db_type == DataBase.MONGO:
-                self.db.delete("allocations", {"id": allocation_id})
-            else:
-                self.db.execute("DELETE FROM allocations WHERE id = %s", (allocation_id,))
-            self.db.close()
+        db = self._get_db(user_info)
+        if db.connect():
+            with db:
+                if db.db_type == DataBase.MONGO:
+                    db.delete("allocations", {"id": allocation_id})
+                else:
+                    db.execute("DELETE FROM allocations WHERE id = %s", (allocation_id,))
         else:
             raise DBConnectionException()
 
     def replace_allocation(self, data: dict, user_info: dict, allocation_id: str = None) -> str:
-        if self.db.connect():
-            if self.db.db_type == DataBase.MONGO:
-                if allocation_id is None:  # new allocation
-                    allocation_id = str(uuid.uuid4())
-                    replace = {"id": allocation_id, "data": data,
-                               "owner": user_info['sub'],
-                               "created": time.time()}
-                else:  # update existing allocation
-                    replace = {"id": allocation_id, "data": data,
-                               "owner": user_info['sub']}
-                self.db.replace("allocations", {"id": allocation_id}, replace)
-            else:
-                if allocation_id is None:  # new allocation
-                    allocation_id = str(uuid.uuid4())
-                    sql = "replace into allocations (id, data, owner, created) values (%s, %s, %s, %s)"
-                    values = (allocation_id, json.dumps(data), user_info['sub'], time.time())
-                else:  # update existing allocation
-                    sql = "update allocations set data = %s where id = %s"
-                    values = (json.dumps(data), allocation_id)
-                self.db.execute(sql, values)
-            self.db.close()
+        db = self._get_db(user_info)
+        if db.connect():
+            with db:
+                if db.db_type == DataBase.MONGO:
+                    if allocation_id is None:  # new allocation
+                        allocation_id = str(uuid.uuid4())
+                        replace = {"id": allocation_id, "data": data,
+                                   "owner": user_info['sub'],
+                                   "created": time.time()}
+                        db.replace("allocations", {"id": allocation_id}, replace)
+                    else:  # update existing allocation, keeping its created time
+                        db.update("allocations", {"id": allocation_id},
+                                  {"$set": {"data": data, "owner": user_info['sub']}}, upsert=False)
+                else:
+                    if allocation_id is None:  # new allocation
+                        allocation_id = str(uuid.uuid4())
+                        sql = "replace into allocations (id, data, owner, created) values (%s, %s, %s, %s)"
+                        values = (allocation_id, json.dumps(data), user_info['sub'], time.time())
+                    else:  # update existing allocation
+                        sql = "update allocations set data = %s where id = %s"
+                        values = (json.dumps(data), allocation_id)
+                    db.execute(sql, values)
             return allocation_id
 
         raise DBConnectionException()
@@ -13,13 +13,47 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import sys
+import copy
 import hvac
 import json
+import time
 import uuid
+import random
+import logging
+import inspect
+import argparse
 import requests
-from typing import List
+import functools
+import threading
+from typing import List, Tuple
 from cryptography.fernet import Fernet
 from awm.utils.allocation_store import AllocationStore
+from awm.utils.cache import TTLCache
+from awm.utils import metrics
+from awm.utils.pagination import encode_cursor, decode_cursor
+
+
+logger = logging.getLogger(__name__)
+
+
+def _relogin(func):
+    """Repeat an operation once with a new Vault login if Vault rejects
+    the cached token of the user (e.g. it has been revoked)"""
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except (hvac.exceptions.Forbidden, hvac.exceptions.Unauthorized):
+            user_info = signature.bind(self, *args, **kwargs).arguments.get("user_info")
+            if not user_info or not self._tokens.delete(self._token_key(user_info)):
+                raise
+            logger.info("Vault token of user %s rejected, login again", user_info['sub'])
+            return func(self, *args, **kwargs)
+    return wrapper
 
 
 class AllocationStoreVault(AllocationStore):
@@ -27,13 +61,35 @@ class AllocationStoreVault(AllocationStore):
     SECRETS_EGI = "https://secrets.egi.eu"
     DEFAULT_URL = SECRETS_EGI
     DEFAULT_KEY = "3JSvUdOsAlvSNVYvBwHWE-iKdWkhq4C_LmjRcpuycT0="
+    # All the allocations of a user in one secret, or a secret per allocation under the user path
+    LAYOUT_SINGLE = "single"
+    LAYOUT_PER_ALLOCATION = "per_allocation"
+    # Vault tokens cached per user and OIDC token
+    TOKEN_CACHE_SIZE = int(os.getenv("VAULT_TOKEN_CACHE_SIZE", "1000"))
+    # Max secs a Vault token is cached (also used if the token lease has no duration)
+    TOKEN_CACHE_TTL = int(os.getenv("VAULT_TOKEN_CACHE_TTL", "3600"))
+    # Secs before the expiration of the token lease to login again
+    TOKEN_REFRESH = int(os.getenv("VAULT_TOKEN_REFRESH", "60"))
+    # Decrypted allocations cached per user, KV v2 entries are revalidated with the secret version
+    CACHE_SIZE = int(os.getenv("VAULT_CACHE_SIZE", "1000"))
+    # Max secs the allocations are cached (the only check in KV v1, as it has no versions)
+    CACHE_TTL = int(os.getenv("VAULT_CACHE_TTL", "30"))
+    # Retries of the KV v2 writes rejected as the secret has been modified meanwhile,
+    # with exponential backoff (with jitter)
+    CAS_RETRIES = int(os.getenv("VAULT_CAS_RETRIES", "5"))
+    RETRY_SLEEP = 0.05
+    RETRY_MAX_SLEEP = 1
 
-    def __init__(self, vault_url, mount_point=None, path=None, role=None, kv_ver=1, ssl_verify=False, key=None):
+    def __init__(self, vault_url, mount_point=None, path=None, role=None, kv_ver=1, ssl_verify=False, key=None,
+                 layout=LAYOUT_SINGLE):
         self.url = vault_url
         self.ssl_verify = ssl_verify
         if kv_ver not in [1, 2]:
             raise Exception("Invalid KV version (1 or 2)")
         self.kv_ver = kv_ver
+        if layout not in [self.LAYOUT_SINGLE, self.LAYOUT_PER_ALLOCATION]:
+            raise Exception(f"Invalid Vault layout ({self.LAYOUT_SINGLE} or {self.LAYOUT_PER_ALLOCATION})")
+        self.layout = layout
         self.role = role
         if vault_url == self.SECRETS_EGI:
             self.mount_point = "/secrets"
@@ -46,6 +102,12 @@ class AllocationStoreVault(AllocationStore):
         self.key = None
         if key:
             self.key = Fernet(key)
+        self._tokens = TTLCache(self.TOKEN_CACHE_SIZE, self.TOKEN_CACHE_TTL, on_remove=self._close_client)
+        metrics.register("vault_token_cache", self._tokens.stats)
+        self._allocations = TTLCache(self.CACHE_SIZE, self.CACHE_TTL)
+        metrics.register("vault_allocations_cache", self._allocations.stats)
+        self._login_locks = {}
+        self._lock = threading.Lock()
 
     def _encrypt(self, message):
         if self.key:
@@ -59,7 +121,45 @@ class AllocationStoreVault(AllocationStore):
         else:
             return message
 
+    @staticmethod
+    def _token_key(user_info) -> tuple:
+        return (user_info['sub'], TTLCache.hash_key(user_info['token']))
+
+    @staticmethod
+    def _close_client(value):
+        """Close the HTTP session of a KV client removed from the token cache"""
+        client, _ = value
+        try:
+            client._adapter.close()
+        except Exception:
+            logger.debug("Error closing the Vault client session", exc_info=True)
+
     def _login(self, user_info):
+        """Get the KV client and the secret path of the user, reusing the Vault token
+        of previous logins with the same OIDC token until its lease is about to expire"""
+        key = self._token_key(user_info)
+        res = self._tokens.get(key)
+        if res is not None:
+            return res
+        with self._lock:
+            lock = self._login_locks.setdefault(key, threading.Lock())
+        # concurrent requests of the same user wait for a single login
+        with lock:
+            try:
+                res = self._tokens.get(key)
+                if res is None:
+                    start = time.time()
+                    res, lease_duration = self._vault_login(user_info)
+                    expires = None
+                    if lease_duration:
+                        expires = start + lease_duration - self.TOKEN_REFRESH
+                    self._tokens.set(key, res, expires)
+                return res
+            finally:
+                with self._lock:
+                    self._login_locks.pop(key, None)
+
+    def _vault_login(self, user_info):
         login_url = self.url + '/v1/auth/jwt/login'
         token = user_info['token']
 
@@ -78,9 +178,7 @@ class AllocationStoreVault(AllocationStore):
         vault_auth_token = deserialized_response["auth"]["client_token"]
         vault_entity_id = deserialized_response["auth"]["entity_id"]
 
-        client = hvac.Client(url=self.url, token=vault_auth_token, verify=self.ssl_verify)
-        if not client.is_authenticated():
-            raise Exception(f"Error authenticating against Vault with token: {vault_auth_token}")
+        client = self._kv_client(vault_auth_token)
 
         path = self.path
         if path is None:
@@ -88,85 +186,257 @@ class AllocationStoreVault(AllocationStore):
         else:
             path = self.path.format(sub=user_info['sub'])
 
+        return (client, path), deserialized_response["auth"].get("lease_duration")
+
+    def _kv_client(self, vault_token):
+        client = hvac.Client(url=self.url, token=vault_token, verify=self.ssl_verify)
+        if not client.is_authenticated():
+            raise Exception(f"Error authenticating against Vault with token: {vault_token}")
+
         if self.kv_ver == 1:
-            return client.secrets.kv.v1, path
+            return client.secrets.kv.v1
         elif self.kv_ver == 2:
-            return client.secrets.kv.v2, path
+            return client.secrets.kv.v2
         raise Exception("Invalid KV version (1 or 2)")
 
-    def list_allocations(self, user_info: dict, from_: int, limit: int) -> List[dict]:
-        client, path = self._login(user_info)
+    def _read_secret(self, client, path) -> Tuple[dict, int]:
+        """Get the (encrypted) allocations stored in the secret and its version
+        (None in KV v1, 0 if the secret does not exist in KV v2)"""
+        try:
+            if self.kv_ver == 1:
+                return client.read_secret(path=path, mount_point=self.mount_point)["data"], None
+            res = client.read_secret_version(path=path, mount_point=self.mount_point, raise_on_deleted_version=True)
+            return res["data"]["data"], res["data"]["metadata"]["version"]
+        except hvac.exceptions.InvalidPath:
+            return {}, None if self.kv_ver == 1 else 0
 
+    def _list_keys(self, client, path) -> List[str]:
         try:
-            creds = client.read_secret(path=path, mount_point=self.mount_point)
-        except Exception:
-            creds = {}
+            return client.list_secrets(path=path, mount_point=self.mount_point)["data"]["keys"]
+        except hvac.exceptions.InvalidPath:
+            return []
 
+    def _secret_path(self, path: str, allocation_id: str) -> str:
+        """Get the path of the secret storing an allocation of the user path. In the
+        per allocation layout it stores a dict with the allocation, as the single one"""
+        if self.layout == self.LAYOUT_PER_ALLOCATION:
+            return f"{path}/{allocation_id}"
+        return path
+
+    def _delete_secret(self, client, path):
+        if self.kv_ver == 1:
+            response = client.delete_secret(path, mount_point=self.mount_point)
+        else:
+            response = client.delete_metadata_and_all_versions(path, mount_point=self.mount_point)
+        if not isinstance(response, dict):
+            response.raise_for_status()
+        self._allocations.delete(path)
+
+    def _read_version(self, client, path) -> int:
+        try:
+            return client.read_secret_metadata(path=path, mount_point=self.mount_point)["data"]["current_version"]
+        except hvac.exceptions.InvalidPath:
+            return 0
+
+    def _get_allocations(self, client, path, fresh: bool = False) -> dict:
+        """Get the cached allocations of the secret, reading them again if fresh is set, they have
+        changed (KV v2) or the cache entry has expired. Returns a dict with the version of the secret,
+        the raw (encrypted) allocations and the ones already decrypted (use _decode to get them)"""
+        entry = self._allocations.get(path)
+        if not fresh and entry is not None and (self.kv_ver == 1 or
+                                                self._read_version(client, path) == entry["version"]):
+            return entry
+        raw, version = self._read_secret(client, path)
+        entry = {"version": version, "raw": raw, "decrypted": {}}
+        self._allocations.set(path, entry)
+        return entry
+
+    def _decode(self, entry: dict, allocation_id: str) -> dict:
+        if allocation_id not in entry["raw"]:
+            return None
+        allocation = entry["decrypted"].get(allocation_id)
+        if allocation is None:
+            allocation = json.loads(self._decrypt(entry["raw"][allocation_id]))
+            entry["decrypted"][allocation_id] = allocation
+        # cached values must not be modified
+        return copy.deepcopy(allocation)
+
+    def _write_allocations(self, client, path, raw: dict, decrypted: dict, cas: int = None):
+        """Store the (encrypted) allocations in the secret and update the cache.
+        In KV v2 the write fails if the secret version is not cas (if set)"""
+        version = None
+        if self.kv_ver == 1:
+            if not raw:
+                self._delete_secret(client, path)
+                return
+            response = client.create_or_update_secret(path, raw, mount_point=self.mount_point)
+        else:
+            # the secret is not deleted if empty, as it cannot be done with check-and-set
+            response = client.create_or_update_secret(path, raw, cas=cas, mount_point=self.mount_point)
+        if isinstance(response, dict):
+            # KV v2 writes return the new version
+            version = response["data"]["version"]
+        else:
+            response.raise_for_status()
+        # an unknown KV v2 version will be read again
+        self._allocations.set(path, {"version": version, "raw": raw, "decrypted": decrypted})
+
+    @staticmethod
+    def _is_cas_conflict(ex: Exception) -> bool:
+        return isinstance(ex, hvac.exceptions.InvalidRequest) and "check-and-set" in str(ex)
+
+    def _update_allocations(self, client, path, update):
+        """Read-modify-write the allocations of the secret: update(entry) returns the new raw and
+        decrypted allocations (or None if there are no changes). In KV v2 the write is done with
+        check-and-set and repeated with the current allocations if they have been modified meanwhile"""
+        retries = 0
+        while True:
+            # KV v1 cached entries may be stale and there is no check-and-set to detect it,
+            # so they must not be written back
+            entry = self._get_allocations(client, path, fresh=self.kv_ver == 1)
+            res = update(entry)
+            if res is None:
+                return
+            try:
+                self._write_allocations(client, path, *res, cas=entry["version"])
+                return
+            except Exception as ex:
+                if not self._is_cas_conflict(ex) or retries >= self.CAS_RETRIES:
+                    raise
+                self._allocations.delete(path)
+                time.sleep(random.uniform(0, min(self.RETRY_MAX_SLEEP, self.RETRY_SLEEP * 2 ** retries)))
+                retries += 1
+
+    @_relogin
+    def list_allocations(self, user_info: dict, from_: int, limit: int,
+                         cursor: str = None, with_count: bool = True) -> Tuple[int, List[dict], str]:
+        last = decode_cursor(cursor, str) if cursor else None
+        client, path = self._login(user_info)
+        if self.layout == self.LAYOUT_PER_ALLOCATION:
+            # skip the subfolders
+            ids = [key for key in self._list_keys(client, path) if not key.endswith("/")]
+        else:
+            entry = self._get_allocations(client, path)
+            ids = list(entry["raw"])
+        count = len(ids)
+
+        # Sort them by id, as Vault does, to get a stable order for the cursors
+        ids.sort()
+        if last:
+            ids = [allocation_id for allocation_id in ids if allocation_id > last[0]]
+            from_ = 0
         data = []
-        for count, elem in enumerate(creds["data"].items()):
-            if from_ > count:
-                continue
-            allocation = {'id': elem[0], 'data': json.loads(self._decrypt(elem[1]))}
-            data.append(allocation)
-            if len(data) >= limit:
-                break
-        count = len(creds["data"].values())
+        for allocation_id in ids[from_:from_ + limit]:
+            if self.layout == self.LAYOUT_PER_ALLOCATION:
+                entry = self._get_allocations(client, self._secret_path(path, allocation_id))
+            allocation = self._decode(entry, allocation_id)
+            # it may have been deleted after listing it
+            if allocation is not None:
+                data.append({'id': allocation_id, 'data': allocation})
+        next_cursor = None
+        if data and from_ + limit < len(ids):
+            next_cursor = encode_cursor(data[-1]["id"])
 
-        return count, data
+        return count, data, next_cursor
 
+    @_relogin
     def get_allocation(self, allocation_id: str, user_info: dict) -> dict:
         client, path = self._login(user_info)
-        creds = client.read_secret(path=path, mount_point=self.mount_point)
-        if allocation_id in creds["data"]:
-            return json.loads(self._decrypt(creds["data"][allocation_id]))
-        else:
-            return None
+        return self._decode(self._get_allocations(client, self._secret_path(path, allocation_id)), allocation_id)
 
+    @_relogin
     def delete_allocation(self, allocation_id: str, user_info: dict = None):
         client, path = self._login(user_info)
+        if self.layout == self.LAYOUT_PER_ALLOCATION:
+            self._delete_secret(client, self._secret_path(path, allocation_id))
+            return
 
-        creds = client.read_secret(path=path, mount_point=self.mount_point)
-        if allocation_id in creds["data"]:
-            del creds["data"][allocation_id]
-            if creds["data"]:
-                response = client.create_or_update_secret(path,
-                                                          creds["data"],
-                                                          method="PUT",
-                                                          mount_point=self.mount_point)
-            else:
-                if self.kv_ver == 1:
-                    response = client.delete_secret(path,
-                                                    mount_point=self.mount_point)
-                else:
-                    response = client.delete_metadata_and_all_versions(path,
-                                                                       mount_point=self.mount_point)
-            response.raise_for_status()
+        def _delete(entry):
+            if allocation_id not in entry["raw"]:
+                return None
+            raw = {k: v for k, v in entry["raw"].items() if k != allocation_id}
+            decrypted = {k: v for k, v in entry["decrypted"].items() if k != allocation_id}
+            return raw, decrypted
+
+        self._update_allocations(client, path, _delete)
 
+    @_relogin
     def replace_allocation(self, data: dict, user_info: dict, allocation_id: str = None) -> str:
         client, path = self._login(user_info)
-        try:
-            creds = client.read_secret(path=path, mount_point=self.mount_point)
-        except Exception:
-            creds = None
 
         if allocation_id is None:
             allocation_id = str(uuid.uuid4())
 
-        if creds:
-            old_data = creds["data"]
-            if allocation_id in creds["data"]:
-                allocation_data = json.loads(self._decrypt(creds["data"][allocation_id]))
-                allocation_data.update(data)
-                creds["data"][allocation_id] = allocation_data
-            else:
-                old_data[allocation_id] = data
+        def _replace(entry):
+            allocation_data = self._decode(entry, allocation_id) or {}
+            allocation_data.update(data)
+            raw = dict(entry["raw"])
+            raw[allocation_id] = self._encrypt(json.dumps(allocation_data))
+            decrypted = dict(entry["decrypted"])
+            decrypted[allocation_id] = allocation_data
+            return raw, decrypted
+
+        self._update_allocations(client, self._secret_path(path, allocation_id), _replace)
+        return allocation_id
+
+    def get_user_paths(self, client) -> List[str]:
+        """Get the paths of all the users with allocations (it requires a token allowed to list them)"""
+        if self.path is None:
+            # the secrets (or folders) are named with the entity id of the users
+            return sorted({key.rstrip("/") for key in self._list_keys(client, "")})
+        if "{sub}" not in self.path:
+            return [self.path]
+        prefix, suffix = self.path.split("{sub}", 1)
+        return [prefix + key.rstrip("/") + suffix for key in self._list_keys(client, prefix) if key.endswith("/")]
+
+    def migrate_layout(self, client, path) -> int:
+        """Move the allocations of the single secret of a user path to one secret per allocation.
+        It can be repeated if it fails, as the single secret is deleted at the end.
+
+        Returns: the number of allocations moved
+        """
+        raw, version = self._read_secret(client, path)
+        for allocation_id, value in raw.items():
+            # the values are moved encrypted
+            self._write_allocations(client, f"{path}/{allocation_id}", {allocation_id: value}, {})
+        if raw or version:
+            self._delete_secret(client, path)
+        return len(raw)
+
+
+def main(argv=None) -> int:
+    """Move the allocations stored in Vault with the single layout to the per allocation one"""
+    parser = argparse.ArgumentParser(prog="python -m awm.utils.allocation_store_vault",
+                                     description="Move the allocations of the users stored in Vault "
+                                                 "to one secret per allocation")
+    parser.add_argument("--url", default=os.getenv("VAULT_URL", AllocationStoreVault.DEFAULT_URL))
+    parser.add_argument("--token", default=os.getenv("VAULT_TOKEN"),
+                        help="Vault token allowed to list and update the allocations of all the users")
+    parser.add_argument("--mount-point")
+    parser.add_argument("--path", help="path of the secret of each user, e.g. users/{sub}/allocations")
+    parser.add_argument("--kv-ver", type=int, default=1)
+    parser.add_argument("--sub", action="append",
+                        help="migrate only the allocations of this user (entity id if no path is set)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if not args.token:
+        parser.error("a Vault token is required (--token or VAULT_TOKEN)")
+
+    store = AllocationStoreVault(args.url, args.mount_point, args.path, kv_ver=args.kv_ver,
+                                 layout=AllocationStoreVault.LAYOUT_PER_ALLOCATION)
+    try:
+        client = store._kv_client(args.token)
+        if args.sub:
+            paths = [store.path.format(sub=sub) if store.path else sub for sub in args.sub]
         else:
-            old_data = {allocation_id: data}
+            paths = store.get_user_paths(client)
+        for path in paths:
+            logger.info("%d allocations moved from %s", store.migrate_layout(client, path), path)
+    except Exception:
+        logger.exception("Error migrating the Vault allocations")
+        return 1
+    return 0
 
-        old_data[allocation_id] = self._encrypt(json.dumps(old_data[allocation_id]))
-        response = client.create_or_update_secret(path,
-                                                  old_data,
-                                                  mount_point=self.mount_point)
 
-        response.raise_for_status()
-        return allocation_id
+if __name__ == "__main__":
+    sys.exit(main())
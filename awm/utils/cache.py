@@ -0,0 +1,132 @@
+#
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+
+class TTLCache():
+    """Thread safe LRU cache with a maximum size and per entry expiration time.
+    If maxbytes is set, the total size of the entries (set by the caller) is also bounded.
+    If on_remove is set, it is called with the values removed from the cache (evicted,
+    expired, deleted or replaced), e.g. to release their resources"""
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 300, maxbytes: int = 0, on_remove: Callable = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.on_remove = on_remove
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def hash_key(value: str) -> str:
+        """Return a key suitable to store sensitive values (e.g. tokens) in the cache"""
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+    def get(self, key, default=None):
+        """Get a value from the cache, returning `default` if it is not found or it has expired"""
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires, size = entry
+            if expires > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+            self._bytes -= size
+            self.misses += 1
+        self._removed([value])
+        return default
+
+    def _removed(self, values: list):
+        # out of the lock, as it may take some time
+        if self.on_remove:
+            for value in values:
+                self.on_remove(value)
+
+    def set(self, key, value, expires: float = None, size: int = 0):
+        """Store a value in the cache until the `expires` timestamp, or at most the cache TTL.
+        size is the number of bytes of the value, only used if maxbytes is set"""
+        now = time.time()
+        max_expires = now + self.ttl
+        if expires is None or expires > max_expires:
+            expires = max_expires
+        if expires <= now or self.maxsize <= 0 or (self.maxbytes and size > self.maxbytes):
+            self.delete(key)
+            return False
+        removed = []
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+                if old[0] is not value:
+                    removed.append(old[0])
+            self._data[key] = (value, expires, size)
+            self._bytes += size
+            while len(self._data) > self.maxsize or (self.maxbytes and self._bytes > self.maxbytes):
+                evicted = self._data.popitem(last=False)[1]
+                self._bytes -= evicted[2]
+                removed.append(evicted[0])
+                self.evictions += 1
+        self._removed(removed)
+        return True
+
+    def delete(self, key):
+        """Remove a value from the cache"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return False
+            self._bytes -= entry[2]
+        self._removed([entry[0]])
+        return True
+
+    def clear(self):
+        """Remove all the values and reset the counters"""
+        with self._lock:
+            removed = [entry[0] for entry in self._data.values()]
+            self._data.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+        self._removed(removed)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """Return the usage counters of the cache"""
+        with self._lock:
+            res = {"size": len(self._data),
+                   "maxsize": self.maxsize,
+                   "hits": self.hits,
+                   "misses": self.misses,
+                   "evictions": self.evictions}
+            if self.maxbytes:
+                res.update({"bytes": self._bytes, "maxbytes": self.maxbytes})
+            return res
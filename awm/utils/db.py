@@ -14,8 +14,20 @@
 # limitations under the License.
 
 """Class to manage DB operations"""
+import os
+import re
+import json
 import time
+import random
+import hashlib
+import logging
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
 from urllib.parse import urlparse
+from awm.utils import metrics
+from awm.utils.cache import TTLCache
 
 try:
     import sqlite3 as sqlite
@@ -46,28 +58,236 @@ if not MYSQL_AVAILABLE:
         MYSQL_AVAILABLE = False
 
 try:
-    from pymongo import MongoClient
+    from pymongo import MongoClient, ReplaceOne
     MONGO_AVAILABLE = True
 except Exception:
     MONGO_AVAILABLE = False
 
+logger = logging.getLogger(__name__)
+
+_SQL_SPACES = re.compile(r"\s+")
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s|\?")
+_SQL_LISTS = re.compile(r"\(\?(?:, ?\?)+\)")
+
+
+@functools.lru_cache(maxsize=1024)
+def sql_fingerprint(sql: str) -> str:
+    """Normalise a SQL sentence to group its executions: literals and parameters are replaced by ?"""
+    sql = _SQL_LITERALS.sub("?", _SQL_SPACES.sub(" ", sql.strip()))
+    return _SQL_LISTS.sub("(...)", sql)
+
+
+def _mongo_shape(value):
+    if isinstance(value, dict):
+        return {k: _mongo_shape(v) for k, v in value.items()}
+    if isinstance(value, list) and any(isinstance(v, dict) for v in value):
+        return [_mongo_shape(v) for v in value]
+    return "?"
+
+
+def mongo_fingerprint(operation: str, table_name: str, filt: dict = None) -> str:
+    """Normalise a MongoDB operation to group its executions: filter values are replaced by ?"""
+    if filt is None:
+        return f"{operation} {table_name}"
+    return f"{operation} {table_name} {json.dumps(_mongo_shape(filt), sort_keys=True)}"
+
+
+class ConnectionPool:
+    """Pool of DB connections of the same DB, shared by all the threads of the process"""
+
+    def __init__(self, connect, check, min_size=0, max_size=10, idle_timeout=300,
+                 check_interval=30, wait_timeout=30):
+        """
+            Arguments:
+            - connect: Function that returns a new connection.
+            - check: Function that raises an Exception if a connection is not usable.
+            - min_size: Number of idle connections kept open.
+            - max_size: Maximum number of connections open at the same time.
+            - idle_timeout: Time (in secs) after which idle connections (over min_size) are closed.
+            - check_interval: Idle time (in secs) after which connections are checked before reusing them.
+            - wait_timeout: Max time (in secs) to wait for a free connection.
+        """
+        self._connect = connect
+        self._check = check
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.wait_timeout = wait_timeout
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        for _ in range(min(min_size, self.max_size)):
+            self._idle.append((connect(), time.time()))
+            self._size += 1
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _discard(self, conn):
+        self._close(conn)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _close_expired(self, now):
+        """Close the idle connections over min_size not used in the last idle_timeout secs"""
+        while len(self._idle) > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            self._close(conn)
+
+    def acquire(self):
+        """Get a connection from the pool, opening a new one if needed"""
+        deadline = time.time() + self.wait_timeout
+        while True:
+            with self._cond:
+                now = time.time()
+                self._close_expired(now)
+                if self._idle:
+                    # Use the most recently used one
+                    conn, last_used = self._idle.pop()
+                elif self._size < self.max_size:
+                    conn, last_used = None, None
+                    self._size += 1
+                else:
+                    if not self._cond.wait(deadline - now) and time.time() >= deadline:
+                        raise Exception("Timeout waiting for a free DB connection")
+                    continue
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            if now - last_used < self.check_interval:
+                return conn
+            try:
+                self._check(conn)
+                return conn
+            except Exception:
+                logger.info("Discarding broken DB connection")
+                self._discard(conn)
+
+    def release(self, conn):
+        """Return a connection to the pool"""
+        try:
+            # Finish any pending transaction
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def close(self):
+        """Close all the idle connections"""
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                self._size -= 1
+                self._close(conn)
+
 
 # Class to manage DB operations
 class DataBase:
     """Class to manage DB operations"""
 
     db_available = SQLITE_AVAILABLE or MYSQL_AVAILABLE or MONGO_AVAILABLE
-    RETRY_SLEEP = 2
+    # Exponential backoff (with jitter) retrying operations in a locked DB
+    RETRY_SLEEP = 0.05
+    RETRY_MAX_SLEEP = 1
     MAX_RETRIES = 15
+    # Max secs retrying an operation in a locked DB, besides the SQLite busy_timeout
+    RETRY_TIMEOUT = float(os.getenv("DB_RETRY_TIMEOUT", "5"))
     MONGO = "MONGO"
     MYSQL = "MySQL"
     SQLITE = "SQLite"
     DB_TYPES = [MYSQL, SQLITE]
 
-    def __init__(self, db_url):
+    POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "0"))
+    POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+    POOL_IDLE_TIMEOUT = int(os.getenv("DB_POOL_IDLE_TIMEOUT", "300"))
+    POOL_CHECK_INTERVAL = int(os.getenv("DB_POOL_CHECK_INTERVAL", "30"))
+    POOL_WAIT_TIMEOUT = int(os.getenv("DB_POOL_WAIT_TIMEOUT", "30"))
+    # PRAGMAs set in the SQLite connections (set an empty value to skip one)
+    SQLITE_PRAGMAS = {
+        "journal_mode": os.getenv("DB_SQLITE_JOURNAL_MODE", "WAL"),
+        "synchronous": os.getenv("DB_SQLITE_SYNCHRONOUS", "NORMAL"),
+        "busy_timeout": os.getenv("DB_SQLITE_BUSY_TIMEOUT", "5000"),
+        "cache_size": os.getenv("DB_SQLITE_CACHE_SIZE", "-16000"),
+        "mmap_size": os.getenv("DB_SQLITE_MMAP_SIZE", "268435456"),
+    }
+    # Operations slower than this (in secs) are logged (0 to disable it)
+    SLOW_QUERY_TIME = float(os.getenv("DB_SLOW_QUERY_TIME", "1"))
+    # Max number of different statements with metrics, the rest are grouped as "other"
+    MAX_QUERY_FINGERPRINTS = 1000
+    # Secs after a write of an owner in which its reads are sent to the primary DB.
+    # The writes are tracked per process, so reads served by other workers may not see them
+    READ_YOUR_WRITES = float(os.getenv("DB_READ_YOUR_WRITES", "5"))
+    # Connection pools (or MongoClients) of each DB URL
+    _pools = {}
+    _pools_lock = threading.Lock()
+    _stats = {"lock_retries": 0, "lock_wait_time": 0.0, "replica_reads": 0, "primary_reads": 0}
+    _stats_lock = threading.Lock()
+    # Metrics of each statement, indexed by (backend, fingerprint)
+    _queries = {}
+    # Owners that have written recently (in this process)
+    _recent_writes = TTLCache(100000, READ_YOUR_WRITES)
+
+    def __init__(self, db_url, read_urls=None, owner=None):
+        """ Arguments:
+            - db_url: URL of the (primary) DB, or list of URLs of the DB shards,
+                      the one of the owner is used
+            - read_urls: URL or list of URLs (or whitespace separated string) of the read replicas
+                         used in select and find operations (Optional, default None).
+                         They are not used with several shards.
+            - owner: user whose operations are done, to read its own writes from the primary DB
+                     and to select its shard (Optional, default None, required with several shards)
+        """
+        if isinstance(db_url, (list, tuple)):
+            self.shard_urls = list(db_url)
+            if len(self.shard_urls) > 1:
+                if owner is None:
+                    raise Exception("The owner is required to use a sharded DB")
+                db_url = DataBase.get_shard(self.shard_urls, owner)
+                read_urls = None
+            else:
+                db_url = self.shard_urls[0]
+        else:
+            self.shard_urls = [db_url]
         self.db_url = db_url
         self.connection = None
         self.db_type = None
+        self._pool = None
+        self.read_urls = DataBase.split_urls(read_urls)
+        self.owner = owner
+        self._replica = None
+        self._written = False
+
+    @staticmethod
+    def split_urls(urls) -> list:
+        """ Get the list of URLs of a list or a whitespace separated string (commas
+        cannot be used, as they appear in the MongoDB URLs with several hosts) """
+        if not urls:
+            return []
+        if isinstance(urls, str):
+            urls = urls.split()
+        return [url.strip() for url in urls if url.strip()]
+
+    @staticmethod
+    def get_shard(db_urls: list, owner: str) -> str:
+        """ Get the URL of the shard of an owner, using rendezvous hashing: adding or
+        removing a shard only moves the owners that belong to it """
+        return max(db_urls, key=lambda url: hashlib.sha256(f"{url}\n{owner}".encode("utf-8")).digest())
 
     def connect(self):
         """ Function to connect to the DB
@@ -109,9 +329,41 @@ class DataBase:
 
         return username, password, server, port
 
+    def _get_pool(self, create):
+        """Get the pool of connections of the DB URL, creating it if needed"""
+        with DataBase._pools_lock:
+            if self.db_url not in DataBase._pools:
+                DataBase._pools[self.db_url] = create()
+            return DataBase._pools[self.db_url]
+
+    @staticmethod
+    def _check_connection(conn):
+        if hasattr(conn, "ping"):
+            conn.ping()
+        else:
+            conn.execute("SELECT 1")
+
+    def _new_pool(self, connect):
+        return ConnectionPool(connect, self._check_connection, self.POOL_MIN_SIZE, self.POOL_MAX_SIZE,
+                              self.POOL_IDLE_TIMEOUT, self.POOL_CHECK_INTERVAL, self.POOL_WAIT_TIMEOUT)
+
+    def _acquire(self, db_type, connect):
+        self._pool = self._get_pool(lambda: self._new_pool(connect))
+        try:
+            self.connection = self._pool.acquire()
+        except Exception:
+            logger.exception("Error getting a connection to the DB")
+            self.connection = None
+            return False
+        self.db_type = db_type
+        return True
+
     def _connect_mongo(self, url, db):
         if MONGO_AVAILABLE:
-            client = MongoClient(url)
+            # MongoClient manages its own pool of connections
+            client = self._get_pool(lambda: MongoClient(url, minPoolSize=self.POOL_MIN_SIZE,
+                                                        maxPoolSize=self.POOL_MAX_SIZE,
+                                                        maxIdleTimeMS=self.POOL_IDLE_TIMEOUT * 1000))
             self.connection = client[db]
             self.db_type = DataBase.MONGO
             return True
@@ -123,21 +375,31 @@ class DataBase:
             username, password, server, port = self._get_user_pass_host_port(url)
             if not port:
                 port = 3306
-            self.connection = mdb.connect(server, username, password, db, port)
-            self.db_type = DataBase.MYSQL
-            return True
+            return self._acquire(DataBase.MYSQL, lambda: mdb.connect(server, username, password, db, port))
         else:
             return False
 
+    @staticmethod
+    def _new_sqlite_connection(db_filename):
+        # Connections are shared among threads (but not used concurrently)
+        conn = sqlite.connect(db_filename, check_same_thread=False)
+        for pragma, value in DataBase.SQLITE_PRAGMAS.items():
+            if value:
+                conn.execute(f"PRAGMA {pragma}={value}")
+        return conn
+
     def _connect_sqlite(self, db_filename):
         if SQLITE_AVAILABLE:
-            self.connection = sqlite.connect(db_filename)
-            self.db_type = DataBase.SQLITE
-            return True
+            return self._acquire(DataBase.SQLITE, lambda: self._new_sqlite_connection(db_filename))
         else:
             return False
 
-    def _execute_retry(self, sql, args, fetch=False):
+    def _execute(self, sql, args, fetch=False, many=False):
+        """ Function to execute a SQL function with _execute_retry, recording its metrics """
+        with self._measure(sql_fingerprint(sql)) as stats:
+            return self._execute_retry(sql, args, fetch, many, stats)
+
+    def _execute_retry(self, sql, args, fetch=False, many=False, stats=None):
         """ Function to execute a SQL function, retrying in case of locked DB
 
             Arguments:
@@ -145,16 +407,29 @@ class DataBase:
             - args: A List of arguments to substitute in the SQL sentence
             - fetch: If the function must fetch the results.
                     (Optional, default False)
+            - many: If args is a list of argument lists to execute the sentence
+                    with each of them in the same transaction.
+                    (Optional, default False)
+            - stats: dict where the number of rows and retries are set.
+                    (Optional, default None)
 
             Returns: True if fetch is False and the operation is performed
-                     correctly or a list with the "Fetch" of the results
+                     correctly, the number of affected rows if many is True
+                     or a list with the "Fetch" of the results
         """
 
+        if stats is None:
+            stats = {}
         if self.connection is None:
             raise Exception("DataBase object not connected")
         else:
             retries_cont = 0
-            while retries_cont < self.MAX_RETRIES:
+            # each attempt may wait busy_timeout for the lock, so the total wait is bounded by
+            # the busy_timeout and the retry timeout
+            busy_timeout = float(self.SQLITE_PRAGMAS.get("busy_timeout") or 0) / 1000
+            deadline = time.time() + busy_timeout + self.RETRY_TIMEOUT
+            while True:
+                attempt_start = time.time()
                 try:
                     cursor = self.connection.cursor()
                     if args is not None:
@@ -162,29 +437,125 @@ class DataBase:
                             new_sql = sql.replace("%s", "?").replace("now()", "date('now')")
                         elif self.db_type == DataBase.MYSQL:
                             new_sql = sql.replace("?", "%s")
-                        cursor.execute(new_sql, args)
+                        if many:
+                            cursor.executemany(new_sql, args)
+                        else:
+                            cursor.execute(new_sql, args)
                     else:
                         cursor.execute(sql)
 
                     if fetch:
                         res = list(cursor.fetchall())
+                        stats["rows"] = len(res)
                     else:
                         self.connection.commit()
-                        res = True
+                        stats["rows"] = max(cursor.rowcount, 0)
+                        res = cursor.rowcount if many else True
                     return res
                 # If the operational error is db lock, retry
                 except sqlite.OperationalError as ex:
                     if str(ex).lower() == 'database is locked':
+                        # finish the failed transaction, keeping the connection
+                        self.connection.rollback()
+                        sleep = random.uniform(0, min(self.RETRY_MAX_SLEEP, self.RETRY_SLEEP * 2 ** retries_cont))
+                        if retries_cont >= self.MAX_RETRIES or time.time() + sleep + busy_timeout > deadline:
+                            logger.error("Giving up after %d retries in a locked DB: %s", retries_cont,
+                                         sql_fingerprint(sql))
+                            raise ex
                         retries_cont += 1
-                        # release the connection
-                        self.close()
-                        time.sleep(self.RETRY_SLEEP)
-                        # and get it again
-                        self.connect()
+                        stats["retries"] = retries_cont
+                        time.sleep(sleep)
+                        # time waiting for the lock (busy_timeout) and sleeping
+                        DataBase._add_stats(lock_retries=1, lock_wait_time=time.time() - attempt_start)
                     else:
+                        self.connection.rollback()
                         raise ex
                 except sqlite.IntegrityError:
+                    # do not leave a partially applied batch in the transaction
+                    self.connection.rollback()
                     raise IntegrityError()
+                except Exception:
+                    self.connection.rollback()
+                    raise
+
+    @contextmanager
+    def _measure(self, fingerprint: str):
+        """Record the time of an operation, and the rows and retries set in the yielded dict"""
+        stats = {"rows": 0, "retries": 0}
+        start = time.time()
+        error = True
+        try:
+            yield stats
+            error = False
+        finally:
+            DataBase._record_query(self.db_type, fingerprint, time.time() - start, error=error, **stats)
+
+    @staticmethod
+    def _record_query(db_type: str, fingerprint: str, elapsed: float, rows: int = 0, retries: int = 0,
+                      error: bool = False):
+        slow = 0 < DataBase.SLOW_QUERY_TIME <= elapsed
+        if slow:
+            logger.warning("Slow %s operation (%.3f secs, %d rows, %d retries): %s",
+                           db_type, elapsed, rows, retries, fingerprint)
+        with DataBase._stats_lock:
+            stats = DataBase._queries.get((db_type, fingerprint))
+            if stats is None:
+                if len(DataBase._queries) >= DataBase.MAX_QUERY_FINGERPRINTS:
+                    fingerprint = "other"
+                stats = DataBase._queries.setdefault((db_type, fingerprint), {
+                    "latency": metrics.Histogram(), "calls": 0, "rows": 0, "retries": 0, "errors": 0, "slow": 0})
+            stats["calls"] += 1
+            stats["rows"] += rows
+            stats["retries"] += retries
+            stats["errors"] += int(error)
+            stats["slow"] += int(slow)
+        stats["latency"].observe(elapsed)
+
+    @staticmethod
+    def query_stats() -> dict:
+        """ Returns the metrics of each statement, grouped by backend """
+        with DataBase._stats_lock:
+            queries = [(key, dict(stats)) for key, stats in DataBase._queries.items()]
+        res = {}
+        for (db_type, fingerprint), stats in queries:
+            stats["latency"] = stats["latency"].snapshot()
+            res.setdefault(db_type, {})[fingerprint] = stats
+        return res
+
+    def _mark_write(self):
+        """Send the next reads of this object and its owner to the primary DB"""
+        self._written = True
+        if self.owner and self.read_urls:
+            DataBase._recent_writes.set(self.owner, True)
+
+    def _reader(self):
+        """Get the DataBase object to read from: a replica or this one"""
+        if not self.read_urls:
+            return self
+        if self._written or (self.owner and DataBase._recent_writes.get(self.owner)):
+            DataBase._add_stats(primary_reads=1)
+            return self
+        if self._replica is None:
+            replica = DataBase(random.choice(self.read_urls))
+            if not replica.connect():
+                logger.warning("Error connecting to the DB read replica, using the primary one")
+                DataBase._add_stats(primary_reads=1)
+                return self
+            self._replica = replica
+        DataBase._add_stats(replica_reads=1)
+        return self._replica
+
+    @staticmethod
+    def _add_stats(**values):
+        with DataBase._stats_lock:
+            for name, value in values.items():
+                DataBase._stats[name] = DataBase._stats.get(name, 0) + value
+
+    @staticmethod
+    def stats() -> dict:
+        """ Returns the DB usage metrics """
+        with DataBase._stats_lock:
+            return dict(DataBase._stats)
 
     def execute(self, sql, args=None):
         """ Executes a SQL sentence without returning results
@@ -198,7 +569,26 @@ class DataBase:
         """
         if self.db_type == DataBase.MONGO:
             raise Exception("Operation not supported in MongoDB")
-        return self._execute_retry(sql, args)
+        self._mark_write()
+        return self._execute(sql, args)
+
+    def execute_many(self, sql, args_list):
+        """ Executes a SQL sentence with each of the arguments in a single transaction
+
+            Arguments:
+            - sql: The SQL sentence
+            - args_list: A List of argument lists to substitute in the SQL sentence
+
+            Returns: The number of rows affected, as counted by the DB backend
+                     (e.g. MySQL counts 2 for each row replaced by a REPLACE)
+        """
+        if self.db_type == DataBase.MONGO:
+            raise Exception("Operation not supported in MongoDB")
+        args_list = list(args_list)
+        if not args_list:
+            return 0
+        self._mark_write()
+        return self._execute(sql, args_list, many=True)
 
     def select(self, sql, args=None):
         """ Executes a SQL sentence that returns results
@@ -212,22 +602,48 @@ class DataBase:
         """
         if self.db_type == DataBase.MONGO:
             raise Exception("Operation not supported in MongoDB")
-        return self._execute_retry(sql, args, fetch=True)
+        reader = self._reader()
+        if reader is not self:
+            return reader.select(sql, args)
+        return self._execute(sql, args, fetch=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # return the connection to the pool even if the operations fail
+        self.close()
+        return False
 
     def close(self):
-        """ Closes the DB connection """
+        """ Returns the DB connection to the pool """
+        if self._replica is not None:
+            self._replica.close()
+            self._replica = None
         if self.connection is None:
             return False
         else:
             try:
-                if self.db_type == DataBase.MONGO:
-                    self.connection.client.close()
-                else:
-                    self.connection.close()
+                # MongoClients are kept open and shared
+                if self.db_type != DataBase.MONGO:
+                    self._pool.release(self.connection)
+                    self.connection = None
                 return True
             except Exception:
                 return False
 
+    @staticmethod
+    def close_all():
+        """ Closes all the pooled DB connections """
+        with DataBase._pools_lock:
+            pools = list(DataBase._pools.values())
+            DataBase._pools.clear()
+        for pool in pools:
+            try:
+                pool.close()
+            except Exception:
+                logger.exception("Error closing DB connections")
+
     def table_exists(self, table_name):
         """ Checks if a table exists in the DB
 
@@ -253,17 +669,50 @@ class DataBase:
         else:
             return True
 
-    def find(self, table_name, filt=None, projection=None, sort=None):
+    def find(self, table_name, filt=None, projection=None, sort=None, skip=0, limit=0):
         """ find elements """
         if self.db_type != DataBase.MONGO:
             raise Exception("Operation only supported in MongoDB")
 
         if self.connection is None:
             raise Exception("DataBase object not connected")
+        reader = self._reader()
+        if reader is not self:
+            return reader.find(table_name, filt, projection, sort, skip, limit)
         else:
             if projection:
                 projection.update({'_id': False})
-            return list(self.connection[table_name].find(filt, projection, sort=sort))
+            with self._measure(mongo_fingerprint("find", table_name, filt)) as stats:
+                res = list(self.connection[table_name].find(filt, projection, sort=sort, skip=skip, limit=limit))
+                stats["rows"] = len(res)
+            return res
+
+    def find_page(self, table_name, filt, projection=None, sort=None, skip=0, limit=0, seek=None, with_total=True):
+        """ find a page of elements and, if with_total is set, the total number of elements
+        that match filt (None otherwise). seek is an additional filter applied only to the page.
+        The total is got with a second count query (two round trips), instead of a single $facet
+        aggregation, so the page query uses the indexes with the seek filter and the total is
+        only counted when requested (withCount=false in the lists avoids the second one) """
+        if self.db_type != DataBase.MONGO:
+            raise Exception("Operation only supported in MongoDB")
+
+        if self.connection is None:
+            raise Exception("DataBase object not connected")
+        reader = self._reader()
+        if reader is not self:
+            return reader.find_page(table_name, filt, projection, sort, skip, limit, seek, with_total)
+        else:
+            # the seek filter is in the same query, so the index is used to get the page
+            page_filt = {"$and": [filt, seek]} if seek else filt
+            with self._measure(mongo_fingerprint("find_page", table_name, {"filter": filt, "seek": seek})) as stats:
+                res = list(self.connection[table_name].find(page_filt, dict(projection or {}, _id=False),
+                                                            sort=sort, skip=skip, limit=limit))
+                stats["rows"] = len(res)
+            total = None
+            if with_total:
+                with self._measure(mongo_fingerprint("count", table_name, filt)):
+                    total = self.connection[table_name].count_documents(filt)
+            return res, total
 
     def replace(self, table_name, filt, replacement):
         """ insert/replace elements """
@@ -273,10 +722,48 @@ class DataBase:
         if self.connection is None:
             raise Exception("DataBase object not connected")
         else:
-            res = self.connection[table_name].replace_one(filt, replacement, True)
+            self._mark_write()
+            with self._measure(mongo_fingerprint("replace", table_name, filt)) as stats:
+                res = self.connection[table_name].replace_one(filt, replacement, True)
+                stats["rows"] = res.modified_count + int(res.upserted_id is not None)
             return res.modified_count == 1 or res.upserted_id is not None
 
-    def update(self, table_name, filt, updates):
+    def bulk_replace(self, table_name, elements, key="id"):
+        """ insert/replace a list of elements (dicts with the same fields) in a
+        single transaction (or bulk_write in MongoDB), matching them by the key field.
+        Returns the number of elements stored, whether they have changed or not """
+        elements = list(elements)
+        if not elements:
+            return 0
+        if self.connection is None:
+            raise Exception("DataBase object not connected")
+        if self.db_type == DataBase.MONGO:
+            self._mark_write()
+            with self._measure(mongo_fingerprint("bulk_replace", table_name)) as stats:
+                res = self.connection[table_name].bulk_write([ReplaceOne({key: elem[key]}, elem, upsert=True)
+                                                              for elem in elements], ordered=False)
+                stats["rows"] = res.matched_count + res.upserted_count
+            return stats["rows"]
+        columns = list(elements[0].keys())
+        sql = (f"replace into {table_name} ({', '.join(columns)}) "
+               f"values ({', '.join(['%s'] * len(columns))})")
+        # the rowcount of REPLACE depends on the backend, but every element is stored
+        self.execute_many(sql, [tuple(elem[col] for col in columns) for elem in elements])
+        return len(elements)
+
+    def bulk_delete(self, table_name, values, key="id"):
+        """ delete the elements with any of the values in the key field in a single
+        transaction (or request in MongoDB). Returns the number of elements deleted """
+        values = list(values)
+        if not values:
+            return 0
+        if self.connection is None:
+            raise Exception("DataBase object not connected")
+        if self.db_type == DataBase.MONGO:
+            return self.delete(table_name, {key: {"$in": values}})
+        return self.execute_many(f"DELETE FROM {table_name} WHERE {key} = %s", [(value,) for value in values])
+
+    def update(self, table_name, filt, updates, upsert=True):
         """ insert/replace elements """
         if self.db_type != DataBase.MONGO:
             raise Exception("Operation only supported in MongoDB")
@@ -284,7 +771,10 @@ class DataBase:
         if self.connection is None:
             raise Exception("DataBase object not connected")
         else:
-            res = self.connection[table_name].update_one(filt, updates, True)
+            self._mark_write()
+            with self._measure(mongo_fingerprint("update", table_name, filt)) as stats:
+                res = self.connection[table_name].update_one(filt, updates, upsert)
+                stats["rows"] = res.modified_count + int(res.upserted_id is not None)
             return res.modified_count == 1 or res.upserted_id is not None
 
     def delete(self, table_name, filt):
@@ -295,7 +785,14 @@ class DataBase:
         if self.connection is None:
             raise Exception("DataBase object not connected")
         else:
-            return self.connection[table_name].delete_many(filt).deleted_count
+            self._mark_write()
+            with self._measure(mongo_fingerprint("delete", table_name, filt)) as stats:
+                stats["rows"] = self.connection[table_name].delete_many(filt).deleted_count
+            return stats["rows"]
+
+
+metrics.register("db", DataBase.stats)
+metrics.register("db_queries", DataBase.query_stats)
 
 
 try:
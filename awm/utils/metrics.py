@@ -0,0 +1,77 @@
+#
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In process registry of the internal metrics exported by the service"""
+import logging
+import threading
+from typing import Callable
+
+
+logger = logging.getLogger(__name__)
+_collectors = {}
+
+
+class Histogram():
+    """Thread safe histogram of observed values (e.g. latencies in secs) with cumulative buckets"""
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+            else:
+                self._counts[-1] += 1
+            self._sum += value
+
+    def snapshot(self) -> dict:
+        """Return the cumulative count of each bucket, the number of values and their sum"""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        res = {}
+        acc = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+            acc += count
+            res[str(bound)] = acc
+        return {"buckets": res, "count": acc, "sum": total}
+
+
+def register(name: str, collector: Callable[[], dict]):
+    """Register a function returning the current values of a set of metrics"""
+    _collectors[name] = collector
+
+
+def unregister(name: str):
+    _collectors.pop(name, None)
+
+
+def collect() -> dict:
+    """Return the current values of all the registered metrics"""
+    res = {}
+    for name, collector in list(_collectors.items()):
+        try:
+            res[name] = collector()
+        except Exception:
+            logger.exception("Error collecting metrics of %s", name)
+    return res
@@ -0,0 +1,217 @@
+#
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Versioned schema migrations of the AWM DB"""
+import json
+import time
+import logging
+import threading
+from awm.utils.db import DataBase
+
+
+logger = logging.getLogger(__name__)
+
+# Registered migrations: list of (version, description, function)
+MIGRATIONS = []
+# DB URLs already migrated by this process
+_applied = set()
+_lock = threading.Lock()
+
+
+def migration(version: int, description: str):
+    """Decorator to register a function as the migration to a schema version.
+    Migrations must be idempotent, as several processes may apply them at the same time."""
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+
+def _create_table(db: DataBase, name: str, mysql_columns: str, sqlite_columns: str):
+    if db.db_type == DataBase.MYSQL:
+        db.execute(f"CREATE TABLE IF NOT EXISTS {name} ({mysql_columns})")
+    elif db.db_type == DataBase.SQLITE:
+        db.execute(f"CREATE TABLE IF NOT EXISTS {name} ({sqlite_columns})")
+    elif db.db_type == DataBase.MONGO:
+        if name not in db.connection.list_collection_names():
+            db.connection.create_collection(name)
+
+
+def _create_index(db: DataBase, table: str, name: str, columns: list):
+    """Create an index, columns is a list of (column, direction) (only used in MongoDB)"""
+    if db.db_type == DataBase.MONGO:
+        db.connection[table].create_index(columns, name=name)
+        return
+    if db.db_type == DataBase.MYSQL:
+        # MySQL does not support CREATE INDEX IF NOT EXISTS
+        res = db.select("SELECT index_name FROM information_schema.statistics WHERE table_schema = DATABASE() "
+                        "and table_name = %s and index_name = %s", (table, name))
+        if res:
+            return
+        sql = "CREATE INDEX"
+    else:
+        sql = "CREATE INDEX IF NOT EXISTS"
+    db.execute(f"{sql} {name} ON {table} ({', '.join(col for col, _ in columns)})")
+
+
+def _add_column(db: DataBase, table: str, name: str, definition: str):
+    """Add a column to a SQL table if it does not exist"""
+    if db.db_type == DataBase.MYSQL:
+        res = db.select("SELECT column_name FROM information_schema.columns WHERE table_schema = DATABASE() "
+                        "and table_name = %s and column_name = %s", (table, name))
+    else:
+        res = [row for row in db.select(f"PRAGMA table_info({table})") if row[1] == name]
+    if not res:
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def _drop_index(db: DataBase, table: str, name: str):
+    if db.db_type == DataBase.MONGO:
+        if name in db.connection[table].index_information():
+            db.connection[table].drop_index(name)
+    elif db.db_type == DataBase.MYSQL:
+        res = db.select("SELECT index_name FROM information_schema.statistics WHERE table_schema = DATABASE() "
+                        "and table_name = %s and index_name = %s", (table, name))
+        if res:
+            db.execute(f"DROP INDEX {name} ON {table}")
+    else:
+        db.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+@migration(1, "Create deployments and allocations tables")
+def _create_tables(db: DataBase):
+    for table in ["deployments", "allocations"]:
+        _create_table(db, table,
+                      "id VARCHAR(255) PRIMARY KEY, data TEXT, owner VARCHAR(255), created TIMESTAMP",
+                      "id TEXT PRIMARY KEY, data TEXT, owner VARCHAR(255), created TIMESTAMP")
+        if db.db_type == DataBase.MONGO:
+            db.connection[table].create_index([("id", 1), ("owner", 1)], unique=True)
+
+
+@migration(2, "Add (owner, created) indexes to list deployments and allocations")
+def _add_owner_created_indexes(db: DataBase):
+    for table in ["deployments", "allocations"]:
+        _create_index(db, table, f"{table}_owner_created", [("owner", 1), ("created", -1)])
+
+
+@migration(3, "Add id to the (owner, created) indexes to paginate with cursors")
+def _add_id_to_owner_created_indexes(db: DataBase):
+    for table in ["deployments", "allocations"]:
+        _create_index(db, table, f"{table}_owner_created_id", [("owner", 1), ("created", -1), ("id", -1)])
+        _drop_index(db, table, f"{table}_owner_created")
+
+
+def _deployment_columns(data) -> dict:
+    """Get the values of the deployments columns that are copied from the deployment info (JSON or dict)"""
+    if isinstance(data, str):
+        data = json.loads(data)
+    deployment = data.get("deployment", {})
+    return {"status": data.get("status"),
+            "tool_id": deployment.get("tool", {}).get("id"),
+            "allocation_id": deployment.get("allocation", {}).get("id")}
+
+
+def _fill_deployment_columns(db: DataBase):
+    """Copy the status, tool and allocation of the deployments stored without them to their columns"""
+    if db.db_type == DataBase.MONGO:
+        for elem in db.find("deployments", {"status": {"$exists": False}}, {"id": True, "data": True}):
+            db.update("deployments", {"id": elem["id"]}, {"$set": _deployment_columns(elem["data"])}, upsert=False)
+        return
+    updates = []
+    for dep_id, data in db.select("SELECT id, data FROM deployments WHERE status is NULL"):
+        try:
+            columns = _deployment_columns(data)
+        except Exception:
+            logger.exception("Invalid data in deployment %s", dep_id)
+            continue
+        updates.append((columns["status"], columns["tool_id"], columns["allocation_id"], dep_id))
+    # in a single transaction
+    db.execute_many("UPDATE deployments SET status = %s, tool_id = %s, allocation_id = %s WHERE id = %s",
+                    updates)
+
+
+@migration(4, "Store the status, tool and allocation of the deployments in indexed columns")
+def _add_deployment_columns(db: DataBase):
+    if db.db_type != DataBase.MONGO:
+        _add_column(db, "deployments", "status", "VARCHAR(32)")
+        _add_column(db, "deployments", "tool_id", "VARCHAR(255)")
+        _add_column(db, "deployments", "allocation_id", "VARCHAR(255)")
+    _fill_deployment_columns(db)
+    for column in ["status", "tool_id", "allocation_id"]:
+        _create_index(db, "deployments", f"deployments_owner_{column}_created_id",
+                      [("owner", 1), (column, 1), ("created", -1), ("id", -1)])
+
+
+def _get_version(db: DataBase) -> int:
+    """Get the current schema version, creating the metadata table if needed"""
+    _create_table(db, "schema_version",
+                  "version INT PRIMARY KEY, description TEXT, applied TIMESTAMP",
+                  "version INTEGER PRIMARY KEY, description TEXT, applied TIMESTAMP")
+    if db.db_type == DataBase.MONGO:
+        res = db.find("schema_version", projection={"version": True}, sort=[("version", -1)], limit=1)
+        return res[0]["version"] if res else 0
+    res = db.select("SELECT max(version) FROM schema_version")
+    return (res[0][0] or 0) if res else 0
+
+
+def _set_version(db: DataBase, version: int, description: str):
+    if db.db_type == DataBase.MONGO:
+        db.replace("schema_version", {"version": version},
+                   {"version": version, "description": description, "applied": time.time()})
+    else:
+        db.execute("replace into schema_version (version, description, applied) values (%s, %s, %s)",
+                   (version, description, time.time()))
+
+
+def migrate(db: DataBase) -> bool:
+    """Apply the pending migrations to a connected DB.
+    It is done only once per process and DB URL, so it can be called on every request.
+
+    Returns: True if the DB is migrated to the last version.
+    """
+    if db.db_url in _applied:
+        return True
+    with _lock:
+        if db.db_url in _applied:
+            return True
+        version = _get_version(db)
+        for mig_version, description, func in MIGRATIONS:
+            if mig_version > version:
+                logger.info("Migrating DB schema to version %d: %s", mig_version, description)
+                func(db)
+                _set_version(db, mig_version, description)
+        _applied.add(db.db_url)
+    return True
+
+
+def migrate_url(db_url) -> bool:
+    """Connect to a DB URL (or to every shard of a list of URLs)
+    and apply the pending migrations (e.g. at startup)"""
+    return all([_migrate_shard(url) for url in (db_url if isinstance(db_url, (list, tuple)) else [db_url])])
+
+
+def _migrate_shard(db_url: str) -> bool:
+    db = DataBase(db_url)
+    if not db.connect():
+        logger.error("Error connecting to the DB to apply the migrations")
+        return False
+    try:
+        return migrate(db)
+    except Exception:
+        logger.exception("Error applying DB migrations")
+        return False
+    finally:
+        db.close()
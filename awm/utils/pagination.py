@@ -0,0 +1,129 @@
+#
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opaque cursors used in keyset pagination"""
+import json
+import base64
+import datetime
+from typing import Tuple
+from awm.utils.db import DataBase
+
+
+def encode_cursor(*values) -> str:
+    """Encode the sort key values of the last element returned (e.g. created and id)"""
+    data = json.dumps(list(values), default=str, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+# Type of the created values in the cursors
+CREATED = (int, float)
+
+
+def cursor_created(created) -> float:
+    """Normalise a created value got from the DB to the timestamp stored in the cursors.
+    MySQL returns datetimes and MongoDB elements stored without created (by old versions) are sorted as 0."""
+    if created is None:
+        return 0.0
+    if isinstance(created, datetime.datetime):
+        return created.timestamp()
+    return float(created)
+
+
+def decode_cursor(cursor: str, *types) -> list:
+    """Decode a cursor returned by encode_cursor, with a value of each of the types
+    (e.g. CREATED, str for the created and id values).
+    Raises ValueError if it is not valid."""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(data)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError("Invalid cursor")
+    for value, value_type in zip(values, types):
+        # bool is a subclass of int
+        if not isinstance(value, value_type) or isinstance(value, bool):
+            raise ValueError("Invalid cursor")
+    return values
+
+
+# Conditions to get the elements after a cursor sorted by (created, id)
+SQL_SEEK = " and created >= %s and (created > %s or id > %s)"
+SQL_SEEK_DESC = " and created <= %s and (created < %s or id < %s)"
+
+
+def sql_seek_args(created, last_id, db_type: str = None) -> tuple:
+    """Get the values of the SQL_SEEK condition from the decoded (created, id) cursor"""
+    if db_type == DataBase.MYSQL:
+        # compare it with the TIMESTAMP column as the datetime returned by MySQL
+        created = datetime.datetime.fromtimestamp(created)
+    return (created, created, last_id)
+
+
+def mongo_seek_filter(created, last_id, descending: bool = True) -> dict:
+    """Get the filter of the elements after the decoded (created, id) cursor"""
+    op = "$lt" if descending else "$gt"
+    # the elements without created have 0 in the cursors
+    same = {"$in": [created, None]} if created == 0 else created
+    return {"$or": [{"created": {op: created}}, {"created": same, "id": {op: last_id}}]}
+
+
+def mongo_sort(descending: bool = True) -> list:
+    direction = -1 if descending else 1
+    return [('created', direction), ('id', direction)]
+
+
+def _sql_where(owner: str, filters: dict = None) -> Tuple[str, tuple]:
+    sql = " WHERE owner = %s"
+    values = (owner,)
+    for column, value in (filters or {}).items():
+        sql += f" and {column} = %s"
+        values += (value,)
+    return sql, values
+
+
+def sql_list_query(table: str, columns: str, owner: str, from_: int, limit: int, last: list = None,
+                   with_count: bool = True, filters: dict = None, descending: bool = False,
+                   db_type: str = None) -> Tuple[str, tuple]:
+    """Get the SQL query, and its values, to list a page of the elements of an owner sorted by (created, id).
+    filters is a dict of column values that the elements must have.
+    It gets one more element to know if there is a next page and, if with_count is set,
+    the total number of matching elements in the last column of every row."""
+    where, where_values = _sql_where(owner, filters)
+    sql = f"SELECT {columns}"
+    values = ()
+    if with_count:
+        sql += f", (SELECT count(id) FROM {table}{where})"
+        values += where_values
+    sql += f" FROM {table}{where}"
+    values += where_values
+    if last:
+        sql += SQL_SEEK_DESC if descending else SQL_SEEK
+        values += sql_seek_args(*last, db_type)
+    sql += " order by created desc, id desc" if descending else " order by created, id"
+    sql += " LIMIT %s OFFSET %s"
+    return sql, values + (limit + 1, from_)
+
+
+def sql_list_total(db, table: str, owner: str, rows: list, paged: bool, filters: dict = None) -> int:
+    """Get the total number of elements from the rows returned by a sql_list_query with count.
+    If the page is empty after an offset or a cursor, it is got with a separate query."""
+    if rows:
+        return rows[0][-1]
+    if not paged:
+        return 0
+    where, values = _sql_where(owner, filters)
+    res = db.select(f"SELECT count(id) from {table}{where}", values)
+    return res[0][0] if res else 0
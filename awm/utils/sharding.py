@@ -0,0 +1,161 @@
+#
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tools to move the owners of the AWM DB among shards when the list of shard URLs changes.
+
+Show the owners that must be moved from the current shards to the new ones:
+
+    python -m awm.utils.sharding plan --source URL [URL ...] --target URL [URL ...]
+
+Move them (or only one of them with --owner). Writes of the moved owners must be
+stopped until the service uses the new shards, as the records are copied and then
+deleted from the source shard. It can be safely repeated if it is interrupted:
+
+    python -m awm.utils.sharding move --source URL [URL ...] --target URL [URL ...]
+"""
+import sys
+import logging
+import argparse
+from awm.utils.db import DataBase
+from awm.utils.migrations import migrate
+
+
+logger = logging.getLogger(__name__)
+
+# Columns of the tables with records of the owners
+TABLES = {
+    "deployments": ["id", "data", "created", "owner", "status", "tool_id", "allocation_id"],
+    "allocations": ["id", "data", "created", "owner"],
+}
+
+
+def _connect(db_url: str) -> DataBase:
+    db = DataBase(db_url)
+    if not db.connect():
+        raise Exception(f"Error connecting to the DB shard {db_url}")
+    migrate(db)
+    return db
+
+
+def get_owners(db: DataBase) -> set:
+    """Get the owners with records in a DB"""
+    owners = set()
+    for table in TABLES:
+        if db.db_type == DataBase.MONGO:
+            owners.update(db.connection[table].distinct("owner"))
+        else:
+            owners.update(row[0] for row in db.select(f"SELECT DISTINCT owner FROM {table}"))
+    owners.discard(None)
+    return owners
+
+
+def plan(source_urls, target_urls) -> list:
+    """Get the owners whose shard changes from the source to the target URLs
+
+    Returns: a list of (owner, source URL, target URL)
+    """
+    target_urls = DataBase.split_urls(target_urls)
+    moves = []
+    for source_url in DataBase.split_urls(source_urls):
+        db = _connect(source_url)
+        try:
+            owners = get_owners(db)
+        finally:
+            db.close()
+        for owner in sorted(owners):
+            target_url = DataBase.get_shard(target_urls, owner)
+            if target_url != source_url:
+                moves.append((owner, source_url, target_url))
+    return moves
+
+
+def _get_records(db: DataBase, table: str, owner: str) -> list:
+    if db.db_type == DataBase.MONGO:
+        return db.find(table, {"owner": owner}, {"_id": False})
+    columns = TABLES[table]
+    rows = db.select(f"SELECT {', '.join(columns)} FROM {table} WHERE owner = %s", (owner,))
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def move_owner(owner: str, source_url: str, target_url: str, keep_source: bool = False) -> dict:
+    """Copy the records of an owner from the source to the target shard, deleting them
+    from the source one unless keep_source is set
+
+    Returns: the number of records copied of each table
+    """
+    source = _connect(source_url)
+    try:
+        target = _connect(target_url)
+        try:
+            copied = {}
+            # copy all the tables before deleting, so it can be repeated if it fails
+            for table in TABLES:
+                records = _get_records(source, table, owner)
+                target.bulk_replace(table, records)
+                copied[table] = len(records)
+            if not keep_source:
+                for table in TABLES:
+                    if source.db_type == DataBase.MONGO:
+                        source.delete(table, {"owner": owner})
+                    else:
+                        source.execute(f"DELETE FROM {table} WHERE owner = %s", (owner,))
+            return copied
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+def move(source_urls, target_urls, owner: str = None, keep_source: bool = False) -> list:
+    """Move the owners (or only the one specified) whose shard changes from the source to the target URLs
+
+    Returns: the list of (owner, source URL, target URL) moved
+    """
+    moves = [m for m in plan(source_urls, target_urls) if owner is None or m[0] == owner]
+    for move_owner_id, source_url, target_url in moves:
+        copied = move_owner(move_owner_id, source_url, target_url, keep_source)
+        logger.info("Owner %s moved from %s to %s: %s", move_owner_id, source_url, target_url, copied)
+    return moves
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m awm.utils.sharding",
+                                     description="Move the owners of the AWM DB among shards")
+    parser.add_argument("command", choices=["plan", "move"])
+    parser.add_argument("--source", required=True, nargs="+", help="URLs of the current shards")
+    parser.add_argument("--target", required=True, nargs="+", help="URLs of the new shards")
+    parser.add_argument("--owner", help="move only the records of this owner")
+    parser.add_argument("--keep-source", action="store_true",
+                        help="do not delete the records from the source shards")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        if args.command == "plan":
+            moves = [m for m in plan(args.source, args.target) if args.owner is None or m[0] == args.owner]
+        else:
+            moves = move(args.source, args.target, args.owner, args.keep_source)
+    except Exception:
+        logger.exception("Error moving the owners among shards")
+        return 1
+    finally:
+        DataBase.close_all()
+    for owner, source_url, target_url in moves:
+        print(f"{owner}: {source_url} -> {target_url}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())